@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Benchmark converting short tracks in batches against one at a time.
+
+Run from anywhere as
+
+    $ python3 benchmarks/batch_conversions.py [--tracks N] [--jobs N]
+          [--stand-in] [--startup SECONDS] [--per-file SECONDS]
+
+Makes N short FLAC tracks with FFmpeg in a temporary directory and
+converts them to mp3 twice, keeping the given number of FFmpeg
+processes going at once: first with an FFmpeg process per track
+(transfer.transcodeFile), then in the batches BatchShortTracks makes
+(transfer.getBatches and transfer.transcodeBatch). Tracks are taken to
+be as long as they're made, so ffprobe isn't run.
+
+With --stand-in, FFmpeg is replaced by a Python script which copies each
+input to its output, sleeping for --startup seconds per process and
+--per-file seconds per file, to measure process overhead alone where
+FFmpeg isn't installed.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transfat import plan  # noqa: E402
+from transfat import transfer  # noqa: E402
+
+# Seconds of audio in each track
+TRACK_DURATION = 20
+
+# Stand-in for FFmpeg, which copies each input to the output after the
+# "-f mp3" following it, or to the last argument
+STAND_IN = '''#!%s
+import shutil, sys, time
+arguments = sys.argv[1:]
+inputs = [arguments[index + 1] for index, argument in enumerate(arguments)
+          if argument == '-i']
+outputs = [arguments[index + 2] for index, argument in enumerate(arguments)
+           if argument == '-f' and arguments[index + 1] == 'mp3']
+time.sleep(%r)
+for inputFile, outputFile in zip(inputs, outputs or arguments[-1:]):
+    time.sleep(%r)
+    shutil.copyfile(inputFile, outputFile)
+'''
+
+
+def makeStandIn(directory, startup, perFile):
+    """Write a stand-in FFmpeg into a directory and put it on the PATH."""
+    path = os.path.join(directory, 'ffmpeg')
+
+    with open(path, 'w') as script:
+        script.write(STAND_IN % (sys.executable, startup, perFile))
+
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = directory + os.pathsep + os.environ['PATH']
+
+
+def makeTracks(directory, count, standIn=False):
+    """Make count short tracks and return their conversions."""
+    first = os.path.join(directory, 'track0000.flac')
+
+    if standIn:
+        with open(first, 'wb') as track:
+            track.write(os.urandom(20 * 1024))
+    else:
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', 'sine=duration=%d' % TRACK_DURATION, first],
+                       check=True)
+
+    conversions = []
+
+    for number in range(count):
+        source = os.path.join(directory, 'track%04d.flac' % number)
+
+        if number:
+            shutil.copyfile(first, source)
+
+        item = plan.TransferItem(source, source, plan.FILE)
+        item.action = plan.CONVERT
+        conversions += [item]
+
+    return conversions
+
+
+def convert(batches, jobs, outputDirectory):
+    """Convert batches of tracks and return the seconds it took."""
+    inputOptions, encoderOptions = transfer.getFFmpegOptions(jobs,
+                                                             quiet=True)
+    os.makedirs(outputDirectory)
+
+    def run(batch):
+        sources = [item.source for item in batch]
+        outputs = [os.path.join(outputDirectory,
+                                os.path.basename(source)[:-5] + '.mp3')
+                   for source in sources]
+
+        return transfer.transcodeBatch(sources, outputs, inputOptions,
+                                       encoderOptions)
+
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = [result for batchResults in executor.map(run, batches)
+                   for result in batchResults]
+
+    elapsed = time.perf_counter() - start
+
+    if any(exitCode for exitCode, _ in results):
+        sys.exit("FFmpeg failed to convert some tracks")
+
+    return elapsed
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tracks", type=int, default=300,
+                        help="number of tracks to convert (default: 300)")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="FFmpeg processes to run at once (default: 4)")
+    parser.add_argument("--stand-in", action='store_true',
+                        help="use a stand-in for FFmpeg which only copies")
+    parser.add_argument("--startup", type=float, default=0.05,
+                        help="seconds the stand-in sleeps per process"
+                             " (default: 0.05)")
+    parser.add_argument("--per-file", type=float, default=0.005,
+                        help="seconds the stand-in sleeps per file"
+                             " (default: 0.005)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.stand_in:
+            makeStandIn(directory, args.startup, args.per_file)
+        elif not shutil.which('ffmpeg'):
+            sys.exit("ffmpeg isn't installed; try --stand-in")
+
+        trackDirectory = os.path.join(directory, 'tracks')
+        os.makedirs(trackDirectory)
+        conversions = makeTracks(trackDirectory, args.tracks, args.stand_in)
+
+        probes = {item.source: {'duration': TRACK_DURATION}
+                  for item in conversions}
+        batches = transfer.getBatches(conversions, probes, args.jobs)
+
+        singleTime = convert([[item] for item in conversions], args.jobs,
+                             os.path.join(directory, 'single'))
+        batchTime = convert(batches, args.jobs,
+                            os.path.join(directory, 'batched'))
+
+    print("one process per track: %.2f s (%d processes)"
+          % (singleTime, len(conversions)))
+    print("batched:               %.2f s (%d processes)"
+          % (batchTime, len(batches)))
+
+
+if __name__ == '__main__':
+    main()
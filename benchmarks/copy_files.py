@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Benchmark copying small files with cp against copying in-process.
+
+Run from anywhere as
+
+    $ python3 benchmarks/copy_files.py [--files N] [--directory DIR]
+
+Makes N files of 4-12 KiB in a scratch directory, then copies them all
+into fresh directories twice: once running cp for each file, as
+transfer.copyFile does when NativeCopyBufferSize is 0, and once copying
+them in-process. Point --directory at a mounted device to time copies to
+it rather than to the local disk.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transfat import transfer  # noqa: E402
+
+
+def makeFiles(directory, count):
+    """Make count files of 4-12 KiB in a directory; return their paths."""
+    random.seed(0)
+    paths = []
+
+    for number in range(count):
+        path = os.path.join(directory, "%05d.mp3" % number)
+
+        with open(path, 'wb') as file_:
+            file_.write(os.urandom(random.randint(4, 12) * 1024))
+
+        paths += [path]
+
+    return paths
+
+
+def copyAll(paths, destination, bufferSize):
+    """Copy files into a new directory; return the seconds it took."""
+    os.mkdir(destination)
+    start = time.monotonic()
+
+    for path in paths:
+        if not transfer.copyFile(path, os.path.join(destination,
+                                                    os.path.basename(path)),
+                                 ['-f'], bufferSize=bufferSize):
+            sys.exit("failed to copy %s" % path)
+
+    return time.monotonic() - start
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=10000,
+                        help="number of files to copy (default: 10000)")
+    parser.add_argument("--buffer-size", type=int,
+                        default=transfer.COPY_BUFFER_SIZE,
+                        help="in-process buffer size in MiB (default: %d)"
+                             % transfer.COPY_BUFFER_SIZE)
+    parser.add_argument("--directory",
+                        help="directory to make the scratch directory in")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(dir=args.directory)
+
+    try:
+        sources = os.path.join(scratch, "sources")
+        os.mkdir(sources)
+        paths = makeFiles(sources, args.files)
+
+        cpTime = copyAll(paths, os.path.join(scratch, "cp"), 0)
+        nativeTime = copyAll(paths, os.path.join(scratch, "native"),
+                             args.buffer_size * 1024**2)
+    finally:
+        shutil.rmtree(scratch)
+
+    print("%d files" % args.files)
+    print("  cp per file: %6.2f s" % cpTime)
+    print("  in-process:  %6.2f s" % nativeTime)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Benchmark how the transfer plan's stages scale with library size.
+
+Run from anywhere as
+
+    $ python3 benchmarks/transfer_plan.py [--sizes N ...]
+
+Builds a transfer plan of N synthetic files, without touching the disk,
+and times filtering out unwanted file types (transfer.filterOutExtensions)
+and working out which files to convert (transfer.planConversions). Of
+every eight files, three are FLAC to convert, three are mp3, one is an
+image to remove, and one is a log to remove. The time per file should
+stay about the same as N grows.
+"""
+
+import argparse
+import configparser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transfat import plan  # noqa: E402
+from transfat import transfer  # noqa: E402
+
+# Names of the files in each synthetic album directory
+ALBUM = ('01.flac', '02.flac', '03.flac', '04.mp3', '05.mp3', '06.mp3',
+         'cover.jpg', 'rip.log')
+
+# Settings the benchmark runs with
+SETTINGS = {'RemoveImages': '1', 'RemoveLog': '1', 'RemoveCue': '1',
+            'RemoveM3U': '1', 'RemoveOtherFiletypes': '0',
+            'ConvertFLACtoMP3': '1', 'ConvertALACtoMP3': '1',
+            'ConvertAACtoMP3': '1', 'ConvertMP4toMP3': '1',
+            'ConvertM4AtoMP3': '1', 'ConvertOGGtoMP3': '1',
+            'OverwriteDestinationFiles': '1'}
+
+
+def iterPaths(count):
+    """Generate count synthetic files, and their directories."""
+    for number in range(count):
+        directory = "album%06d" % (number // len(ALBUM))
+
+        if number % len(ALBUM) == 0:
+            yield ("/library/" + directory, "/device/" + directory, True)
+
+        name = directory + "/" + ALBUM[number % len(ALBUM)]
+        yield ("/library/" + name, "/device/" + name, False)
+
+
+def timed(function, *args):
+    """Return the seconds a function call takes."""
+    start = time.perf_counter()
+    function(*args)
+
+    return time.perf_counter() - start
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help="numbers of files to plan for (default: 1000"
+                             " 10000 100000)")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read_dict({'benchmark': SETTINGS})
+    settings = config['benchmark']
+
+    for size in args.sizes:
+        transferPlan = plan.TransferPlan(iterPaths(size))
+        filterTime = timed(transfer.filterOutExtensions, transferPlan,
+                           settings, True)
+        convertTime = timed(transfer.planConversions, transferPlan,
+                            settings, True)
+
+        print("%7d files: filter %.3f s, convert-plan %.3f s"
+              % (size, filterTime, convertTime))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,423 @@
+"""Checks the native FAT sorter against real FAT12, FAT16, and FAT32 images.
+
+Run with pytest from the repository root:
+
+    $ python3 -m pytest tests
+
+A small FAT16 image is built by hand, entry by entry, to check reading
+and sorting directories without anything else installed.
+
+Bigger images are made with mkfs.vfat if it's installed, and with
+pyfatfs otherwise. Files are written to them in a scrambled order with
+pyfatfs, which doesn't need the image mounted, so those checks are
+skipped if pyfatfs isn't installed. If fsck.vfat is installed, it checks
+the sorted images too.
+"""
+
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transfat import fat  # noqa: E402
+
+try:
+    from pyfatfs.PyFat import PyFat
+    from pyfatfs.PyFatFS import PyFatFS
+except ImportError:
+    PyFat = PyFatFS = None
+
+requiresPyfatfs = pytest.mark.skipif(PyFat is None,
+                                     reason="pyfatfs isn't installed")
+
+# Image sizes in bytes giving each FAT type with mkfs.vfat's and
+# pyfatfs's default cluster sizes
+IMAGE_SIZES = {12: 4 * 1000**2, 16: 40 * 1000**2, 32: 300 * 1000**2}
+
+# Names made to trip the sorter up: numbers which sort differently as
+# text, names differing only in case, long names, and 8.3 names
+FILE_NAMES = (['%02d - Track number %d.mp3' % (number, number)
+               for number in range(1, 13)]
+              + ['Track 2.mp3', 'Track 10.mp3', 'track 1.mp3', 'A.MP3',
+                 'b.mp3', 'cover.jpg', 'COVER2.JPG'])
+DIRECTORY_NAMES = ['Disc 1', 'Disc 2', 'Disc 10', 'album 10', 'Album 9',
+                   'ZZ']
+
+
+def makeImage(path, fatType):
+    """Make an empty FAT image of a given type."""
+    size = IMAGE_SIZES[fatType]
+
+    if shutil.which('mkfs.vfat'):
+        subprocess.run(['mkfs.vfat', '-C', '-F', str(fatType), path,
+                        str(size // 1024)],
+                       check=True, stdout=subprocess.DEVNULL)
+        return
+
+    with open(path, 'wb') as image:
+        image.truncate(size)
+
+    pyFat = PyFat()
+    pyFat.mkfs(path, {12: PyFat.FAT_TYPE_FAT12, 16: PyFat.FAT_TYPE_FAT16,
+                      32: PyFat.FAT_TYPE_FAT32}[fatType], size=size)
+    pyFat.close()
+
+
+def scramble(path, seed=1):
+    """Fill an image with directories and files in a scrambled order.
+
+    Returns:
+        A dictionary mapping the path of each file in the image to its
+        contents.
+    """
+    rng = random.Random(seed)
+    contents = {}
+    directories = DIRECTORY_NAMES[:]
+    rng.shuffle(directories)
+
+    filesystem = PyFatFS(path)
+
+    try:
+        for directory in directories:
+            filesystem.makedir('/' + directory)
+            names = list(FILE_NAMES)
+            rng.shuffle(names)
+
+            for name in names:
+                filePath = '/%s/%s' % (directory, name)
+                contents[filePath] = (filePath.encode()
+                                      * rng.randint(1, 200))
+                filesystem.writebytes(filePath, contents[filePath])
+
+            filesystem.makedir('/%s/sub' % directory)
+
+        for name in ('readme.txt', 'Zebra.mp3', '1.mp3'):
+            contents['/' + name] = name.encode()
+            filesystem.writebytes('/' + name, contents['/' + name])
+
+        # Leave a free entry in the middle of a directory
+        filesystem.remove('/%s/b.mp3' % directories[0])
+        del contents['/%s/b.mp3' % directories[0]]
+    finally:
+        filesystem.close()
+
+    return contents
+
+
+def storedOrders(path):
+    """Return the stored order of every directory of an image.
+
+    Returns:
+        A dictionary mapping the first cluster of each directory, 0 for
+        the root, to a list of 2-tuples of (name, isDirectory), leaving
+        out dot entries and the volume label.
+    """
+    orders = {}
+
+    with fat.FatVolume(path) as volume:
+        stack = [0]
+
+        while stack:
+            cluster = stack.pop()
+            entries = [entry for entry in volume.readDirectory(
+                                            volume.directoryRegions(cluster))
+                       if not (entry.isDotEntry or entry.isVolumeLabel)]
+            orders[cluster] = [(entry.name, entry.isDirectory)
+                               for entry in entries]
+            stack += [entry.cluster for entry in entries
+                      if entry.isDirectory]
+
+    return orders
+
+
+def readFiles(path):
+    """Return a dictionary mapping each file in an image to its contents."""
+    contents = {}
+    filesystem = PyFatFS(path)
+
+    try:
+        for step in filesystem.walk('/'):
+            for info in step.files:
+                filePath = step.path.rstrip('/') + '/' + info.name
+                contents[filePath] = filesystem.readbytes(filePath)
+    finally:
+        filesystem.close()
+
+    return contents
+
+
+# Layout of the hand-built FAT16 image: 512 byte sectors, a cluster per
+# sector, one reserved sector, two FATs, and a 512 entry root directory
+SECTOR_SIZE = 512
+FAT_SECTORS = 17
+ROOT_SECTORS = 32
+DATA_SECTORS = 4100
+FIRST_DATA_SECTOR = 1 + 2 * FAT_SECTORS + ROOT_SECTORS
+
+
+def shortEntry(shortName, attributes=0x20, cluster=0, size=0, case=0):
+    """Return a short directory entry for an 11 byte 8.3 name."""
+    return struct.pack('<11sBBB6xHHHHI', shortName, attributes, case, 0,
+                       cluster >> 16, 0, 0, cluster & 0xFFFF, size)
+
+
+def longEntries(name, shortName):
+    """Return the long name entries for a name, last part first."""
+    characters = name.encode('utf-16-le') + b'\0\0'
+    characters += b'\xFF' * (-len(characters) % 26)
+    parts = [characters[start:start + 26]
+             for start in range(0, len(characters), 26)]
+    checksum = fat.shortNameChecksum(shortName)
+    entries = []
+
+    for number, part in enumerate(parts, 1):
+        entry = bytearray(32)
+        entry[0] = number | (0x40 if number == len(parts) else 0)
+        entry[11] = fat.ATTR_LONG_NAME
+        entry[13] = checksum
+
+        for index, offset in enumerate(fat.LONG_NAME_OFFSETS):
+            entry[offset:offset + 2] = part[2 * index:2 * index + 2]
+
+        entries.insert(0, bytes(entry))
+
+    return b''.join(entries)
+
+
+def entry(name, shortName, **kwargs):
+    """Return a file or directory's entries, with a long name if given."""
+    longName = longEntries(name, shortName) if name else b''
+    return longName + shortEntry(shortName, **kwargs)
+
+
+# The root directory, in stored order: the volume label, then files and
+# directories in a scrambled order, with a free entry and a long name
+# whose short entry has been replaced among them
+ROOT_ENTRIES = [
+    entry(None, b'TESTVOL    ', attributes=fat.ATTR_VOLUME_ID),
+    entry('Track 10.mp3', b'TRACK1~1MP3', size=10),
+    entry('Disc 10', b'DISC10     ', attributes=fat.ATTR_DIRECTORY,
+          cluster=2),
+    entry(None, b'A       MP3', size=1),
+    b'\xE5' + entry('gone.mp3', b'GONE    MP3')[1:32],
+    entry('track 2.mp3', b'TRACK2~1MP3', size=2),
+    entry(None, b'B       MP3', size=1, case=fat.LOWER_CASE_BASE
+                                           | fat.LOWER_CASE_EXTENSION),
+    longEntries('stale name.mp3', b'OLD     MP3')
+    + shortEntry(b'NEW     MP3', size=3),
+    entry('Disc 9', b'DISC9      ', attributes=fat.ATTR_DIRECTORY,
+          cluster=3),
+    entry('A rather long file name which takes several entries.mp3',
+          b'ARATHE~1MP3', size=4),
+]
+
+# Names read from the root directory, in stored order
+ROOT_NAMES = ['TESTVOL', 'Track 10.mp3', 'Disc 10', 'A.MP3', 'track 2.mp3',
+              'b.mp3', 'NEW.MP3', 'Disc 9',
+              'A rather long file name which takes several entries.mp3']
+
+# Entries of Disc 10, in cluster 2
+SUBDIRECTORY_ENTRIES = [
+    entry(None, b'.          ', attributes=fat.ATTR_DIRECTORY, cluster=2),
+    entry(None, b'..         ', attributes=fat.ATTR_DIRECTORY),
+    entry('Track 3.flac', b'TRACK3~1FLA', size=5),
+    entry('Track 1.flac', b'TRACK1~1FLA', size=5),
+]
+
+
+def makeFat16Image(path):
+    """Write a FAT16 image with the entries above, and no file data."""
+    totalSectors = FIRST_DATA_SECTOR + DATA_SECTORS
+    boot = bytearray(SECTOR_SIZE)
+    boot[0:11] = b'\xEB\x3C\x90MSWIN4.1'
+    struct.pack_into('<HBHBHHBHHHI', boot, 11, SECTOR_SIZE, 1, 1, 2,
+                     ROOT_SECTORS * SECTOR_SIZE // 32, totalSectors, 0xF8,
+                     FAT_SECTORS, 32, 2, 0)
+    struct.pack_into('<BBBI11s8s', boot, 36, 0x80, 0,
+                     fat.EXTENDED_BOOT_SIGNATURE, 0x1234ABCD, b'TESTVOL    ',
+                     b'FAT16   ')
+    boot[510:512] = b'\x55\xAA'
+
+    # Clusters 0 and 1 are reserved, and the directories in clusters 2
+    # and 3 are one cluster long
+    table = struct.pack('<4H', 0xFFF8, 0xFFFF, 0xFFFF, 0xFFFF)
+
+    with open(path, 'wb') as image:
+        image.truncate(totalSectors * SECTOR_SIZE)
+        image.write(boot)
+
+        for number in range(2):
+            image.seek((1 + number * FAT_SECTORS) * SECTOR_SIZE)
+            image.write(table)
+
+        image.seek((1 + 2 * FAT_SECTORS) * SECTOR_SIZE)
+        image.write(b''.join(ROOT_ENTRIES))
+
+        image.seek(FIRST_DATA_SECTOR * SECTOR_SIZE)
+        image.write(b''.join(SUBDIRECTORY_ENTRIES))
+
+        # Disc 9 is empty apart from its dot entries
+        image.seek((FIRST_DATA_SECTOR + 1) * SECTOR_SIZE)
+        image.write(entry(None, b'.          ',
+                          attributes=fat.ATTR_DIRECTORY, cluster=3)
+                    + entry(None, b'..         ',
+                            attributes=fat.ATTR_DIRECTORY))
+
+
+def test_readDirectory(tmp_path):
+    """Hand-built entries are read back as they were written."""
+    path = str(tmp_path / 'fat16.img')
+    makeFat16Image(path)
+
+    with fat.FatVolume(path) as volume:
+        assert volume.fatType == 16
+        assert volume.volumeId == 0x1234ABCD
+        assert volume.volumeLabel == 'TESTVOL'
+        assert volume.directoryRegions(2) == [(FIRST_DATA_SECTOR
+                                               * SECTOR_SIZE, SECTOR_SIZE)]
+
+        entries = volume.readDirectory(volume.directoryRegions(0))
+
+        assert [entry.name for entry in entries] == ROOT_NAMES
+        assert [entry.data for entry in entries] == [
+                            data for data in ROOT_ENTRIES if data[0] != 0xE5]
+        assert entries[0].isVolumeLabel
+        assert [entry.name for entry in entries if entry.isDirectory] == [
+                                                        'Disc 10', 'Disc 9']
+        assert entries[2].cluster == 2
+
+        subdirectory = volume.readDirectory(volume.directoryRegions(2))
+
+        assert [entry.name for entry in subdirectory] == [
+                                '.', '..', 'Track 3.flac', 'Track 1.flac']
+        assert [entry.isDotEntry for entry in subdirectory] == [
+                                                True, True, False, False]
+
+
+def test_sortDirectory(tmp_path):
+    """Sorting rewrites entries in natural order, and nothing else."""
+    path = str(tmp_path / 'fat16.img')
+    makeFat16Image(path)
+
+    with open(path, 'rb') as image:
+        before = image.read()
+
+    rootOffset = (1 + 2 * FAT_SECTORS) * SECTOR_SIZE
+    rootSize = ROOT_SECTORS * SECTOR_SIZE
+
+    with fat.FatVolume(path) as volume:
+        rewritten, entries = volume.sortDirectory(0)
+
+        assert rewritten
+        assert [entry.name for entry in entries] == [
+            'TESTVOL', 'Disc 9', 'Disc 10',
+            'A rather long file name which takes several entries.mp3',
+            'A.MP3', 'b.mp3', 'NEW.MP3', 'track 2.mp3', 'Track 10.mp3']
+
+        # What's stored is what was returned, without the free entry
+        stored = volume.readDirectory(volume.directoryRegions(0))
+
+        assert ([entry.data for entry in stored]
+                == [entry.data for entry in entries])
+        assert (sorted(entry.data for entry in stored)
+                == sorted(data for data in ROOT_ENTRIES if data[0] != 0xE5))
+
+        # Sorting again changes nothing
+        assert not volume.sortDirectory(0)[0]
+
+        rewritten, entries = volume.sortDirectory(2)
+
+        assert rewritten
+        assert [entry.name for entry in entries] == [
+                                '.', '..', 'Track 1.flac', 'Track 3.flac']
+
+    with open(path, 'rb') as image:
+        after = image.read()
+
+    # Only the directories changed, and what's after the root
+    # directory's entries is zeroed
+    used = len(b''.join(data for data in ROOT_ENTRIES if data[0] != 0xE5))
+    subdirectoryOffset = FIRST_DATA_SECTOR * SECTOR_SIZE
+
+    assert after[:rootOffset] == before[:rootOffset]
+    assert after[rootOffset + used:rootOffset + rootSize] == bytes(
+                                                            rootSize - used)
+    assert (after[rootOffset + rootSize:subdirectoryOffset]
+            == before[rootOffset + rootSize:subdirectoryOffset])
+    assert (after[subdirectoryOffset + SECTOR_SIZE:]
+            == before[subdirectoryOffset + SECTOR_SIZE:])
+
+
+def test_sortVolumeByHand(tmp_path):
+    """Every directory of a hand-built image is sorted."""
+    path = str(tmp_path / 'fat16.img')
+    makeFat16Image(path)
+
+    assert fat.sortVolume(path) == (2, 3)
+    assert fat.sortVolume(path) == (0, 3)
+
+
+@requiresPyfatfs
+@pytest.mark.parametrize('fatType', [12, 16, 32])
+def test_sortVolume(tmp_path, fatType):
+    """Sorting puts every directory in order and changes nothing else."""
+    path = str(tmp_path / 'fat.img')
+    makeImage(path, fatType)
+    contents = scramble(path)
+
+    with fat.FatVolume(path) as volume:
+        assert volume.fatType == fatType
+
+    # The scrambled image needs sorting
+    assert any(order != sorted(order, key=lambda pair: fat.sortKey(*pair))
+               for order in storedOrders(path).values())
+
+    rewritten, visited = fat.sortVolume(path)
+
+    assert rewritten > 0
+    assert visited == 1 + 2 * len(DIRECTORY_NAMES)
+
+    for order in storedOrders(path).values():
+        assert order == sorted(order, key=lambda pair: fat.sortKey(*pair))
+
+    assert readFiles(path) == contents
+
+    # Sorting again has nothing to do
+    assert fat.sortVolume(path) == (0, visited)
+
+    if shutil.which('fsck.vfat'):
+        subprocess.run(['fsck.vfat', '-n', path], check=True,
+                       stdout=subprocess.DEVNULL)
+
+
+@requiresPyfatfs
+def test_sortDirectories(tmp_path):
+    """Sorting some directories leaves the others alone."""
+    path = str(tmp_path / 'fat.img')
+    makeImage(path, 16)
+    scramble(path)
+
+    before = storedOrders(path)
+    fat.sortVolume(path, ['disc 2'])
+    after = storedOrders(path)
+
+    with fat.FatVolume(path) as volume:
+        root = volume.readDirectory(volume.directoryRegions(0))
+        clusters = {entry.name: entry.cluster for entry in root}
+
+    for cluster, order in after.items():
+        if cluster in (0, clusters['Disc 2']):
+            assert order == sorted(order,
+                                   key=lambda pair: fat.sortKey(*pair))
+        else:
+            assert order == before[cluster]
+
+
+if __name__ == '__main__':
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,91 @@
+"""Checks finding FAT devices in the kernel's mount table.
+
+Run with pytest from the repository root:
+
+    $ python3 -m pytest tests
+
+The mount table is read from a file written for each test, in the format
+of /proc/self/mountinfo, so nothing needs to be mounted.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transfat import fatsort  # noqa: E402
+
+# Mounts in the order they were mounted: the root filesystem, a USB
+# stick with a space and a backslash in its label, an SD card mounted
+# inside it, and two filesystems stacked at the same place. Some lines
+# have optional fields before the separator, and some have none.
+MOUNT_INFO = r"""22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw
+25 22 0:5 / /dev rw,nosuid shared:2 - devtmpfs udev rw,size=8000k
+40 22 8:17 / /media/MY\040MUSIC rw shared:30 master:2 - vfat /dev/sdb1 rw
+41 40 8:33 / /media/MY\040MUSIC/sd\134card rw,relatime - exfat /dev/sdc1 rw
+42 22 8:49 / /mnt/stick rw,relatime shared:31 - ext4 /dev/sdd1 rw
+43 42 8:50 / /mnt/stick rw,relatime shared:32 - vfat /dev/sdd2 rw
+a line cut off by a crash
+"""
+
+
+@pytest.fixture
+def mountInfo(tmp_path, monkeypatch):
+    """Write the mount table and have fatsort read it."""
+    path = str(tmp_path / 'mountinfo')
+
+    with open(path, 'w') as mountInfoFile:
+        mountInfoFile.write(MOUNT_INFO)
+
+    getMounts = fatsort.getMounts
+    monkeypatch.setattr(fatsort, 'getMounts',
+                        lambda mountInfoPath=path: getMounts(mountInfoPath))
+
+    return path
+
+
+def test_getMounts(mountInfo):
+    """Optional fields are skipped, and escapes are undone."""
+    assert fatsort.getMounts(mountInfo) == [
+        ('/dev/sda1', '/', 'ext4'),
+        ('udev', '/dev', 'devtmpfs'),
+        ('/dev/sdb1', '/media/MY MUSIC', 'vfat'),
+        ('/dev/sdc1', '/media/MY MUSIC/sd\\card', 'exfat'),
+        ('/dev/sdd1', '/mnt/stick', 'ext4'),
+        ('/dev/sdd2', '/mnt/stick', 'vfat')]
+
+
+def test_getMountsUnreadable(tmp_path):
+    """A mount table which can't be read has nothing in it."""
+    assert fatsort.getMounts(str(tmp_path / 'missing')) == []
+
+
+@pytest.mark.parametrize('destination, expected', [
+    ('/media/MY MUSIC', ('/dev/sdb1', '/media/MY MUSIC')),
+    ('/media/MY MUSIC/albums/a',
+     ('/dev/sdb1', '/media/MY MUSIC')),
+    # The longest mount location containing the destination wins
+    ('/media/MY MUSIC/sd\\card/albums',
+     ('/dev/sdc1', '/media/MY MUSIC/sd\\card')),
+    # Of stacked mounts, the last one mounted hides the others
+    ('/mnt/stick/albums', ('/dev/sdd2', '/mnt/stick')),
+    # Not a prefix match on names
+    ('/media/MY MUSICAL', ('', '')),
+    ('/home/user', ('', ''))])
+def test_findDeviceLocations(mountInfo, destination, expected):
+    """The device a destination is on is found."""
+    assert fatsort.findDeviceLocations(destination, True) == expected
+
+
+def test_getFilesystemType(mountInfo):
+    """The type of the last filesystem mounted somewhere is found."""
+    assert fatsort.getFilesystemType('/mnt/stick', mountInfo) == 'vfat'
+    assert fatsort.getFilesystemType('/media/MY MUSIC/sd\\card',
+                                     mountInfo) == 'exfat'
+    assert fatsort.getFilesystemType('/nowhere', mountInfo) == ''
+
+
+if __name__ == '__main__':
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
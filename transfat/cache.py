@@ -0,0 +1,173 @@
+"""Contains a persistent, size-bounded cache of transcoded audio files."""
+
+import functools
+import hashlib
+import os
+import subprocess
+import threading
+
+# Extension given to files in the cache
+CACHE_EXTENSION = '.mp3'
+
+# Block size to read files with when fingerprinting them
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+
+
+def getCacheDirectoryPath():
+    """Return a string containing the path of the cache directory.
+
+    Follows the XDG spec, so this is $XDG_CACHE_HOME/transfat, which
+    defaults to ~/.cache/transfat. Transcoded files are kept in the
+    'transcodes' subdirectory of this.
+    """
+    cachedir = (os.environ.get("XDG_CACHE_HOME")
+                or os.path.expanduser("~/.cache"))
+
+    return cachedir + "/transfat"
+
+
+def fileFingerprint(path):
+    """Return a hex string identifying the contents of a file."""
+    digest = hashlib.blake2b(digest_size=20)
+
+    with open(path, 'rb') as file_:
+        for block in iter(lambda: file_.read(FINGERPRINT_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def ffmpegVersion():
+    """Return the version line FFmpeg reports, or an empty string."""
+    try:
+        output = subprocess.run(['ffmpeg', '-version'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL).stdout
+    except OSError:
+        return ''
+
+    return output.decode('utf-8', 'replace').partition('\n')[0]
+
+
+class TranscodeCache:
+    """A directory of transcoded files keyed by source and settings.
+
+    Entries are named after a hash of the source file's contents and
+    the encoder settings used to produce them, so a changed source, a
+    changed quality setting, or a new FFmpeg version all miss the cache.
+    Each entry's modification time records when it was last used, which
+    is what evict uses to throw out the least recently used entries.
+
+    Attributes:
+        directory: A string containing the path of the cache directory.
+        sizeLimit: An integer containing the number of bytes the cache
+            is allowed to hold after eviction.
+        fingerprint: A function returning the content fingerprint of
+            the file at a path.
+        hits: An integer counting lookups that found an entry.
+        misses: An integer counting lookups that didn't find an entry.
+    """
+
+    def __init__(self, directory, sizeLimit, fingerprint=fileFingerprint):
+        """Open (creating if necessary) a cache directory.
+
+        The function used to fingerprint source files can be swapped
+        out for one that remembers fingerprints, such as
+        'library.LibraryIndex.fingerprint'.
+        """
+        self.directory = directory
+        self.sizeLimit = sizeLimit
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, sourcePath, *settings):
+        """Return the key for a source file and encoder settings."""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(self.fingerprint(sourcePath).encode())
+
+        for setting in settings:
+            digest.update(b'\0' + str(setting).encode())
+
+        return digest.hexdigest()
+
+    def path(self, key):
+        """Return the path of the entry for a key."""
+        return os.path.join(self.directory, key[:2], key + CACHE_EXTENSION)
+
+    def lookup(self, key):
+        """Return the path of an entry if it exists, or None.
+
+        Finding an entry marks it as recently used.
+        """
+        entryPath = self.path(key)
+
+        try:
+            os.utime(entryPath)
+        except OSError:
+            entryPath = None
+
+        with self._lock:
+            if entryPath:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return entryPath
+
+    def temporaryPath(self, key):
+        """Return a path to write a new entry to before storing it."""
+        entryPath = self.path(key)
+        os.makedirs(os.path.dirname(entryPath), exist_ok=True)
+
+        return "%s.%d.%d.part" % (entryPath, os.getpid(),
+                                  threading.get_ident())
+
+    def store(self, key, temporaryPath):
+        """Move a finished file into the cache and return its path."""
+        entryPath = self.path(key)
+        os.replace(temporaryPath, entryPath)
+
+        return entryPath
+
+    def evict(self):
+        """Remove least recently used entries until under the size limit.
+
+        Returns:
+            An integer containing the number of entries removed.
+        """
+        entries = []
+        totalSize = 0
+
+        for root, _, files in os.walk(self.directory):
+            for file_ in files:
+                entryPath = os.path.join(root, file_)
+
+                try:
+                    info = os.stat(entryPath)
+                except OSError:
+                    continue
+
+                entries += [(info.st_mtime, info.st_size, entryPath)]
+                totalSize += info.st_size
+
+        # Go through the entries from least to most recently used
+        removed = 0
+
+        for _, size, entryPath in sorted(entries):
+            if totalSize <= self.sizeLimit:
+                break
+
+            try:
+                os.remove(entryPath)
+            except OSError:
+                continue
+
+            totalSize -= size
+            removed += 1
+
+        return removed
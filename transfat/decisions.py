@@ -0,0 +1,250 @@
+"""Contains functions for asking every question a transfer has up front.
+
+Settings set to prompt would otherwise have transfat ask questions as it
+comes across files, in the middle of converting and copying, so a long
+transfer can sit waiting for an answer for hours. Instead, the files of
+a transfer plan are looked over before any work starts, and similar
+questions are asked together: once for everything they apply to, and
+then, if the answer is no, directory by directory if the user wants.
+The answers are applied to the plan, so the work itself never needs to
+ask anything.
+"""
+
+import os
+from . import plan
+from . import talk
+from . import transfer
+from .config.constants import PROMPT
+
+
+class Decisions:
+    """The answers to the questions asked about a transfer.
+
+    Attributes:
+        conversions: A dictionary mapping 2-tuples of ("dirpath",
+            "extension") to whether to convert files of that extension
+            in that directory, for transfer.ConversionPlanner.
+        overwrite: A boolean signalling that files which are already at
+            their destinations are to be overwritten. Files which
+            aren't have been marked as skipped.
+        replacedFiles: A list of strings containing the paths of files
+            in the way of destination directories, to be removed so
+            that the directories can be created.
+        removedSources: A list of strings containing the paths of
+            sources to remove once they've been transferred.
+    """
+
+    def __init__(self):
+        """Start without any answers."""
+        self.conversions = {}
+        self.overwrite = False
+        self.replacedFiles = []
+        self.removedSources = []
+
+
+def gatherDecisions(transferPlan, configsettings, sources):
+    """Ask every question a transfer needs answering.
+
+    Files which are being kept out of the transfer are marked as
+    removed, files which aren't to be overwritten as skipped, and the
+    planned writes of files which won't be converted are corrected.
+    Questions the config settings don't ask to be prompted for aren't
+    asked.
+
+    Args:
+        transferPlan: A 'plan.TransferPlan' object whose planned writes
+            have been worked out (see transfer.getPlannedWrites).
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        sources: A list of strings containing the paths of the sources
+            being transferred.
+
+    Returns:
+        A 'Decisions' object.
+    """
+    decisions = Decisions()
+
+    askRemovals(transferPlan, configsettings)
+    askReplacements(transferPlan, decisions)
+    askConversions(transferPlan, configsettings, decisions)
+    askOverwrites(transferPlan, configsettings, decisions)
+
+    if configsettings.getint('DeleteSources') == PROMPT:
+        decisions.removedSources = [source for source in sources
+                                    if talk.prompt("Remove %s once it's"
+                                                   " transferred?" % source)]
+
+    return decisions
+
+
+def askGrouped(question, groups):
+    """Ask a yes/no question about groups of files, all at once.
+
+    The question is asked about every group first. If the answer is no
+    and there's more than one group, the user can answer group by group
+    instead.
+
+    Args:
+        question: A string to be formatted with a description of the
+            files asked about, for instance "Convert %s?".
+        groups: A dictionary mapping directories to lists of the files
+            in them being asked about.
+
+    Returns:
+        A set of the directories the answer was yes for.
+    """
+    if len(groups) == 1:
+        directory, files = next(iter(groups.items()))
+        return ({directory} if talk.prompt(question % describe(files,
+                                                               directory))
+                else set())
+
+    fileCount = sum(len(files) for files in groups.values())
+
+    if talk.prompt(question % ("all %d of them, in %d directories"
+                               % (fileCount, len(groups)))):
+        return set(groups)
+    elif not talk.prompt("Answer directory by directory?"):
+        return set()
+
+    return {directory for directory, files in sorted(groups.items())
+            if talk.prompt(question % describe(files, directory))}
+
+
+def describe(files, directory):
+    """Return a description of some files in a directory for a question."""
+    if len(files) == 1:
+        return files[0]
+
+    return "the %d of them in %s" % (len(files), directory)
+
+
+def askRemovals(transferPlan, configsettings):
+    """Ask which files to transfer, for file types set to prompt.
+
+    Files which aren't wanted are marked as removed. Files of types
+    which are set to be removed without asking are left alone; see
+    transfer.filterOutExtensions.
+    """
+    removalOptions = transfer.getRemovalOptions(configsettings)
+
+    # Files to ask about, by extension and then by directory
+    groups = {}
+
+    for item in transferPlan.files():
+        if transfer.getRemoveOption(item.destination,
+                                    removalOptions) == PROMPT:
+            extension = os.path.splitext(item.source)[1].lower()
+            directory = os.path.dirname(item.source)
+            groups.setdefault(extension, {}).setdefault(
+                                        directory, []).append(item)
+
+    for extension, directories in sorted(groups.items()):
+        question = "Transfer %s files: %%s?" % (extension or "other")
+        wanted = askGrouped(question,
+                            {directory: [item.source for item in items]
+                             for directory, items in directories.items()})
+
+        for directory, items in directories.items():
+            if directory not in wanted:
+                for item in items:
+                    item.status = plan.REMOVED
+
+    return
+
+
+def askReplacements(transferPlan, decisions):
+    """Ask whether to replace files in the way of destination directories.
+
+    Directories which can't be created, and everything in them, are
+    marked as removed. Files to replace are added to the decisions.
+    """
+    for item in transferPlan.directories():
+        if not os.path.isfile(item.destination):
+            continue
+
+        if talk.prompt("%s is a file. Overwrite?" % item.destination):
+            decisions.replacedFiles += [item.destination]
+            continue
+
+        prefix = os.path.join(item.destination, '')
+        item.status = plan.REMOVED
+
+        for other in transferPlan.items:
+            if other.destination.startswith(prefix):
+                other.status = plan.REMOVED
+
+    return
+
+
+def askConversions(transferPlan, configsettings, decisions):
+    """Ask which files to convert, for extensions set to prompt.
+
+    Adds the answers to the decisions, and corrects the planned writes
+    of files which won't be converted.
+    """
+    promptExtensions = tuple(extension for extension, promptFlag
+                             in transfer.getConversionExtensions(
+                                                        configsettings)
+                             if promptFlag)
+
+    # Files to ask about, by extension and then by directory
+    groups = {}
+
+    for item in transferPlan.files():
+        extension = os.path.splitext(item.source)[1].lower()
+
+        if extension in promptExtensions:
+            directory = os.path.dirname(item.source)
+            groups.setdefault(extension, {}).setdefault(
+                                        directory, []).append(item)
+
+    for extension, directories in sorted(groups.items()):
+        wanted = askGrouped("Convert %s files: %%s?" % extension,
+                            {directory: [item.source for item in items]
+                             for directory, items in directories.items()})
+
+        for directory, items in directories.items():
+            decisions.conversions[(directory, extension)] = (directory
+                                                             in wanted)
+
+            if directory not in wanted:
+                # Copied as it is
+                for item in items:
+                    item.target = item.destination
+                    item.encoder = None
+
+    return
+
+
+def askOverwrites(transferPlan, configsettings, decisions):
+    """Ask which files already on the device to overwrite.
+
+    Only asked if overwriting is set to prompt. Files not to overwrite
+    are marked as skipped.
+    """
+    overwriteSetting = configsettings.getint('OverwriteDestinationFiles')
+
+    if overwriteSetting != PROMPT:
+        return
+
+    # Files already at their destinations, by directory
+    groups = {}
+
+    for item in transferPlan.files():
+        if os.path.lexists(item.target):
+            groups.setdefault(os.path.dirname(item.target), []).append(item)
+
+    wanted = (askGrouped("Overwrite existing files: %s?",
+                         {directory: [item.target for item in items]
+                          for directory, items in groups.items()})
+              if groups else set())
+
+    for directory, items in groups.items():
+        if directory not in wanted:
+            for item in items:
+                item.status = plan.SKIPPED
+
+    decisions.overwrite = True
+
+    return
@@ -0,0 +1,661 @@
+"""Contains a native sorter for the directories of FAT filesystems.
+
+Many car stereos play files in the order their directory entries are
+stored in, which for FAT is the order they were created in. Sorting a
+directory means rewriting its entries in natural order in place; no
+file data is touched, and neither is the file allocation table.
+
+The filesystem (a block device or an image file) is memory-mapped, so
+only the directories being sorted and the parts of the file allocation
+table needed to follow them are ever read. The filesystem mustn't be
+mounted while it's being sorted.
+
+The same parsing is used to report how fragmented the files on a
+filesystem are, by following each file's chain of clusters and counting
+the runs of consecutive clusters it's stored in.
+"""
+
+import mmap
+import os
+import re
+import struct
+import sys
+
+# Size of a directory entry in bytes
+ENTRY_SIZE = 32
+
+# Directory entry attributes
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_LONG_NAME = 0x0F
+
+# Signature of boot sectors with a volume ID and label
+EXTENDED_BOOT_SIGNATURE = 0x29
+
+# Name exFAT boot sectors give their filesystem, where FAT keeps its
+# BIOS parameter block
+EXFAT_NAME = b'EXFAT   '
+
+# First bytes of directory entries with special meanings
+FREE_ENTRY = 0xE5
+END_OF_DIRECTORY = 0x00
+
+# Flags in the reserved byte of short entries, set by Windows to store
+# names whose base or extension is entirely lower case
+LOWER_CASE_BASE = 0x08
+LOWER_CASE_EXTENSION = 0x10
+
+# Byte offsets of the UTF-16 characters of long name entries
+LONG_NAME_OFFSETS = (1, 3, 5, 7, 9, 14, 16, 18, 20, 22, 24, 28, 30)
+
+
+def naturalKey(name):
+    """Return a sort key putting names in natural, case-blind order.
+
+    Runs of digits compare as numbers, so "track 2" comes before
+    "track 10".
+    """
+    parts = re.split(r'(\d+)', name.casefold())
+    parts[1::2] = [int(digits) for digits in parts[1::2]]
+
+    return parts
+
+
+def sortKey(name, isDirectory=False):
+    """Return the key directory entries are sorted by.
+
+    Directories come before files, and each are in natural order (see
+    naturalKey), with names differing only in case kept in a consistent
+    order.
+    """
+    return (not isDirectory, naturalKey(name), name)
+
+
+def shortNameChecksum(shortName):
+    """Return the checksum long name entries store of a short name."""
+    checksum = 0
+
+    for byte in shortName:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+
+    return checksum
+
+
+class DirectoryEntry:
+    """A file or directory's entries in its parent directory.
+
+    Attributes:
+        data: A bytes object containing the raw entries, which are any
+            long name entries followed by the short entry.
+        name: A string containing the long name if there is a valid one,
+            and otherwise the short name.
+        attributes: An integer containing the short entry's attributes.
+        cluster: An integer containing the number of the first cluster
+            of the file or directory.
+    """
+
+    __slots__ = ('data', 'name', 'attributes', 'cluster')
+
+    def __init__(self, data, longNameEntries):
+        """Parse an entry from its raw bytes.
+
+        Args:
+            data: A bytes object as described for the data attribute.
+            longNameEntries: An integer containing how many long name
+                entries there are at the start of data.
+        """
+        self.data = data
+        short = data[-ENTRY_SIZE:]
+        self.attributes = short[11]
+        self.cluster = ((struct.unpack_from('<H', short, 20)[0] << 16)
+                        | struct.unpack_from('<H', short, 26)[0])
+        self.name = (self.longName(data[:-ENTRY_SIZE], short[:11])
+                     if longNameEntries else None) or self.shortName(short)
+
+    @staticmethod
+    def shortName(short):
+        """Return the 8.3 name stored in a short entry."""
+        base = bytearray(short[:8].rstrip(b' '))
+        extension = short[8:11].rstrip(b' ')
+
+        # 0xE5 is stored as 0x05 in the first byte, since 0xE5 would
+        # mark the entry as free
+        if base[:1] == b'\x05':
+            base[0] = FREE_ENTRY
+
+        base = base.decode('cp437')
+        extension = extension.decode('cp437')
+
+        if short[12] & LOWER_CASE_BASE:
+            base = base.lower()
+        if short[12] & LOWER_CASE_EXTENSION:
+            extension = extension.lower()
+
+        return base + '.' + extension if extension else base
+
+    @staticmethod
+    def longName(entries, shortName):
+        """Return the name stored in long name entries, or None.
+
+        The entries are stored last part first. None is returned if the
+        entries don't belong to the short name.
+        """
+        checksum = shortNameChecksum(shortName)
+        characters = bytearray()
+
+        for start in range(len(entries) - ENTRY_SIZE, -1, -ENTRY_SIZE):
+            if entries[start + 13] != checksum:
+                return None
+
+            for offset in LONG_NAME_OFFSETS:
+                characters += entries[start + offset:start + offset + 2]
+
+        name = characters.decode('utf-16-le', 'replace')
+
+        # The name is terminated by a null character if it doesn't fill
+        # the last entry
+        return name.split('\0', 1)[0]
+
+    @property
+    def isDirectory(self):
+        """Whether the entry is a subdirectory."""
+        return bool(self.attributes & ATTR_DIRECTORY)
+
+    @property
+    def isDotEntry(self):
+        """Whether the entry is the "." or ".." entry of a directory."""
+        return self.data[-ENTRY_SIZE] == ord('.')
+
+    @property
+    def isVolumeLabel(self):
+        """Whether the entry is the volume label."""
+        return bool(self.attributes & ATTR_VOLUME_ID)
+
+
+class FatVolume:
+    """A memory-mapped FAT12, FAT16, or FAT32 filesystem.
+
+    Attributes:
+        path: A string containing the path of the device or image file.
+        fatType: An integer containing 12, 16, or 32.
+        bytesPerSector: An integer containing the size of a sector.
+        sectorsPerCluster: An integer containing the number of sectors
+            in a cluster.
+        bytesPerCluster: An integer containing the size of a cluster.
+        clusterCount: An integer containing the number of data clusters.
+        dataOffset: An integer containing the byte offset of the data
+            region, which follows the boot sector, file allocation
+            tables, and (except on FAT32) the root directory.
+        volumeId: An integer containing the volume serial number, or
+            None if the boot sector doesn't have one.
+        volumeLabel: A string containing the volume label stored in the
+            boot sector, or None if it doesn't have one.
+        rootCluster: An integer containing the first cluster of the root
+            directory on FAT32, and 0 otherwise, where the root
+            directory has a fixed region of its own.
+    """
+
+    def __init__(self, path):
+        """Open and map a filesystem, reading its boot sector.
+
+        Raises an OSError if the path can't be opened or mapped, and a
+        ValueError if it doesn't contain a FAT filesystem.
+        """
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR)
+
+        try:
+            # Block devices report a size of zero to stat, so seek to
+            # the end to find their size
+            size = os.lseek(self._fd, 0, os.SEEK_END)
+            self._map = mmap.mmap(self._fd, size)
+        except (OSError, ValueError):
+            os.close(self._fd)
+            raise
+
+        try:
+            self.readBootSector()
+        except (ValueError, struct.error):
+            self.close()
+            raise ValueError("%s doesn't contain a FAT filesystem" % path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Write any changes back and unmap the filesystem."""
+        self._map.flush()
+        self._map.close()
+        os.close(self._fd)
+
+    def readBootSector(self):
+        """Read the filesystem's layout from its boot sector."""
+        boot = self._map
+
+        if boot[510:512] != b'\x55\xAA':
+            raise ValueError("missing boot sector signature")
+
+        (bytesPerSector, sectorsPerCluster, reservedSectors, fatCount,
+         rootEntryCount, totalSectors16, fatSize16) = struct.unpack_from(
+                                                        '<HBHBHHxH', boot, 11)
+        totalSectors32, fatSize32, rootCluster = struct.unpack_from(
+                                                        '<I I 4x I', boot, 32)
+
+        if (bytesPerSector not in (512, 1024, 2048, 4096)
+                or sectorsPerCluster == 0 or fatCount == 0):
+            raise ValueError("invalid BIOS parameter block")
+
+        fatSize = fatSize16 or fatSize32
+        totalSectors = totalSectors16 or totalSectors32
+        rootSectors = ((rootEntryCount * ENTRY_SIZE + bytesPerSector - 1)
+                       // bytesPerSector)
+        firstDataSector = reservedSectors + fatCount * fatSize + rootSectors
+
+        self.bytesPerSector = bytesPerSector
+        self.sectorsPerCluster = sectorsPerCluster
+        self.bytesPerCluster = bytesPerSector * sectorsPerCluster
+        self.clusterCount = ((totalSectors - firstDataSector)
+                             // sectorsPerCluster)
+
+        # The FAT type is determined by the number of clusters alone
+        if self.clusterCount < 4085:
+            self.fatType = 12
+        elif self.clusterCount < 65525:
+            self.fatType = 16
+        else:
+            self.fatType = 32
+
+        self._fatOffset = reservedSectors * bytesPerSector
+        self.dataOffset = firstDataSector * bytesPerSector
+
+        # The volume ID and label are in the extended boot record, if
+        # there is one, which is further along on FAT32
+        extendedOffset = 64 if self.fatType == 32 else 36
+
+        if boot[extendedOffset + 2] == EXTENDED_BOOT_SIGNATURE:
+            self.volumeId, label = struct.unpack_from('<I11s', boot,
+                                                      extendedOffset + 3)
+            self.volumeLabel = label.decode('cp437').rstrip(' ')
+        else:
+            self.volumeId = self.volumeLabel = None
+
+        if self.fatType == 32:
+            self.rootCluster = rootCluster
+            self._rootRegion = None
+        else:
+            self.rootCluster = 0
+            self._rootRegion = (self.dataOffset
+                                - rootSectors * bytesPerSector,
+                                rootSectors * bytesPerSector)
+
+    def nextCluster(self, cluster):
+        """Return the cluster after a cluster in its chain, or None."""
+        if self.fatType == 12:
+            value = struct.unpack_from('<H', self._map,
+                                       self._fatOffset + cluster * 3 // 2)[0]
+            value = value >> 4 if cluster & 1 else value & 0xFFF
+            endOfChain = 0xFF8
+        elif self.fatType == 16:
+            value = struct.unpack_from('<H', self._map,
+                                       self._fatOffset + cluster * 2)[0]
+            endOfChain = 0xFFF8
+        else:
+            value = struct.unpack_from('<I', self._map,
+                                       self._fatOffset + cluster * 4)[0]
+            value &= 0x0FFFFFFF
+            endOfChain = 0x0FFFFFF8
+
+        if value < 2 or value >= min(endOfChain, self.clusterCount + 2):
+            # End of the chain, or something which shouldn't be in a
+            # chain (a free or bad cluster)
+            return None
+
+        return value
+
+    def directoryRegions(self, cluster):
+        """Return where a directory's entries are stored.
+
+        Args:
+            cluster: An integer containing the first cluster of the
+                directory, or 0 for the root directory.
+
+        Returns:
+            A list of 2-tuples of (offset, length) giving the byte
+            ranges of the directory in order.
+        """
+        if cluster == 0 and self._rootRegion:
+            return [self._rootRegion]
+        elif cluster == 0:
+            cluster = self.rootCluster
+
+        regions = []
+
+        # Stop following the chain if it loops back on itself
+        while cluster is not None and len(regions) <= self.clusterCount:
+            regions += [(self.dataOffset
+                         + (cluster - 2) * self.bytesPerCluster,
+                         self.bytesPerCluster)]
+            cluster = self.nextCluster(cluster)
+
+        return regions
+
+    def clusterRuns(self, cluster):
+        """Return the runs of consecutive clusters a chain is stored in.
+
+        Args:
+            cluster: An integer containing the first cluster of the
+                chain.
+
+        Returns:
+            A list of 2-tuples of (first cluster, number of clusters),
+            in chain order. A file stored contiguously has one run.
+        """
+        runs = []
+        visited = 0
+
+        # Stop following the chain if it loops back on itself
+        while cluster is not None and visited <= self.clusterCount:
+            if runs and cluster == runs[-1][0] + runs[-1][1]:
+                runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+            else:
+                runs += [(cluster, 1)]
+
+            visited += 1
+            cluster = self.nextCluster(cluster)
+
+        return runs
+
+    def readDirectory(self, regions):
+        """Return the entries stored in a directory's regions.
+
+        Free entries, and long name entries which don't lead up to a
+        short entry, are left out.
+
+        Args:
+            regions: A list as returned by directoryRegions.
+
+        Returns:
+            A list of 'DirectoryEntry' objects in stored order.
+        """
+        data = b''.join(self._map[offset:offset + length]
+                        for offset, length in regions)
+        entries = []
+        longNameStart = None
+
+        for start in range(0, len(data), ENTRY_SIZE):
+            firstByte = data[start]
+
+            if firstByte == END_OF_DIRECTORY:
+                break
+            elif firstByte == FREE_ENTRY:
+                longNameStart = None
+            elif data[start + 11] & 0x3F == ATTR_LONG_NAME:
+                # A new long name starts with its last part
+                if firstByte & 0x40 or longNameStart is None:
+                    longNameStart = start
+            else:
+                if longNameStart is None:
+                    longNameStart = start
+
+                end = start + ENTRY_SIZE
+                entries += [DirectoryEntry(data[longNameStart:end],
+                                           (start - longNameStart)
+                                           // ENTRY_SIZE)]
+                longNameStart = None
+
+        return entries
+
+    def writeDirectory(self, regions, entries):
+        """Store entries in a directory's regions, in the order given.
+
+        Space left over after the entries is zeroed, which marks the
+        end of the directory.
+        """
+        data = b''.join(entry.data for entry in entries)
+        position = 0
+
+        for offset, length in regions:
+            chunk = data[position:position + length]
+            self._map[offset:offset + length] = (
+                                    chunk + bytes(length - len(chunk)))
+            position += length
+
+        return
+
+    def sortDirectory(self, cluster):
+        """Sort a directory's entries in natural order.
+
+        The "." and ".." entries and the volume label stay at the start,
+        followed by everything else in the order given by sortKey. The
+        directory is only rewritten if its order changes.
+
+        Args:
+            cluster: An integer containing the first cluster of the
+                directory, or 0 for the root directory.
+
+        Returns:
+            A 2-tuple containing a boolean signalling whether the
+            directory was rewritten and a list of its entries in sorted
+            order.
+        """
+        regions = self.directoryRegions(cluster)
+        entries = self.readDirectory(regions)
+
+        fixed = [entry for entry in entries
+                 if entry.isDotEntry or entry.isVolumeLabel]
+        movable = [entry for entry in entries
+                   if not (entry.isDotEntry or entry.isVolumeLabel)]
+        movable.sort(key=lambda entry: sortKey(entry.name,
+                                               entry.isDirectory))
+        sortedEntries = fixed + movable
+
+        if ([entry.data for entry in sortedEntries]
+                == [entry.data for entry in entries]):
+            return (False, sortedEntries)
+
+        self.writeDirectory(regions, sortedEntries)
+
+        return (True, sortedEntries)
+
+
+def isExfat(path):
+    """Return whether a device or image file contains exFAT.
+
+    exFAT isn't supported by FatVolume, but is easy to mistake for a
+    filesystem that isn't FAT at all. Returns False if the path can't
+    be read.
+    """
+    try:
+        with open(path, 'rb') as device:
+            return device.read(3 + len(EXFAT_NAME))[3:] == EXFAT_NAME
+    except OSError:
+        return False
+
+
+def sortVolume(path, directories=None):
+    """Sort the directories of a FAT filesystem in natural order.
+
+    Args:
+        path: A string containing the path of an unmounted block device
+            or image file containing a FAT filesystem.
+        directories: An optional iterable of strings containing the
+            paths of the directories to sort, relative to the root of
+            the filesystem and separated by slashes, with an empty
+            string for the root. The parents of each directory are
+            sorted too, and directories which can't be found are
+            skipped. If None, every directory is sorted.
+
+    Returns:
+        A 2-tuple containing the number of directories rewritten and the
+        number of directories looked at.
+
+    Raises:
+        OSError: The filesystem couldn't be opened.
+        ValueError: The path doesn't contain a FAT filesystem.
+    """
+    with FatVolume(path) as volume:
+        if directories is None:
+            return sortTree(volume)
+
+        return sortDirectories(volume, directories)
+
+
+def sortTree(volume):
+    """Sort every directory of a volume; see sortVolume."""
+    rewritten = 0
+    visited = set()
+    stack = [0]
+
+    while stack:
+        cluster = stack.pop()
+
+        # Don't go around in circles on a corrupt filesystem
+        if cluster in visited:
+            continue
+
+        visited.add(cluster)
+
+        changed, entries = volume.sortDirectory(cluster)
+        rewritten += changed
+
+        stack.extend(entry.cluster for entry in entries
+                     if entry.isDirectory and not entry.isDotEntry
+                     and not entry.isVolumeLabel and entry.cluster >= 2)
+
+    return (rewritten, len(visited))
+
+
+def sortDirectories(volume, directories):
+    """Sort some directories of a volume and their parents.
+
+    See sortVolume. Names are matched without regard to case, like FAT
+    does.
+    """
+    rewritten = 0
+
+    # Sorted entries of each directory looked at, by first cluster
+    sortedEntries = {}
+
+    def sortOnce(cluster):
+        nonlocal rewritten
+
+        if cluster not in sortedEntries:
+            changed, sortedEntries[cluster] = volume.sortDirectory(cluster)
+            rewritten += changed
+
+        return sortedEntries[cluster]
+
+    for directory in directories:
+        # Sort the way down to the directory, starting at the root
+        cluster = 0
+        sortOnce(cluster)
+
+        for name in filter(None, directory.split('/')):
+            name = name.casefold()
+            cluster = next((entry.cluster for entry in sortOnce(cluster)
+                            if entry.isDirectory and not entry.isDotEntry
+                            and entry.name.casefold() == name), None)
+
+            if cluster is None:
+                # Nothing there any more
+                break
+
+            sortOnce(cluster)
+
+    return (rewritten, len(sortedEntries))
+
+
+def measureFragmentation(path):
+    """Count how fragmented the files of a FAT filesystem are.
+
+    Args:
+        path: A string containing the path of an unmounted block device
+            or image file containing a FAT filesystem.
+
+    Returns:
+        A 3-tuple containing the number of files with any data, the
+        number of those which are stored in more than one run of
+        consecutive clusters, and the total number of runs the files
+        are stored in.
+
+    Raises:
+        OSError: The filesystem couldn't be opened.
+        ValueError: The path doesn't contain a FAT filesystem.
+    """
+    files = fragmented = runs = 0
+
+    with FatVolume(path) as volume:
+        visited = set()
+        stack = [0]
+
+        while stack:
+            cluster = stack.pop()
+
+            # Don't go around in circles on a corrupt filesystem
+            if cluster in visited:
+                continue
+
+            visited.add(cluster)
+
+            for entry in volume.readDirectory(
+                                    volume.directoryRegions(cluster)):
+                if (entry.isDotEntry or entry.isVolumeLabel
+                        or entry.cluster < 2):
+                    continue
+                elif entry.isDirectory:
+                    stack += [entry.cluster]
+                    continue
+
+                fileRuns = len(volume.clusterRuns(entry.cluster))
+                files += 1
+                fragmented += fileRuns > 1
+                runs += fileRuns
+
+    return (files, fragmented, runs)
+
+
+def main():
+    """Sort a filesystem named on the command line, or report on it.
+
+    Run as 'python3 -m transfat.fat DEVICE [DIRECTORY ...]', sorting
+    the given directories (see sortVolume), or every directory if none
+    are given. This is how fatsort.nativeFatsort sorts a device as root
+    without the rest of transfat running as root.
+
+    Run as 'python3 -m transfat.fat --fragmentation DEVICE' to print how
+    fragmented the files on a device are instead (see
+    measureFragmentation), without changing anything.
+
+    Returns:
+        An integer exit code.
+    """
+    report = sys.argv[1:2] == ['--fragmentation']
+    arguments = sys.argv[2:] if report else sys.argv[1:]
+
+    if not arguments or (report and len(arguments) > 1):
+        print("usage: python3 -m transfat.fat DEVICE [DIRECTORY ...]\n"
+              "       python3 -m transfat.fat --fragmentation DEVICE",
+              file=sys.stderr)
+        return 2
+
+    try:
+        if report:
+            files, fragmented, runs = measureFragmentation(arguments[0])
+        else:
+            sortVolume(arguments[0], arguments[1:] or None)
+    except (OSError, ValueError) as err:
+        print(err, file=sys.stderr)
+        return 1
+
+    if report:
+        print("%d files, %d fragmented, %.2f runs of clusters per file"
+              % (files, fragmented, runs / files if files else 0))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,28 @@
 """Contains functions useful for fatsorting drives."""
 
 import os
+import re
 import subprocess
+import sys
+from . import fat
+from . import manifest
 from . import talk
 
+# Filesystem types we can transfer to
+FAT_TYPES = ('vfat', 'msdos', 'exfat')
+
+# Filesystem types only fatsort can sort, and which can't be staged
+EXFAT_TYPES = ('exfat',)
+
+# Where the kernel lists what's mounted
+MOUNT_INFO_PATH = '/proc/self/mountinfo'
+
+# How the mount table escapes awkward characters
+OCTAL_ESCAPE = re.compile(rb'\\([0-7]{3})')
+
+# Where udev links filesystems by UUID
+UUID_DIRECTORY = '/dev/disk/by-uuid'
+
 
 def findDeviceLocations(destinationPath, noninteractive=False, verbose=False,
                         quiet=False):
@@ -33,44 +52,39 @@ def findDeviceLocations(destinationPath, noninteractive=False, verbose=False,
     # Make sure destination is an absolute path
     destination = os.path.abspath(destinationPath)
 
-    # Get list of FAT devices
-    bashListCmd = "mount -t vfat | cut -f 1,3 -d ' '"
-    deviceListProcess = subprocess.Popen(["bash", "-c", bashListCmd],
-                                         stdout=subprocess.PIPE)
+    mounts = getMounts()
 
-    # Read the devices list from Popen
-    deviceString = deviceListProcess.communicate()[0].decode('ascii')
-    deviceString = deviceString.rstrip()
+    # Find what the destination is mounted on. That's the longest mount
+    # location containing it, and the last one mounted if there are a
+    # few of those, since it hides the others.
+    match = None
 
-    # Check if any FAT devices were found
-    if deviceString == '':
-        # No FAT devices found, return empty string
-        return ('', '')
+    for mount in mounts:
+        mountLoc = mount[1]
 
-    # Split deviceString so we get a separate string for each device
-    deviceList = deviceString.split('\n')
+        if (os.path.commonpath((destination, mountLoc)) == mountLoc
+                and (match is None or len(mountLoc) >= len(match[1]))):
+            match = mount
 
-    # For each device, split into device location and mount location.
-    # So in deviceListSep, deviceListSep[i][0] gives the device location
-    # and deviceListSep[i][1] gives the mount location of the ith device
-    deviceListSep = [deviceList[i].split() for i in range(len(deviceList))]
+    if match and match[2] in FAT_TYPES:
+        # Found a match! Return device and mount location
+        return (match[0], match[1])
 
-    # Test if destination path matches any mount locations
-    for i in range(len(deviceList)):
-        deviceLoc = deviceListSep[i][0]
-        mountLoc = deviceListSep[i][1]
+    # Get list of FAT devices
+    deviceList = [mount for mount in mounts if mount[2] in FAT_TYPES]
 
-        if os.path.commonpath((destination, mountLoc)) == mountLoc:
-            # Found a match! Return device and mount location
-            return (deviceLoc, mountLoc)
+    # Check if any FAT devices were found
+    if not deviceList:
+        # No FAT devices found, return empty string
+        return ('', '')
 
     # Something went wrong with the automation: if not set to
     # non-interactive mode, ask user if any of the FAT devices found
-    # earlier match the intended destination; otherwise, just return
-    # empty strings
+    # match the intended destination; otherwise, just return empty
+    # strings
     if not noninteractive:
         # Enumerate each device
-        deviceListEnum = ["[%d] %s" % (i, deviceList[i-1])
+        deviceListEnum = ["[%d] %s %s" % (i, *deviceList[i-1][:2])
                           for i in range(1, len(deviceList)+1)]
 
         # Add option to abort
@@ -95,12 +109,145 @@ def findDeviceLocations(destinationPath, noninteractive=False, verbose=False,
             return ('', '')
 
         # Return requested device and mount location strings
-        return (deviceListSep[ans-1][0], deviceListSep[ans-1][1])
+        return (deviceList[ans-1][0], deviceList[ans-1][1])
 
     # Non-interactive mode is on, just return empty strings
     return ('', '')
 
 
+def getMounts(mountInfoPath=MOUNT_INFO_PATH):
+    """Return every mounted filesystem, in the order they were mounted.
+
+    Reads the kernel's mount table directly, rather than running mount.
+    Mount locations and devices can contain any character; the kernel
+    escapes spaces, tabs, newlines, and backslashes in octal, which is
+    undone here.
+
+    Args:
+        mountInfoPath: An optional string containing the path of the
+            mount table, in the format of /proc/self/mountinfo.
+
+    Returns:
+        A list of 3-tuples of ("device", "mountLocation", "type")
+        strings; or, if the mount table can't be read, an empty list.
+    """
+    try:
+        with open(mountInfoPath, 'rb') as mountInfo:
+            lines = mountInfo.read().splitlines()
+    except OSError:
+        return []
+
+    mounts = []
+
+    for line in lines:
+        fields = line.split(b' ')
+
+        try:
+            # Optional fields come between the mount options and a
+            # single hyphen, followed by the type and device
+            separator = fields.index(b'-', 6)
+            mountLoc = fields[4]
+            fsType, device = fields[separator+1:separator+3]
+        except ValueError:
+            continue
+
+        mounts.append((unescapeMountField(device),
+                       unescapeMountField(mountLoc),
+                       unescapeMountField(fsType)))
+
+    return mounts
+
+
+def unescapeMountField(field):
+    """Return a string from a field of the mount table, unescaped."""
+    field = OCTAL_ESCAPE.sub(lambda match: bytes((int(match.group(1), 8),)),
+                             field)
+    return os.fsdecode(field)
+
+
+def getDeviceSize(deviceLocation):
+    """Return the size of a device or file in bytes.
+
+    Block devices' sizes are read from sysfs, which doesn't need
+    permission to open the device. Anything else is opened and seeked
+    to the end. Raises an OSError if neither works.
+    """
+    name = os.path.basename(os.path.realpath(deviceLocation))
+
+    try:
+        with open('/sys/class/block/%s/size' % name) as sizeFile:
+            # Always in 512 byte sectors, whatever the device's are
+            return int(sizeFile.read()) * 512
+    except (OSError, ValueError):
+        pass
+
+    fd = os.open(deviceLocation, os.O_RDONLY)
+
+    try:
+        # Block devices report a size of zero to stat
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def getFilesystemUuid(deviceLocation):
+    """Return the UUID of the filesystem on a device, or None.
+
+    The UUID is looked up in /dev/disk/by-uuid, which doesn't need
+    permission to open the device. Failing that, FAT filesystems' UUIDs
+    are worked out from their volume IDs, as blkid does.
+    """
+    devicePath = os.path.realpath(deviceLocation)
+
+    try:
+        with os.scandir(UUID_DIRECTORY) as iterator:
+            for entry in iterator:
+                if os.path.realpath(entry.path) == devicePath:
+                    return entry.name
+    except OSError:
+        pass
+
+    try:
+        with fat.FatVolume(deviceLocation) as volume:
+            volumeId = volume.volumeId
+    except (OSError, ValueError):
+        return None
+
+    if volumeId is None:
+        return None
+
+    return '%04X-%04X' % (volumeId >> 16, volumeId & 0xFFFF)
+
+
+def getFilesystemType(mountLocation, mountInfoPath=MOUNT_INFO_PATH):
+    """Return the type of the filesystem mounted at a location.
+
+    Returns:
+        A string containing the type, as given in the mount table; or,
+        if nothing is mounted there, an empty string.
+    """
+    mountLocation = os.path.realpath(mountLocation)
+    fsType = ''
+
+    # The last filesystem mounted there hides any others
+    for mount in getMounts(mountInfoPath):
+        if os.path.realpath(mount[1]) == mountLocation:
+            fsType = mount[2]
+
+    return fsType
+
+
+def getSpace(mountLocation):
+    """Return the size and free space of a mounted filesystem.
+
+    Returns:
+        A 2-tuple of integers containing the total number of bytes the
+        filesystem can hold and the number of bytes free on it.
+    """
+    stats = os.statvfs(mountLocation)
+    return (stats.f_blocks * stats.f_frsize, stats.f_bavail * stats.f_frsize)
+
+
 def unmount(deviceLocation, verbose=False):
     """Unmount a device and return whether it was successful."""
     noiseLevel = []
@@ -112,12 +259,162 @@ def unmount(deviceLocation, verbose=False):
     return bool(not exitCode)
 
 
-def fatsort(deviceLocation, quiet=False):
-    """fatsort a device and return whether it was successful."""
+def getTouchedDirectories(mountLocation, files, directories=()):
+    """Return the directories that need sorting after a transfer.
+
+    Args:
+        mountLocation: A string containing the device's mount location.
+        files: An iterable of strings containing the absolute paths of
+            files written to the device.
+        directories: An optional iterable of strings containing the
+            absolute paths of directories created on the device.
+
+    Returns:
+        A set of strings containing the paths, relative to the mount
+        location, of the directories created, the directories
+        containing the files and directories, and all of their parents,
+        with an empty string for the mount location. Paths outside of
+        the mount location are ignored.
+    """
+    touched = set()
+    parents = [os.path.dirname(path) for path in files]
+    parents += [os.path.dirname(path) for path in directories]
+
+    for directory in parents + list(directories):
+        directory = os.path.relpath(directory, mountLocation)
+
+        if directory == os.curdir:
+            directory = ''
+        elif directory.split(os.sep, 1)[0] == os.pardir:
+            continue
+
+        # Add the directory and its parents, stopping once we get to
+        # one we already have
+        while directory not in touched:
+            touched.add(directory)
+
+            if not directory:
+                break
+
+            directory = os.path.dirname(directory)
+
+    return touched
+
+
+def fatsort(deviceLocation, quiet=False, directories=None):
+    """fatsort a device and return whether it was successful.
+
+    Args:
+        deviceLocation: A string containing the device location.
+        quiet: An optional boolean toggling whether fatsort should be
+            quiet.
+        directories: An optional iterable of strings containing the
+            paths of the only directories to sort, relative to the root
+            of the device (see getTouchedDirectories). If None, every
+            directory is sorted.
+    """
     noiseLevel = []
     if quiet:
         noiseLevel += ['-q']
 
+    # Tell fatsort which directories to sort, if we know
+    directoryOptions = []
+
+    if directories is not None:
+        for directory in sorted(directories):
+            directoryOptions += ['-d', '/' + directory]
+
+        if not directoryOptions:
+            # Nothing to sort
+            return True
+
     exitCode = subprocess.Popen(['sudo', 'fatsort', deviceLocation]
-                                + noiseLevel).wait()
+                                + noiseLevel + directoryOptions).wait()
     return bool(not exitCode)
+
+
+def nativeFatsort(deviceLocation, verbose=False, directories=None):
+    """Sort a device in-process and return whether it was successful.
+
+    Sorts the device's directories in natural order, like fatsort does,
+    without needing fatsort installed. See fat.sortVolume. The device
+    must be unmounted first. If we aren't running as root, the sorting
+    is done by a separate process run with sudo. exFAT devices can't be
+    sorted this way; fatsort can sort those.
+
+    Args:
+        deviceLocation: A string containing the device location.
+        verbose: An optional boolean toggling whether to give extra
+            output.
+        directories: An optional iterable of directories as for
+            fatsort.
+    """
+    if directories is not None:
+        directories = sorted(directories)
+
+        if not directories:
+            # Nothing to sort
+            return True
+
+    if os.geteuid():
+        exitCode = subprocess.Popen(['sudo', sys.executable, '-m',
+                                     'transfat.fat', deviceLocation]
+                                    + (directories or [])).wait()
+        return bool(not exitCode)
+
+    try:
+        rewritten, total = fat.sortVolume(deviceLocation, directories)
+    except (OSError, ValueError):
+        return False
+
+    talk.status("%d of %d directories needed sorting" % (rewritten, total),
+                verbose)
+
+    return True
+
+
+def findUnsortedDirectories(mountLocation, directories=None):
+    """Return which directories on a mounted device are out of order.
+
+    Reads each directory's entries in the order the filesystem stores
+    them, which os.scandir gives for FAT, and compares that with the
+    order the sorters put them in (see fat.sortKey). The device manifest
+    is ignored, since where it ends up doesn't matter.
+
+    Args:
+        mountLocation: A string containing the device's mount location.
+        directories: An optional iterable of strings containing the
+            paths of the directories to check relative to the mount
+            location, as returned by getTouchedDirectories. If None,
+            every directory on the device is checked.
+
+    Returns:
+        A set of strings containing the paths, relative to the mount
+        location, of the directories which are out of order or couldn't
+        be read.
+    """
+    if directories is None:
+        directories = [os.path.relpath(root, mountLocation)
+                       for root, _, _ in os.walk(mountLocation)]
+        directories = ['' if directory == os.curdir else directory
+                       for directory in directories]
+
+    ignored = (manifest.MANIFEST_NAME, manifest.MANIFEST_NAME + '.part')
+    unsorted = set()
+
+    for directory in directories:
+        try:
+            with os.scandir(os.path.join(mountLocation,
+                                         directory)) as iterator:
+                keys = [fat.sortKey(entry.name,
+                                    entry.is_dir(follow_symlinks=False))
+                        for entry in iterator
+                        if entry.name not in ignored]
+        except OSError:
+            unsorted.add(directory)
+            continue
+
+        if any(key > nextKey for key, nextKey in zip(keys, keys[1:])):
+            unsorted.add(directory)
+
+    return unsorted
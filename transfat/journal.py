@@ -0,0 +1,376 @@
+"""Contains a journal of a transfer, for resuming it if it's interrupted.
+
+The journal is a file of JSON records, one per line, which are only
+ever appended to. The first records the sources and destination of the
+transfer. After that, a file is recorded as planned when work on it
+starts, converted once FFmpeg has finished with it, copied once it's
+on the device, and verified once the copy's size has been checked. A
+transfer which finishes removes its journal.
+
+If a journal is left behind, the next run cleans up whatever the
+interrupted transfer left half done. If it's transferring the same
+sources to the same destination, it also skips the files which were
+verified and copies the files which were converted without converting
+them again.
+
+Records are written straight to the file, so they survive the program
+being killed, and are flushed to disk every so often, so at most a few
+files need to be redone after a crash. A record cut off by a crash is
+ignored.
+"""
+
+import json
+import os
+import threading
+import time
+from . import cache
+from . import plan
+
+# Kinds of record
+START = 'start'
+PLANNED = 'planned'
+CONVERTED = 'converted'
+COPIED = 'copied'
+VERIFIED = 'verified'
+
+# Number of records to write between flushes to disk
+SYNC_INTERVAL = 32
+
+# Seconds that modification times on the device can be behind by. FAT
+# only keeps them to the nearest two seconds.
+TIME_RESOLUTION = 2
+
+
+def getJournalPath():
+    """Return a string containing the path of the journal file."""
+    return cache.getCacheDirectoryPath() + "/journal"
+
+
+class Journal:
+    """The journal of a transfer, and of the one it's resuming, if any.
+
+    Attributes:
+        path: A string containing the path of the journal file.
+        interrupted: A boolean signalling that a journal was left
+            behind by an interrupted transfer.
+        resuming: A boolean signalling that the interrupted transfer
+            was of the same sources to the same destination, so this
+            transfer picks up where it left off.
+        startTime: A float containing the time the transfer started, or
+            the time the transfer being resumed started.
+        previous: A dictionary mapping each source file in the journal
+            left behind to a dictionary of what was recorded about it.
+            The 'events' key of this holds a set of the kinds of record
+            written for the file.
+    """
+
+    def __init__(self, path, sources, destination):
+        """Read the journal left behind by an interrupted transfer.
+
+        Nothing is written until open is called.
+
+        Args:
+            path: A string containing the path of the journal file.
+            sources: A list of strings containing the paths of the
+                sources being transferred.
+            destination: A string containing the path of the
+                destination.
+        """
+        self.path = path
+        self.interrupted = False
+        self.resuming = False
+        self.startTime = time.time()
+        self.previous = {}
+
+        self._run = {'sources': [os.path.abspath(source)
+                                 for source in sources],
+                     'destination': os.path.abspath(destination)}
+        self._fd = None
+        self._unsynced = 0
+        self._cutOff = False
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, 'rb') as journalFile:
+                contents = journalFile.read()
+        except OSError:
+            return
+
+        lines = contents.splitlines()
+        self._cutOff = not contents.endswith(b'\n')
+
+        records = []
+
+        for line in lines:
+            try:
+                records += [json.loads(line)]
+            except ValueError:
+                # Cut off by a crash
+                continue
+
+        if not records or records[0].get('event') != START:
+            return
+
+        self.interrupted = True
+
+        header = records[0]
+
+        if (header.get('sources') == self._run['sources']
+                and header.get('destination') == self._run['destination']):
+            self.resuming = True
+            self.startTime = header.get('time', self.startTime)
+
+        for record in records[1:]:
+            try:
+                details = self.previous.setdefault(record['source'],
+                                                   {'events': set()})
+                details['events'].add(record['event'])
+            except (KeyError, TypeError):
+                continue
+
+            details.update((key, value) for key, value in record.items()
+                           if key not in ('event', 'source'))
+
+        return
+
+    def open(self):
+        """Start writing to the journal, and return whether that worked.
+
+        A transfer being resumed adds to the old journal; otherwise the
+        old journal is replaced. Call cleanUp first.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            if self.resuming:
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+                # Don't add on to the end of a record cut off by a crash
+                if self._cutOff:
+                    os.write(self._fd, b'\n')
+            else:
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT
+                                   | os.O_TRUNC | os.O_APPEND, 0o644)
+                self._write(dict(self._run, event=START,
+                                 time=self.startTime))
+        except OSError:
+            return False
+
+        return True
+
+    def close(self, finished=False):
+        """Flush and close the journal, removing it if we're finished."""
+        if self._fd is not None:
+            try:
+                os.fsync(self._fd)
+            except OSError:
+                pass
+
+            os.close(self._fd)
+            self._fd = None
+
+        if finished:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+        return
+
+    def _write(self, record):
+        """Append a record to the journal."""
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+
+        with self._lock:
+            os.write(self._fd, line.encode('utf-8', 'surrogateescape'))
+            self._unsynced += 1
+
+            if self._unsynced >= SYNC_INTERVAL:
+                os.fsync(self._fd)
+                self._unsynced = 0
+
+        return
+
+    def record(self, event, source, **details):
+        """Record something about a source file.
+
+        Safe to call from several threads at once. Errors writing the
+        journal are ignored, since they only stop us resuming.
+
+        Args:
+            event: PLANNED, CONVERTED, COPIED, or VERIFIED.
+            source: A string containing the path of the source file.
+            details: Anything else to record, which needs to be
+                JSON-serializable. Planned conversions record the
+                'output' path being converted to, whether that's a
+                'temporary' file to remove once copied, and the
+                'partial' path FFmpeg writes to until it's done; planned
+                copies record the 'destination', the 'expected' size,
+                and the time they were 'started' (see planCopy); and
+                verified files record their 'destination' and 'size'.
+        """
+        if self._fd is None:
+            return
+
+        try:
+            self._write(dict(details, event=event, source=source))
+        except OSError:
+            pass
+
+        return
+
+    def planCopy(self, source, copiedFile, destination):
+        """Record a copy as planned, just before it starts.
+
+        Args:
+            source: A string containing the path of the source file.
+            copiedFile: A string containing the path of the file to be
+                copied, which is the converted file for converted files.
+            destination: A string containing the path to copy it to.
+        """
+        try:
+            size = os.path.getsize(copiedFile)
+        except OSError:
+            size = None
+
+        self.record(PLANNED, source, destination=destination, expected=size,
+                    started=time.time())
+
+        return
+
+    def verify(self, source, copiedFile, destination):
+        """Record a file as copied, and as verified if its size is right.
+
+        Args:
+            source: A string containing the path of the source file.
+            copiedFile: A string containing the path of the file that
+                was copied, which is the converted file for converted
+                files.
+            destination: A string containing the path it was copied to.
+        """
+        self.record(COPIED, source)
+
+        try:
+            size = os.path.getsize(destination)
+            verified = size == os.path.getsize(copiedFile)
+        except OSError:
+            verified = False
+
+        if verified:
+            self.record(VERIFIED, source, destination=destination, size=size)
+
+        return
+
+    def isFinished(self, source, target):
+        """Return whether the transfer being resumed finished a file.
+
+        Args:
+            source: A string containing the path of the source file.
+            target: A string containing the path of the file that ends
+                up on the device (see transfer.getPlannedWrite).
+
+        Returns:
+            A boolean signalling that the file was verified at the
+            target, and is still there at the size it was verified at.
+        """
+        details = self.previous.get(source)
+
+        if (not self.resuming or details is None
+                or VERIFIED not in details['events']
+                or details.get('destination') != target):
+            return False
+
+        try:
+            return os.path.getsize(target) == details.get('size')
+        except OSError:
+            return False
+
+    def convertedFile(self, source, output):
+        """Return whether a temporary converted file can be reused.
+
+        Args:
+            source: A string containing the path of the source file.
+            output: A string containing the path the file would be
+                converted to.
+
+        Returns:
+            A boolean signalling that the transfer being resumed
+            finished converting the file to the same temporary file,
+            which is still there.
+        """
+        details = self.previous.get(source)
+
+        return (self.resuming and details is not None
+                and CONVERTED in details['events']
+                and details.get('temporary')
+                and details.get('output') == output
+                and os.path.isfile(output))
+
+    def markFinished(self, transferPlan):
+        """Mark the pending files the resumed transfer finished as done.
+
+        Their planned writes must have been worked out. Returns the
+        number of files marked.
+        """
+        finished = 0
+
+        for item in transferPlan.files():
+            if self.isFinished(item.source, item.target):
+                item.status = plan.DONE
+                finished += 1
+
+        return finished
+
+    def cleanUp(self):
+        """Remove what the interrupted transfer left half done.
+
+        Partly converted files are removed, and so are temporary
+        converted files, unless they can be used to resume. If resuming,
+        files the interrupted transfer was in the middle of copying are
+        removed if they were changed after their copy started and
+        aren't the size they were being copied at, since they're only
+        partly there. Anything else at their destinations may have been
+        put there since, and is left alone.
+
+        Returns:
+            An integer counting the files removed.
+        """
+        removed = []
+
+        for details in self.previous.values():
+            events = details['events']
+            finished = VERIFIED in events
+
+            if CONVERTED not in events:
+                removed += [details.get('partial')]
+            elif details.get('temporary') and (finished
+                                               or not self.resuming):
+                removed += [details.get('output')]
+
+            destination = details.get('destination')
+
+            if destination and not finished and self.resuming:
+                try:
+                    status = os.stat(destination)
+                except OSError:
+                    continue
+
+                started = details.get('started', self.startTime)
+
+                if (status.st_mtime >= started - TIME_RESOLUTION
+                        and status.st_size != details.get('expected')):
+                    removed += [destination]
+
+        count = 0
+
+        for path in removed:
+            if not path:
+                continue
+
+            try:
+                os.remove(path)
+                count += 1
+            except OSError:
+                pass
+
+        return count
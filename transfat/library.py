@@ -0,0 +1,192 @@
+"""Contains a persistent index of source library directories.
+
+Walking a large source library, especially over a network filesystem,
+can take minutes. The index remembers what each directory contained
+along with the directory's modification time. A directory's contents
+are only read again when its modification time changes, which happens
+whenever something is added to, removed from, or renamed within it.
+"""
+
+import json
+import os
+import threading
+from . import cache
+
+# Version of the index file format
+INDEX_VERSION = 1
+
+
+def getIndexPath():
+    """Return a string containing the path of the library index file."""
+    return cache.getCacheDirectoryPath() + "/library.json"
+
+
+class LibraryIndex:
+    """An index of directories and the files in them.
+
+    Each directory entry maps to a dictionary containing the directory's
+    modification time in nanoseconds ('mtime'), a list of the names of
+    its subdirectories ('dirs'), and a dictionary mapping the names of
+    its files to lists of [size, mtime, inode, hash]. The hash is the
+    file's content fingerprint, computed only when asked for, and is
+    None until then.
+
+    Note that changing a file in place doesn't change its directory's
+    modification time, so the sizes and modification times stored for
+    the files of an unchanged directory may be out of date. Nothing
+    relies on them being current; fingerprint checks a file's current
+    state before trusting a stored hash.
+
+    Attributes:
+        path: A string containing the path of the index file.
+        directories: A dictionary mapping absolute directory paths to
+            entries as described above.
+        rescanned: An integer counting directories read during walks.
+        reused: An integer counting directories taken from the index
+            during walks.
+    """
+
+    def __init__(self, path):
+        """Load an index file, starting afresh if it can't be read."""
+        self.path = path
+        self.directories = {}
+        self.rescanned = 0
+        self.reused = 0
+        self._changed = False
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, 'r') as indexFile:
+                contents = json.load(indexFile)
+        except (OSError, ValueError):
+            return
+
+        if (isinstance(contents, dict)
+                and contents.get('version') == INDEX_VERSION):
+            self.directories = contents['directories']
+
+    def save(self):
+        """Write the index if it's changed; return whether that worked."""
+        if not self._changed:
+            return True
+
+        temporaryPath = self.path + '.part'
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            with self._lock, open(temporaryPath, 'w') as indexFile:
+                json.dump({'version': INDEX_VERSION,
+                           'directories': self.directories},
+                          indexFile, separators=(',', ':'))
+
+            os.replace(temporaryPath, self.path)
+        except OSError:
+            return False
+
+        self._changed = False
+
+        return True
+
+    def walk(self, top):
+        """Walk a directory tree top down, like os.walk.
+
+        Yields 3-tuples of ("dirpath", dirnames, filenames) like
+        os.walk, reading directories whose modification time has
+        changed and taking everything else from the index. Symbolic
+        links to directories aren't followed.
+        """
+        stack = [top]
+
+        while stack:
+            dirpath = stack.pop()
+
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                continue
+
+            entry = self.directories.get(dirpath)
+
+            if entry is None or entry['mtime'] != mtime:
+                try:
+                    entry = self.scanDirectory(dirpath, mtime, entry)
+                except OSError:
+                    continue
+
+                self.rescanned += 1
+            else:
+                self.reused += 1
+
+            yield (dirpath, entry['dirs'], list(entry['files']))
+
+            # Go through subdirectories in order, as os.walk would
+            stack.extend(os.path.join(dirpath, name)
+                         for name in reversed(entry['dirs']))
+
+        return
+
+    def scanDirectory(self, dirpath, mtime, oldEntry=None):
+        """Read a directory into the index and return its entry.
+
+        Hashes are kept from the old entry for files which don't seem
+        to have changed.
+        """
+        if oldEntry is None:
+            oldFiles = {}
+        else:
+            oldFiles = oldEntry['files']
+
+        dirs = []
+        files = {}
+
+        with os.scandir(dirpath) as iterator:
+            for dirEntry in iterator:
+                if dirEntry.is_dir(follow_symlinks=False):
+                    dirs += [dirEntry.name]
+                elif dirEntry.is_file():
+                    info = dirEntry.stat()
+                    state = [info.st_size, info.st_mtime_ns, info.st_ino]
+                    oldState = oldFiles.get(dirEntry.name)
+
+                    if oldState is not None and oldState[:3] == state:
+                        files[dirEntry.name] = oldState
+                    else:
+                        files[dirEntry.name] = state + [None]
+
+        entry = {'mtime': mtime, 'dirs': sorted(dirs), 'files': files}
+
+        with self._lock:
+            self.directories[dirpath] = entry
+            self._changed = True
+
+        return entry
+
+    def fingerprint(self, path):
+        """Return a file's content fingerprint, reusing a stored one.
+
+        The stored fingerprint is only used if the file's size,
+        modification time, and inode still match the index; otherwise
+        it's computed (see cache.fileFingerprint) and stored. Safe to
+        call from several threads at once.
+        """
+        info = os.stat(path)
+        state = [info.st_size, info.st_mtime_ns, info.st_ino]
+        dirpath, name = os.path.split(path)
+        entry = self.directories.get(dirpath)
+
+        if entry is not None:
+            fileState = entry['files'].get(name)
+
+            if (fileState is not None and fileState[:3] == state
+                    and fileState[3] is not None):
+                return fileState[3]
+
+        hash_ = cache.fileFingerprint(path)
+
+        if entry is not None and name in entry['files']:
+            with self._lock:
+                entry['files'][name] = state + [hash_]
+                self._changed = True
+
+        return hash_
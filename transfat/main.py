@@ -13,11 +13,29 @@ or do
 to see how to be fancier. Or read the README.md.
 """
 
+import os
+import time
+from transfat import cache
+from transfat import decisions
 from transfat import fatsort
+from transfat import journal
+from transfat import library
+from transfat import manifest
+from transfat import pipeline
+from transfat import plan
+from transfat import probe
 from transfat import rename
+from transfat import space
+from transfat import stage
 from transfat import system
 from transfat import talk
 from transfat import transfer
+from transfat import verify
+from transfat import writes
+from transfat.config.constants import NO, YES, PROMPT
+
+# Default size limit of the transcode cache in MiB
+DEFAULT_CACHE_SIZE = 10240
 
 
 def main():
@@ -25,17 +43,6 @@ def main():
     # Get runtime arguments
     args = system.getRuntimeArguments()
 
-    # Confirm that dependencies are installed
-    talk.status("Checking if dependencies are installed", args.verbose)
-
-    if system.dependenciesAvailable(args.no_sort, args.quiet, args.verbose):
-        # Depencies available
-        talk.success("Dependencies are installed", args.verbose)
-    else:
-        # Dependencies unavailable. dependenciesAvailable will spit out
-        # any necessary error dialogue.
-        system.abort(1)
-
     # Read the configuration file
     talk.status("Reading config file '%s'" % args.config_file, args.verbose)
 
@@ -50,9 +57,35 @@ def main():
         # Success
         talk.success("'%s' read" % args.config_file, args.verbose)
 
+    # Determine whether to sort the device ourselves, in which case
+    # fatsort isn't needed
+    nativeSort = cfgSettings.getint('UseNativeSorter', fallback=NO)
+
+    # Determine whether to write to the device in sorted order, in
+    # which case it usually doesn't need sorting afterwards
+    orderedWrites = cfgSettings.getint('OrderedWrites', fallback=NO)
+
+    # Determine whether to stage the transfer in an image of the device
+    staging = args.stage or args.refresh
+
+    # Confirm that dependencies are installed
+    talk.status("Checking if dependencies are installed", args.verbose)
+
+    if system.dependenciesAvailable(args.no_sort or nativeSort, args.quiet,
+                                    args.verbose):
+        # Depencies available
+        talk.success("Dependencies are installed", args.verbose)
+    else:
+        # Dependencies unavailable. dependenciesAvailable will spit out
+        # any necessary error dialogue.
+        system.abort(1)
+
     # Get root access if we don't have it already, and restart with it
-    # if we don't. No need to do this if we're not fatsorting.
-    if not args.no_sort:
+    # if we don't. No need to do this if we're not fatsorting, or if
+    # we're writing in order, in which case root is only asked for if
+    # it turns out sorting is needed. Staging always needs it, to mount
+    # the image and write to the device.
+    if staging or (not args.no_sort and not orderedWrites):
         talk.status("Checking root access", args.verbose)
 
         rootAccess = system.requestRootAccess(cfgSettings,
@@ -91,52 +124,522 @@ def main():
                   "\ndevice: %s\nmount: %s" % (devLoc, mntLoc),
                   end='\n\n')
 
-    # Transfer files
-    if args.sources:
-        # Get source and destination paths
-        talk.status("Getting lists of source and destination paths",
-                    args.verbose)
+    # exFAT devices can't be staged or sorted natively, since neither
+    # mkfs.vfat nor our sorter handle exFAT. fatsort can sort them.
+    if fatsort.getFilesystemType(mntLoc) in fatsort.EXFAT_TYPES:
+        if staging:
+            talk.error("%s is exFAT, which can't be staged!" % devLoc,
+                       args.quiet)
+            system.abort(1)
+
+        if nativeSort and not args.no_sort:
+            nativeSort = NO
+
+            if system.dependenciesAvailable(False, True, args.verbose):
+                talk.status("%s is exFAT; sorting it with fatsort" % devLoc,
+                            args.verbose)
+            else:
+                talk.error("%s is exFAT, which only fatsort can sort, and"
+                           " fatsort isn't installed; not sorting" % devLoc,
+                           args.quiet)
+                args.no_sort = True
+
+    # Transfer to an image of the device instead of the device itself if
+    # we're staging
+    imagePath = ''
+
+    if staging:
+        if (not args.refresh and not args.non_interactive
+                and not talk.prompt("Replace everything on %s?" % devLoc)):
+            system.abort(1)
 
-        _, fromFiles, toDirs, toFiles = (
-            transfer.getCorrespondingPathsLists(args.sources, args.destination,
-                                                args.verbose, args.quiet))
+        talk.status("Staging %s in an image file" % devLoc, args.verbose)
+
+        imagePath = stage.createImage(devLoc, args.refresh)
+
+        if not imagePath:
+            talk.error("Failed to create an image of %s!" % devLoc,
+                       args.quiet)
+            system.abort(1)
+
+        imageMount = stage.mountImage(imagePath)
+
+        if not imageMount:
+            talk.error("Failed to mount %s!" % imagePath, args.quiet)
+            stage.removeImage(imagePath)
+            system.abort(1)
 
-        talk.success("Source and destination locations found", args.verbose)
+        # Everything from here on happens on the image
+        args.destination = os.path.normpath(
+                os.path.join(imageMount,
+                             os.path.relpath(os.path.abspath(args.destination),
+                                             mntLoc)))
+        deviceMount, mntLoc = mntLoc, imageMount
 
-        # Filter out certain file types based on settings in config file
-        talk.status("Filtering out unwanted file types", args.verbose)
+        talk.success("%s staged at %s" % (devLoc, imagePath), args.verbose)
 
-        transfer.filterOutExtensions(fromFiles, toFiles, cfgSettings,
-                                     args.non_interactive)
+    # Clean up after any interrupted transfer, and keep a journal of
+    # this one so it can be resumed if it's interrupted too
+    transferJournal = None
 
-        talk.success("Filtering complete", args.verbose)
+    if args.sources and cfgSettings.getint('ResumeTransfers', fallback=NO):
+        transferJournal = journal.Journal(journal.getJournalPath(),
+                                          args.sources, args.destination)
 
-        # Perform necessary audio file conversions
-        talk.status("Starting to convert any audio files that need it",
+        if transferJournal.interrupted:
+            talk.status("Cleaning up after an interrupted transfer",
+                        args.verbose)
+
+            removed = transferJournal.cleanUp()
+
+            talk.success("%d leftover files removed" % removed, args.verbose)
+
+            if transferJournal.resuming:
+                talk.status("Resuming interrupted transfer", not args.quiet)
+
+        if not transferJournal.open():
+            talk.error("Failed to open transfer journal!", args.quiet)
+            transferJournal = None
+
+    # Load the device manifest, which keeps track of what's on the
+    # device. If we need it and it might not match the device, rebuild it
+    # from a scan of the device.
+    deviceManifest, manifestClean = manifest.loadManifest(mntLoc)
+
+    if args.rebuild_manifest or (args.update and not manifestClean):
+        talk.status("Scanning %s to rebuild device manifest" % mntLoc,
                     args.verbose)
 
-        # Returns a list of temporary files to remove later
-        tmpFiles = transfer.convertAudioFiles(fromFiles, toFiles, cfgSettings,
-                                              args.non_interactive,
-                                              args.verbose, args.quiet)
+        deviceManifest = manifest.scanDevice(mntLoc, deviceManifest)
+        manifestClean = True
 
-        talk.success("Conversions finished", args.verbose)
+        talk.success("Device manifest rebuilt", args.verbose)
 
-        # Create necessary directories to transfer to
-        talk.status("Creating destination directories", args.verbose)
+    # Directories to sort, relative to the mount location, or None to
+    # sort the whole device
+    sortDirectories = None
 
-        transfer.createDirectories(toDirs, args.non_interactive, args.verbose,
-                                   args.quiet)
+    # Transfer files
+    if args.sources:
+        # Let the user know how much space there is to start with
+        freeBefore = fatsort.getSpace(mntLoc)[1]
 
-        talk.success("Destination directories created", args.verbose)
+        talk.status("%.1f MiB free on %s" % (freeBefore / 1024**2, mntLoc),
+                    not args.quiet)
 
-        # Copy source files to destination
-        talk.status("Copying files", args.verbose)
+        # Use the library index to avoid rewalking unchanged source
+        # directories if we're asked to
+        if cfgSettings.getint('UseLibraryIndex', fallback=NO):
+            libraryIndex = library.LibraryIndex(library.getIndexPath())
+            walk = libraryIndex.walk
+        else:
+            libraryIndex = None
+            walk = os.walk
+
+        # Open the transcode cache if we're using one
+        if cfgSettings.getint('UseTranscodeCache', fallback=NO):
+            cacheLimit = cfgSettings.getint('TranscodeCacheSize',
+                                            fallback=DEFAULT_CACHE_SIZE)
+            transcodeCache = cache.TranscodeCache(
+                                cache.getCacheDirectoryPath() + '/transcodes',
+                                cacheLimit * 1024**2)
+
+            # Remember source fingerprints in the library index
+            if libraryIndex:
+                transcodeCache.fingerprint = libraryIndex.fingerprint
+        else:
+            transcodeCache = None
 
-        transfer.copyFiles(fromFiles, toFiles, cfgSettings, args.non_interactive,
-                           args.verbose, args.quiet)
+        # Look inside files to convert, so that ones the stereo can
+        # already play are only remuxed, if we're asked to
+        if cfgSettings.getint('ProbeCodecs', fallback=NO):
+            probeCache = probe.ProbeCache(probe.getProbeCachePath())
+        else:
+            probeCache = None
+
+        # Tune how many files are written to the device at once, and
+        # with what buffer size, if we're asked to. This needs the
+        # in-process copier, and isn't worth it when staging, since the
+        # image is written to the device in one pass anyway.
+        copyBufferSize = transfer.getCopyBufferSize(cfgSettings)
+
+        if (cfgSettings.getint('AdaptiveWrites', fallback=NO)
+                and copyBufferSize and not staging):
+            writeController = writes.WriteController(
+                                        writes.getDevicesPath(),
+                                        fatsort.getFilesystemUuid(devLoc),
+                                        copyBufferSize)
+        else:
+            writeController = None
 
-        talk.success("Files copied", args.verbose)
+        # Checksum files as they're copied, so that they can be read
+        # back from the device and checked, if we're asked to. Only the
+        # in-process copier sees what it copies.
+        if args.verify and copyBufferSize:
+            checksums = verify.Checksums()
+        else:
+            checksums = None
+
+            if args.verify:
+                talk.error("Can't verify files copied with cp; set"
+                           " NativeCopyBufferSize to verify", args.quiet)
+
+        # Determine whether to have FFmpeg write straight to the
+        # destination
+        encodeToDestination = cfgSettings.getint('EncodeToDestination',
+                                                 fallback=NO)
+
+        # FFmpeg would create files as it finishes them, which is out of
+        # order, so converted files need to be copied in order instead
+        if orderedWrites:
+            encodeToDestination = NO
+
+        # Files FFmpeg writes to the destination aren't copied, so they
+        # can't be checksummed as they're copied
+        if checksums:
+            encodeToDestination = NO
+
+        # Seconds spent copying files, if it can be told apart from time
+        # spent converting them
+        copyTime = None
+
+        # Destination files which failed verification
+        unverifiedFiles = []
+
+        # Answers to the questions asked before transferring, if they
+        # were asked up front
+        transferDecisions = None
+
+        # Work out what will end up on the device, so the manifest can
+        # keep track of it
+        startTime = time.time()
+        encoderSettings = manifest.getEncoderSettings(
+                                    transfer.getFFmpegOptions()[1],
+                                    cache.ffmpegVersion())
+
+        if args.pipeline:
+            # Walk, filter, convert, and copy at the same time, without
+            # building lists of every path first unless there are
+            # questions to ask or the space needs checking
+            paths = transfer.iterCorrespondingPaths(args.sources,
+                                                    args.destination,
+                                                    args.verbose, args.quiet,
+                                                    walk, orderedWrites)
+            pipelineManifest = deviceManifest if args.update else None
+            conversionAnswers = None
+
+            # Questions asked once the pipeline has started would hold
+            # up the conversions and copies until they're answered, and
+            # the space check needs every file. So if either could
+            # happen, walk the sources first, which is quick next to
+            # converting them, and ask and check everything up front.
+            checkSpace = cfgSettings.getint('CheckFreeSpace', fallback=NO)
+
+            if not args.non_interactive or checkSpace:
+                talk.status("Getting source and destination paths",
+                            args.verbose)
+
+                transferPlan = plan.TransferPlan(paths)
+                transfer.filterOutExtensions(transferPlan, cfgSettings, True)
+                transfer.getPlannedWrites(transferPlan, cfgSettings,
+                                          encoderSettings,
+                                          args.non_interactive)
+
+                if args.update:
+                    transfer.filterUnchangedFiles(transferPlan,
+                                                  deviceManifest, mntLoc,
+                                                  args.verbose)
+                    cfgSettings['OverwriteDestinationFiles'] = str(YES)
+                    pipelineManifest = None
+
+                if not args.non_interactive:
+                    transferDecisions = decisions.gatherDecisions(
+                                                            transferPlan,
+                                                            cfgSettings,
+                                                            args.sources)
+                    conversionAnswers = transferDecisions.conversions
+
+                    if transferDecisions.overwrite:
+                        cfgSettings['OverwriteDestinationFiles'] = str(YES)
+
+                if checkSpace:
+                    talk.status("Checking there's enough space on %s"
+                                % mntLoc, args.verbose)
+
+                    if not space.preflight(
+                            transferPlan, mntLoc, transfer.QUALITY,
+                            cfgSettings.getint('OverwriteDestinationFiles'),
+                            args.jobs, args.non_interactive, args.quiet,
+                            probeCache):
+                        talk.error("Not enough space on %s!" % mntLoc,
+                                   args.quiet)
+                        system.abort(1)
+
+                    talk.success("Enough space on %s" % mntLoc, args.verbose)
+
+                paths = transferPlan.paths()
+            else:
+                paths = transfer.iterWantedPaths(paths, cfgSettings, True)
+
+            # Anything not skipped as up to date is new or has changed,
+            # so overwrite it
+            if args.update:
+                cfgSettings['OverwriteDestinationFiles'] = str(YES)
+
+            # Don't trust the manifest if we're interrupted while
+            # writing to the device
+            manifest.saveManifest(mntLoc, deviceManifest, clean=False)
+
+            if transferDecisions:
+                transfer.deleteFiles(transferDecisions.replacedFiles,
+                                     args.quiet)
+
+            talk.status("Converting and copying files", args.verbose)
+
+            if writeController:
+                parallelWriter = writes.ParallelWriter(
+                                    writeController,
+                                    transfer.getCopyOptions(
+                                                cfgSettings,
+                                                args.non_interactive,
+                                                args.verbose),
+                                    args.quiet,
+                                    transfer.getPreallocateFiles(
+                                                            cfgSettings),
+                                    checksums)
+            else:
+                parallelWriter = None
+
+            transferPipeline = pipeline.TransferPipeline(
+                                    cfgSettings, args.non_interactive,
+                                    args.verbose, args.quiet, args.jobs,
+                                    transcodeCache, encodeToDestination,
+                                    encoderSettings, pipelineManifest,
+                                    mntLoc, transferJournal, probeCache,
+                                    parallelWriter, checksums,
+                                    conversionAnswers)
+
+            # Returns a list of temporary files to remove later
+            tmpFiles = transferPipeline.run(paths)
+            plannedWrites = transferPipeline.plannedWrites
+            createdDirs = transferPipeline.createdDirectories
+
+            talk.success("Files converted and copied", args.verbose)
+
+            if libraryIndex:
+                talk.status("%d directories read, %d taken from library index"
+                            % (libraryIndex.rescanned, libraryIndex.reused),
+                            args.verbose)
+        else:
+            # Get source and destination paths
+            talk.status("Getting source and destination paths",
+                        args.verbose)
+
+            scanStart = time.time()
+
+            transferPlan = plan.TransferPlan(
+                                transfer.iterCorrespondingPaths(
+                                        args.sources, args.destination,
+                                        args.verbose, args.quiet, walk,
+                                        orderedWrites))
+
+            talk.success("Source and destination locations found",
+                         args.verbose)
+            talk.status("Scanned sources in %.2f seconds"
+                        % (time.time() - scanStart), args.verbose)
+
+            if libraryIndex:
+                talk.status("%d directories read, %d taken from library index"
+                            % (libraryIndex.rescanned, libraryIndex.reused),
+                            args.verbose)
+
+                if not libraryIndex.save():
+                    talk.error("Failed to write library index!", args.quiet)
+
+            # Filter out certain file types based on settings in config
+            # file. Files of types set to prompt are kept for now, and
+            # asked about along with everything else before any work
+            # starts.
+            talk.status("Filtering out unwanted file types", args.verbose)
+
+            transfer.filterOutExtensions(transferPlan, cfgSettings, True)
+
+            talk.success("Filtering complete", args.verbose)
+
+            transfer.getPlannedWrites(transferPlan, cfgSettings,
+                                      encoderSettings, args.non_interactive)
+
+            # Leave files which are already up to date alone if we're
+            # updating
+            if args.update:
+                talk.status("Finding files which are already up to date",
+                            args.verbose)
+
+                transfer.filterUnchangedFiles(transferPlan, deviceManifest,
+                                              mntLoc, args.verbose)
+
+                # Whatever's left is new or has changed, so overwrite it
+                cfgSettings['OverwriteDestinationFiles'] = str(YES)
+
+                talk.success("Up to date files skipped", args.verbose)
+
+            # Leave files which an interrupted transfer finished alone
+            if transferJournal and transferJournal.resuming:
+                finished = transferJournal.markFinished(transferPlan)
+
+                talk.status("%d files already transferred" % finished,
+                            args.verbose)
+
+            # Ask every question up front, so that the conversions and
+            # copies can run unattended
+            if not args.non_interactive:
+                transferDecisions = decisions.gatherDecisions(transferPlan,
+                                                              cfgSettings,
+                                                              args.sources)
+
+                if transferDecisions.overwrite:
+                    cfgSettings['OverwriteDestinationFiles'] = str(YES)
+
+            # Find out what's really in the files to convert, running
+            # ffprobe on several at once
+            if probeCache:
+                talk.status("Probing audio files", args.verbose)
+
+                probes = probe.probeFiles(
+                                [item.source for item in transferPlan.files()
+                                 if item.target != item.destination],
+                                probeCache, args.jobs)
+                remuxes = sum(probe.isPlayable(info)
+                              for info in probes.values())
+
+                talk.success("Audio files probed", args.verbose)
+                talk.status("%d of %d files to convert are already mp3, and"
+                            " will only be remuxed" % (remuxes, len(probes)),
+                            args.verbose)
+
+            # Make sure everything will fit before converting or copying
+            # anything
+            if cfgSettings.getint('CheckFreeSpace', fallback=NO):
+                talk.status("Checking there's enough space on %s" % mntLoc,
+                            args.verbose)
+
+                if not space.preflight(
+                        transferPlan, mntLoc, transfer.QUALITY,
+                        cfgSettings.getint('OverwriteDestinationFiles'),
+                        args.jobs, args.non_interactive, args.quiet,
+                        probeCache):
+                    talk.error("Not enough space on %s!" % mntLoc,
+                               args.quiet)
+                    system.abort(1)
+
+                talk.success("Enough space on %s" % mntLoc, args.verbose)
+
+            # Don't trust the manifest if we're interrupted while
+            # writing to the device
+            manifest.saveManifest(mntLoc, deviceManifest, clean=False)
+
+            # Create necessary directories to transfer to. Do this
+            # before converting anything, since conversions may write
+            # straight to the destination.
+            talk.status("Creating destination directories", args.verbose)
+
+            if transferDecisions:
+                transfer.deleteFiles(transferDecisions.replacedFiles,
+                                     args.quiet)
+
+            createdDirs = transfer.createDirectories(
+                        [item.destination
+                         for item in transferPlan.directories()],
+                        True, args.verbose, args.quiet)
+
+            talk.success("Destination directories created", args.verbose)
+
+            # Perform necessary audio file conversions
+            talk.status("Starting to convert any audio files that need it",
+                        args.verbose)
+
+            if transferDecisions:
+                conversionAnswers = transferDecisions.conversions
+            else:
+                conversionAnswers = None
+
+            # Returns a list of temporary files to remove later
+            tmpFiles = transfer.convertAudioFiles(transferPlan,
+                                                  cfgSettings,
+                                                  args.non_interactive,
+                                                  args.verbose, args.quiet,
+                                                  args.jobs, transcodeCache,
+                                                  encodeToDestination,
+                                                  transferJournal,
+                                                  conversionAnswers,
+                                                  probeCache)
+
+            talk.success("Conversions finished", args.verbose)
+
+            # Copy source files to destination
+            talk.status("Copying files", args.verbose)
+
+            if writeController:
+                parallelWriter = writes.ParallelWriter(
+                                    writeController,
+                                    transfer.getCopyOptions(
+                                                cfgSettings,
+                                                args.non_interactive,
+                                                args.verbose),
+                                    args.quiet,
+                                    transfer.getPreallocateFiles(
+                                                            cfgSettings),
+                                    checksums)
+            else:
+                parallelWriter = None
+
+            copyStart = time.monotonic()
+
+            transfer.copyFiles(transferPlan, cfgSettings,
+                               args.non_interactive, args.verbose, args.quiet,
+                               transferJournal, parallelWriter, checksums)
+
+            copyTime = time.monotonic() - copyStart
+
+            talk.success("Files copied", args.verbose)
+
+            plannedWrites = transferPlan.plannedWrites()
+
+        # Read the copies back from the device, and copy any which
+        # don't match again, before the converted files they were
+        # copied from are removed
+        if checksums:
+            talk.status("Verifying copies on %s" % mntLoc, args.verbose)
+
+            unverifiedFiles, checked, read, readTime = verify.verifyCopies(
+                                checksums, copyBufferSize,
+                                transfer.getPreallocateFiles(cfgSettings),
+                                args.jobs, args.verbose, args.quiet)
+
+            if not verify.writeReport(verify.getReportPath(),
+                                      unverifiedFiles, checked):
+                talk.error("Failed to write verification report!",
+                           args.quiet)
+
+            if unverifiedFiles:
+                talk.error("%d files failed verification; see %s"
+                           % (len(unverifiedFiles), verify.getReportPath()),
+                           args.quiet)
+            else:
+                talk.success("Copies verified", args.verbose)
+
+            talk.status("Verified %d files, %.1f MiB, in %.2f seconds"
+                        " (%.1f MiB/s)"
+                        % (checked, read / 1024**2, readTime,
+                           read / 1024**2 / readTime if readTime else 0),
+                        not args.quiet)
+
+            if copyTime:
+                copied = sum(size for _, _, size in checksums.files.values())
+                talk.status("Copied %.1f MiB in %.2f seconds (%.1f MiB/s)"
+                            % (copied / 1024**2, copyTime,
+                               copied / 1024**2 / copyTime),
+                            not args.quiet)
 
         # Delete temporary files
         talk.status("Removing any temp files", args.verbose)
@@ -145,14 +648,75 @@ def main():
 
         talk.success("temp files removed", args.verbose)
 
+        # Remember what was written to the device
+        writtenFiles = manifest.recordWrites(deviceManifest, mntLoc,
+                                             plannedWrites, startTime)
+
+        # Only sort the directories we've changed, unless asked to sort
+        # everything
+        if not args.sort_all:
+            sortDirectories = fatsort.getTouchedDirectories(mntLoc,
+                                                            writtenFiles,
+                                                            createdDirs)
+
+        # Trim the transcode cache back down to size and report how
+        # useful it was
+        if transcodeCache:
+            talk.status("Evicting old transcode cache entries", args.verbose)
+
+            evicted = transcodeCache.evict()
+
+            talk.success("%d cache entries evicted" % evicted, args.verbose)
+            talk.status("Transcode cache: %d hits, %d misses"
+                        % (transcodeCache.hits, transcodeCache.misses),
+                        not args.quiet)
+
+        # Remember the best way found of writing to the device
+        if writeController:
+            if writeController.best:
+                writers, bufferSize, throughput = writeController.best
+                talk.status("Wrote to %s at up to %.1f MiB/s, %d files at"
+                            " a time with %d MiB buffers"
+                            % (mntLoc, throughput / 1024**2, writers,
+                               bufferSize // 1024**2),
+                            args.verbose)
+
+            if not writeController.save():
+                talk.error("Failed to write device settings!", args.quiet)
+
+        # Save any fingerprints computed while converting
+        if libraryIndex and not libraryIndex.save():
+            talk.error("Failed to write library index!", args.quiet)
+
+        # Remember what was found in probed files for next time
+        if probeCache:
+            talk.status("%d files probed, %d taken from probe cache"
+                        % (probeCache.probed, probeCache.reused),
+                        args.verbose)
+
+            if not probeCache.save():
+                talk.error("Failed to write probe cache!", args.quiet)
+
         # Delete source directories if asked we're asked to. Note that
         # deleteSourceSetting - 1 is equivalent to a prompt flag, given
         # the config setting constant definitions.
         deleteSourceSetting = cfgSettings.getint("DeleteSources")
         promptFlag = deleteSourceSetting - 1
 
-        if (deleteSourceSetting
-           and not (args.non_interactive and promptFlag)):
+        if unverifiedFiles and deleteSourceSetting:
+            # Keep the sources of anything which didn't make it
+            talk.error("Not removing sources, since some files failed"
+                       " verification!", args.quiet)
+        elif transferDecisions and deleteSourceSetting == PROMPT:
+            # Already asked
+            talk.status("Removing source files and directories", args.verbose)
+
+            transfer.deletePaths(transferDecisions.removedSources, False,
+                                 args.verbose, args.quiet)
+
+            talk.success("source files and directories removed", args.verbose)
+        elif (deleteSourceSetting
+              and not (args.non_interactive and promptFlag)):
             # Remove sources
             talk.status("Removing source files and directories", args.verbose)
 
@@ -167,27 +731,129 @@ def main():
 
         rename.rename(mntLoc, args.quiet)
 
+        # The manifest doesn't know about renamed directories
+        manifestClean = False
+
+        # Renaming changes the entries of the device's root directory
+        if sortDirectories is not None:
+            sortDirectories.add('')
+
         talk.success("Matching directories renamed", args.verbose)
 
-    # Unmount and fatsort if we're asked to
-    if not args.no_sort:
-        # Unmount
+    # Save the device manifest if anything's changed
+    if args.sources or args.rebuild_manifest:
+        talk.status("Writing device manifest", args.verbose)
+
+        if manifest.saveManifest(mntLoc, deviceManifest, manifestClean):
+            talk.success("Device manifest written", args.verbose)
+        else:
+            talk.error("Failed to write device manifest!", args.quiet)
+
+    # Nothing left to resume
+    if transferJournal:
+        transferJournal.close(finished=True)
+
+    # Let the user know how much space is left
+    if args.sources:
+        talk.status("%.1f MiB free on %s, down from %.1f MiB"
+                    % (fatsort.getSpace(mntLoc)[1] / 1024**2, mntLoc,
+                       freeBefore / 1024**2),
+                    not args.quiet)
+
+    # Unmount and fatsort if we're asked to. If we wrote in order, only
+    # sort the directories that still ended up out of order, if any.
+    sortNeeded = not args.no_sort
+
+    if sortNeeded and orderedWrites:
+        talk.status("Checking the order of directories on %s" % mntLoc,
+                    args.verbose)
+
+        sortDirectories = fatsort.findUnsortedDirectories(mntLoc,
+                                                          sortDirectories)
+
+        if sortDirectories:
+            talk.status("%d directories are out of order"
+                        % len(sortDirectories), args.verbose)
+        else:
+            talk.success("Directories already in order; not sorting",
+                         args.verbose)
+            sortNeeded = False
+
+    # When staging, the image is what gets unmounted and sorted
+    if staging:
+        sortLoc = imagePath
         talk.status("Unmounting %s" % mntLoc, args.verbose)
 
-        if not fatsort.unmount(devLoc, args.verbose):
-            talk.error("Failed to unmount %s!" % mntLoc, args.quiet)
+        if not fatsort.unmount(mntLoc, args.verbose):
+            talk.error("Failed to unmount %s! Staged image kept at %s"
+                       % (mntLoc, imagePath), args.quiet)
             system.abort(1)
         else:
             talk.success("%s unmounted" % mntLoc, args.verbose)
+    else:
+        sortLoc = devLoc
+
+    if sortNeeded:
+        # Unmount
+        if not staging:
+            talk.status("Unmounting %s" % mntLoc, args.verbose)
+
+            if not fatsort.unmount(devLoc, args.verbose):
+                talk.error("Failed to unmount %s!" % mntLoc, args.quiet)
+                system.abort(1)
+            else:
+                talk.success("%s unmounted" % mntLoc, args.verbose)
 
         # Fatsort
-        talk.status("fatsorting %s" % mntLoc, args.quiet)
+        talk.status("fatsorting %s" % sortLoc, args.quiet)
+
+        if nativeSort:
+            sortSuccess = fatsort.nativeFatsort(sortLoc, args.verbose,
+                                                sortDirectories)
+        else:
+            sortSuccess = fatsort.fatsort(sortLoc, args.verbose,
+                                          sortDirectories)
+
+        if not sortSuccess:
+            talk.error("Failed to fatsort %s!" % sortLoc, args.quiet)
+
+            if staging:
+                talk.status("Staged image kept at %s" % imagePath,
+                            not args.quiet)
 
-        if not fatsort.fatsort(devLoc, args.verbose):
-            talk.error("Failed to fatsort %s!" % mntLoc, args.quiet)
             system.abort(1)
         else:
-            talk.success("%s fatsorted" % mntLoc, args.verbose)
+            talk.success("%s fatsorted" % sortLoc, args.verbose)
+
+    # Write the staged image to the device in one go
+    if staging:
+        talk.status("Unmounting %s" % deviceMount, args.verbose)
+
+        if not fatsort.unmount(devLoc, args.verbose):
+            talk.error("Failed to unmount %s! Staged image kept at %s"
+                       % (deviceMount, imagePath), args.quiet)
+            system.abort(1)
+        else:
+            talk.success("%s unmounted" % deviceMount, args.verbose)
+
+        talk.status("Writing staged image to %s" % devLoc, not args.quiet)
+
+        writeStart = time.time()
+
+        try:
+            written = stage.writeImage(imagePath, devLoc)
+        except (OSError, ValueError) as err:
+            talk.error("Failed to write to %s: %s! Staged image kept at %s"
+                       % (devLoc, err, imagePath), args.quiet)
+            system.abort(1)
+
+        writeTime = time.time() - writeStart
+
+        talk.success("%.1f MiB written to %s in %.1f seconds"
+                     % (written / 1024**2, devLoc, writeTime),
+                     not args.quiet)
+
+        stage.removeImage(imagePath, mntLoc)
 
     # Successful run
     talk.success("All done", args.verbose)
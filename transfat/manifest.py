@@ -0,0 +1,213 @@
+"""Contains functions to keep track of what transfat put on a device.
+
+The manifest lives in the root of the device's mount location and
+records, for each file transfat put on the device, its size and
+modification time along with which version of which source file it
+came from and, for transcoded files, which encoder settings made it.
+When the manifest is known to be consistent with the device, update
+runs use it instead of stat-ing every file on a slow device.
+
+The manifest is marked unclean before a run starts writing to the
+device and clean once the run finishes, so a manifest left behind by an
+interrupted run isn't trusted.
+"""
+
+import json
+import os
+
+# Name of the manifest file in the root of a device
+MANIFEST_NAME = '.transfat-manifest.json'
+
+# Version of the manifest format
+MANIFEST_VERSION = 2
+
+
+def getManifestPath(mountLocation):
+    """Return a string containing the path of a device's manifest."""
+    return os.path.join(mountLocation, MANIFEST_NAME)
+
+
+def sourceSignature(path, info=None):
+    """Return a string identifying the current version of a file.
+
+    This is based on the file's size and modification time rather than
+    its contents, so it's cheap to compute even for large libraries. If
+    the file has already been stat-ed, its 'os.stat_result' can be given
+    as info to save doing it again.
+    """
+    if info is None:
+        info = os.stat(path)
+
+    return "%d:%d" % (info.st_size, info.st_mtime_ns)
+
+
+def getEncoderSettings(encoderOptions, ffmpegVersion):
+    """Return a string identifying the settings files are encoded with.
+
+    Args:
+        encoderOptions: A list of strings containing FFmpeg encoder
+            options.
+        ffmpegVersion: A string containing the version FFmpeg reports.
+    """
+    return ' '.join(encoderOptions + [ffmpegVersion])
+
+
+def loadManifest(mountLocation):
+    """Return a device's manifest and whether it can be trusted.
+
+    Returns:
+        A 2-tuple containing (entries, clean) where entries is a
+        dictionary mapping paths relative to the mount location to
+        4-tuples of (size, mtime, "source", "encoder"), and clean is a
+        boolean signalling whether the entries are known to match the
+        device. The source signature and encoder settings may be None if
+        they're unknown or the file wasn't transcoded. If the device has
+        no readable manifest the entries are empty and not clean.
+    """
+    try:
+        with open(getManifestPath(mountLocation), 'r') as manifestFile:
+            contents = json.load(manifestFile)
+    except (OSError, ValueError):
+        return ({}, False)
+
+    if (not isinstance(contents, dict)
+            or contents.get('version') != MANIFEST_VERSION):
+        return ({}, False)
+
+    # Encoder settings are stored once and referred to by index
+    encoders = contents['encoders']
+    entries = {}
+
+    for relativePath, (size, mtime, source, encoder) in (
+            contents['files'].items()):
+        if encoder is not None:
+            encoder = encoders[encoder]
+
+        entries[relativePath] = (size, mtime, source, encoder)
+
+    return (entries, bool(contents['clean']))
+
+
+def saveManifest(mountLocation, entries, clean=True):
+    """Write a device's manifest and return whether it was successful.
+
+    The manifest is written to a temporary file which then replaces the
+    old manifest, so the old manifest stays intact if this fails.
+
+    Args:
+        mountLocation: A string containing the device's mount location.
+        entries: A dictionary of entries as returned by loadManifest.
+        clean: An optional boolean signalling whether the entries match
+            what's on the device. Save an unclean manifest before
+            changing anything on the device.
+    """
+    encoders = []
+    encoderIndices = {}
+    files = {}
+
+    for relativePath, (size, mtime, source, encoder) in entries.items():
+        if encoder is not None:
+            if encoder not in encoderIndices:
+                encoderIndices[encoder] = len(encoders)
+                encoders += [encoder]
+
+            encoder = encoderIndices[encoder]
+
+        files[relativePath] = [size, mtime, source, encoder]
+
+    manifestPath = getManifestPath(mountLocation)
+    temporaryPath = manifestPath + '.part'
+
+    try:
+        with open(temporaryPath, 'w') as manifestFile:
+            json.dump({'version': MANIFEST_VERSION,
+                       'clean': clean,
+                       'encoders': encoders,
+                       'files': files},
+                      manifestFile, separators=(',', ':'))
+
+        os.replace(temporaryPath, manifestPath)
+    except OSError:
+        return False
+
+    return True
+
+
+def recordWrites(entries, mountLocation, plannedWrites, since):
+    """Add files written during this run to a manifest.
+
+    Args:
+        entries: A dictionary of entries as returned by loadManifest,
+            which is updated in place.
+        mountLocation: A string containing the device's mount location.
+        plannedWrites: A list of 3-tuples of ("destination", "source",
+            "encoder") as returned by transfer.getPlannedWrite.
+        since: A float containing the time the run started at, as
+            returned by time.time. Destination files older than this
+            weren't written by this run and aren't recorded.
+
+    Returns:
+        A list of strings containing the absolute paths of the
+        destination files recorded.
+    """
+    # FAT stores modification times to within two seconds
+    since -= 2
+
+    # List of destination files recorded
+    recorded = []
+
+    for destination, source, encoder in plannedWrites:
+        try:
+            info = os.stat(destination)
+        except OSError:
+            continue
+
+        if info.st_mtime < since:
+            continue
+
+        relativePath = os.path.relpath(destination, mountLocation)
+        entries[relativePath] = (info.st_size, info.st_mtime, source,
+                                 encoder)
+        recorded += [destination]
+
+    return recorded
+
+
+def scanDevice(mountLocation, oldEntries):
+    """Return manifest entries for everything on a device.
+
+    Walks the whole device. Source signatures and encoder settings are
+    kept from the old entries for files whose size and modification
+    time haven't changed, and are otherwise unknown.
+
+    Args:
+        mountLocation: A string containing the device's mount location.
+        oldEntries: A dictionary of entries as returned by loadManifest.
+    """
+    entries = {}
+
+    for root, _, files in os.walk(mountLocation):
+        for file_ in files:
+            path = os.path.join(root, file_)
+            relativePath = os.path.relpath(path, mountLocation)
+
+            if relativePath.startswith(MANIFEST_NAME):
+                continue
+
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+
+            source = encoder = None
+            oldEntry = oldEntries.get(relativePath)
+
+            if (oldEntry is not None
+                    and oldEntry[0] == info.st_size
+                    and oldEntry[1] == info.st_mtime):
+                source, encoder = oldEntry[2:]
+
+            entries[relativePath] = (info.st_size, info.st_mtime, source,
+                                     encoder)
+
+    return entries
@@ -0,0 +1,437 @@
+"""Contains functions to convert and copy files at the same time."""
+
+import collections
+import concurrent.futures
+import functools
+import os
+import queue
+import threading
+from . import journal
+from . import talk
+from . import transfer
+
+# Default size in MiB of the converted files allowed to be waiting to be
+# copied, or being converted
+REORDER_BUFFER_SIZE = 256
+
+# Number of files allowed to wait to be copied, on top of two per job.
+# Files which aren't converted take up none of the reorder buffer, so
+# this is all that keeps the producer from getting far ahead of the
+# device with them.
+QUEUE_SIZE = 16
+
+
+class TransferPipeline:
+    """Converts and copies a stream of files, overlapping the two.
+
+    The stream of paths to transfer is consumed by a producer thread,
+    which creates destination directories as it comes across them and
+    runs conversions on a pool of FFmpeg processes. Conversions finish
+    in whatever order they finish in, but files are handed to the
+    calling thread to be copied strictly in the order they came in,
+    which is natural order when writing in order, so they're created on
+    the device in that order.
+
+    Converted files wait in a reorder buffer until everything before
+    them has been copied. The buffer is bounded in bytes (see
+    getReorderBufferSize): a conversion is only started once there's
+    room for it, counting it at its source file's size until it's done
+    and at its converted size after that. This keeps the scratch space
+    converted files take up capped, while letting the encoders get as
+    far ahead of the device as that allows. Nothing holds on to the
+    whole list of files.
+
+    If given a device manifest, files which are already up to date on
+    the device (see transfer.isUpToDate) are skipped. If given a journal,
+    files are recorded in it as they're worked on, and files finished by
+    the transfer it's resuming are skipped.
+
+    Attributes:
+        tmpFiles: A list of strings containing the absolute paths of
+            temporary files created by conversion, which should be
+            removed later.
+        plannedWrites: A list of 3-tuples as returned by
+            transfer.getPlannedWrite for the files transferred
+            successfully, for passing to manifest.recordWrites.
+        createdDirectories: A list of strings containing the absolute
+            paths of the destination directories created.
+    """
+
+    def __init__(self, configsettings, noninteractive=False, verbose=False,
+                 quiet=False, jobs=1, transcodeCache=None, toDestination=False,
+                 encoderSettings=None, deviceManifest=None,
+                 mountLocation=None, transferJournal=None,
+                 probeCache=None, parallelWriter=None, checksums=None,
+                 conversionAnswers=None):
+        """Set up a pipeline.
+
+        Args:
+            configsettings: A dictionary-like 'configparser.SectionProxy'
+                object containing configuration settings from
+                config.ini.
+            noninteractive: An optional boolean signalling to never
+                prompt.
+            verbose: An optional boolean toggling whether to give extra
+                output.
+            quiet: An optional boolean toggling whether to omit error
+                output.
+            jobs: An optional integer specifying how many FFmpeg
+                processes to run at the same time.
+            transcodeCache: An optional 'cache.TranscodeCache' object to
+                take converted files from and store them in.
+            toDestination: An optional boolean toggling whether to have
+                FFmpeg write straight to the destination files. Ignored
+                when using a transcode cache.
+            encoderSettings: An optional string as returned by
+                manifest.getEncoderSettings, recorded in planned writes.
+            deviceManifest: An optional dictionary of manifest entries
+                as returned by manifest.loadManifest. If given, files
+                which are up to date according to it are skipped.
+            mountLocation: A string containing the mount location of
+                the destination device. Required with a device manifest.
+            transferJournal: An optional 'journal.Journal' object to
+                record the transfer in.
+            probeCache: An optional 'probe.ProbeCache' object. If given,
+                files whose audio is already mp3 are remuxed rather than
+                encoded again; see transfer.transcodeFile.
+            parallelWriter: An optional 'writes.ParallelWriter' object
+                to copy files with, several at once. It's finished with
+                once the files are copied.
+            checksums: An optional 'verify.Checksums' object to record
+                the checksum of each file in as it's copied in-process.
+            conversionAnswers: An optional dictionary of answers to
+                conversion prompts, as for transfer.ConversionPlanner,
+                so that they aren't asked while the pipeline runs.
+        """
+        self.noninteractive = noninteractive
+        self.verbose = verbose
+        self.quiet = quiet
+        self.jobs = jobs
+        self.transcodeCache = transcodeCache
+        self.toDestination = toDestination and transcodeCache is None
+        self.encoderSettings = encoderSettings
+        self.deviceManifest = deviceManifest
+        self.mountLocation = mountLocation
+        self.transferJournal = transferJournal
+        self.probeCache = probeCache
+        self.parallelWriter = parallelWriter
+        self.checksums = checksums
+
+        self.planner = transfer.ConversionPlanner(configsettings,
+                                                  noninteractive,
+                                                  self.toDestination,
+                                                  conversionAnswers)
+        self.convertExtensions = tuple(extension for extension, _
+                                       in self.planner.extensionList)
+        self.inputOptions, self.encoderOptions = (
+                        transfer.getFFmpegOptions(jobs, verbose, quiet))
+        self.cpOptions = transfer.getCopyOptions(configsettings,
+                                                 noninteractive, verbose)
+        self.bufferSize = transfer.getCopyBufferSize(configsettings)
+        self.preallocateFiles = transfer.getPreallocateFiles(configsettings)
+        self.reorderBufferSize = getReorderBufferSize(configsettings)
+
+        # Bytes of the reorder buffer in use, and a condition to wait
+        # on for them to go down
+        self.bufferedBytes = 0
+        self._bufferCondition = threading.Condition()
+
+        self.tmpFiles = []
+        self.plannedWrites = []
+        self.createdDirectories = []
+
+        # Whatever went wrong in the producer thread, to be raised in
+        # the calling thread
+        self._producerError = None
+
+    def run(self, paths):
+        """Transfer a stream of paths and return the temporary files.
+
+        Args:
+            paths: An iterable of 3-tuples of ("source", "destination",
+                isDirectory), as generated by
+                transfer.iterCorrespondingPaths. Destination directories
+                are created when they come up, and must come up before
+                any files inside of them.
+
+        Returns:
+            The list of temporary files in the tmpFiles attribute.
+
+        Raises:
+            Whatever the producer thread raised, once the files it
+            queued have been copied.
+        """
+        # The producer thread fills this with 5-tuples of ("source",
+        # "file", "destination", size, plannedWrite) to copy, where file
+        # is the converted file for converted files and the source
+        # otherwise, size is the bytes of the reorder buffer it takes
+        # up, and plannedWrite is as returned by
+        # transfer.getPlannedWrite, and then None once it's finished.
+        # It's bounded by the reorder buffer, and by its length.
+        copyQueue = queue.Queue(maxsize=2 * self.jobs + QUEUE_SIZE)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                                max_workers=self.jobs) as executor:
+            producer = threading.Thread(target=self.produce,
+                                        args=(paths, executor, copyQueue),
+                                        daemon=True)
+            producer.start()
+
+            # Copy files as they come in
+            for (source, copiedFile, destination, size,
+                 plannedWrite) in iter(copyQueue.get, None):
+                if self.transferJournal:
+                    self.transferJournal.planCopy(source, copiedFile,
+                                                  destination)
+
+                callback = functools.partial(self.finishCopy, source,
+                                             copiedFile, destination, size,
+                                             plannedWrite)
+
+                if self.parallelWriter:
+                    self.parallelWriter.copy(copiedFile, destination,
+                                             callback)
+                else:
+                    callback(transfer.copyFile(copiedFile, destination,
+                                               self.cpOptions, self.quiet,
+                                               self.bufferSize,
+                                               self.preallocateFiles,
+                                               self.checksums))
+
+            if self.parallelWriter:
+                self.parallelWriter.finish()
+
+            producer.join()
+
+        if self._producerError:
+            raise self._producerError
+
+        return self.tmpFiles
+
+    def finishCopy(self, source, copiedFile, destination, size,
+                   plannedWrite, success):
+        """Record a finished copy and free its room in the buffer."""
+        if success:
+            self.plannedWrites.append(plannedWrite)
+
+            if self.transferJournal:
+                self.transferJournal.verify(source, copiedFile, destination)
+
+        self.resizeBuffered(size, 0)
+
+        return
+
+    def produce(self, paths, executor, copyQueue):
+        """Feed files to copy into a queue, converting them as needed.
+
+        Meant to run in its own thread; see run. Conversions are
+        submitted to an executor as files come in, once there's room
+        for them in the reorder buffer. Files are queued in order once
+        they're ready. None is queued when done, even if something goes
+        wrong, in which case the exception is kept for run to raise.
+
+        Args:
+            paths: An iterable of paths; see run.
+            executor: A 'concurrent.futures.Executor' to run conversions
+                on.
+            copyQueue: A 'queue.Queue' to put files to copy into.
+        """
+        # Files waiting to be queued, as 6-tuples of ("source",
+        # "destination", conversion, future, size, plannedWrite), where
+        # conversion and future are None if the file isn't being
+        # converted, and size is the bytes of the reorder buffer it takes
+        # up
+        pending = collections.deque()
+
+        try:
+            for source, destination, isDirectory in paths:
+                if isDirectory:
+                    self.createdDirectories += transfer.createDirectories(
+                                                        [destination],
+                                                        self.noninteractive,
+                                                        self.verbose,
+                                                        self.quiet)
+                    continue
+
+                # Skip files which are already on the device
+                plannedWrite = transfer.getPlannedWrite(
+                                            source, destination,
+                                            self.convertExtensions,
+                                            self.encoderSettings)
+
+                if (self.deviceManifest is not None
+                        and transfer.isUpToDate(plannedWrite,
+                                                self.deviceManifest,
+                                                self.mountLocation,
+                                                self.verbose)):
+                    continue
+
+                # Skip files an interrupted transfer already finished
+                if (self.transferJournal
+                        and self.transferJournal.isFinished(source,
+                                                            plannedWrite[0])):
+                    self.plannedWrites.append(plannedWrite)
+                    continue
+
+                conversion, finished = self.planner.plan(source,
+                                                         destination)
+
+                if finished:
+                    continue
+
+                # Files it was decided not to convert are copied as they
+                # are
+                if not conversion and plannedWrite[2] is not None:
+                    plannedWrite = (destination, plannedWrite[1], None)
+
+                if conversion:
+                    # Converted files are taken to be no bigger than
+                    # their source files until they're done
+                    try:
+                        size = os.path.getsize(source)
+                    except OSError:
+                        size = 0
+
+                    self.makeRoom(size, pending, copyQueue)
+                else:
+                    size = 0
+
+                if (conversion and self.transferJournal
+                        and self.transferJournal.convertedFile(
+                                                        source,
+                                                        conversion[1])):
+                    talk.status("Already converted %s" % source,
+                                self.verbose)
+
+                    future = concurrent.futures.Future()
+                    future.set_result((0, conversion[1]))
+                elif conversion:
+                    talk.status("Converting %s" % source, self.verbose)
+
+                    if self.transferJournal:
+                        transfer.recordConversion(self.transferJournal,
+                                                  source, conversion[1],
+                                                  self.transcodeCache,
+                                                  self.toDestination)
+
+                    future = executor.submit(transfer.transcodeFile, source,
+                                             conversion[1], self.inputOptions,
+                                             self.encoderOptions,
+                                             self.transcodeCache,
+                                             self.toDestination,
+                                             self.probeCache)
+                else:
+                    future = None
+
+                pending.append((source, destination, conversion, future,
+                                size, plannedWrite))
+
+                # Hand over files that are ready
+                while pending and (pending[0][3] is None
+                                   or pending[0][3].done()):
+                    self.handOver(pending.popleft(), copyQueue)
+
+            while pending:
+                self.handOver(pending.popleft(), copyQueue)
+        except BaseException as err:
+            self._producerError = err
+        finally:
+            copyQueue.put(None)
+
+    def handOver(self, pendingFile, copyQueue):
+        """Queue a file to be copied once its conversion has finished.
+
+        Args:
+            pendingFile: A 6-tuple of ("source", "destination",
+                conversion, future, size, plannedWrite); see produce.
+            copyQueue: A 'queue.Queue' to put files to copy into.
+        """
+        (source, destination, conversion, future, size,
+         plannedWrite) = pendingFile
+        copiedFile = source
+
+        if conversion:
+            extension = conversion[0]
+            exitCode, outputFile = future.result()
+
+            if exitCode:
+                # Copy the original file instead
+                talk.error("Failed to convert %s" % source, self.quiet)
+                size = self.resizeBuffered(size, 0)
+            else:
+                if self.transferJournal:
+                    self.transferJournal.record(journal.CONVERTED, source)
+
+                if self.toDestination:
+                    # Already where it needs to be
+                    self.plannedWrites.append(plannedWrite)
+
+                    if self.transferJournal:
+                        self.transferJournal.verify(source, outputFile,
+                                                    outputFile)
+
+                    self.resizeBuffered(size, 0)
+                    return
+
+                if self.transcodeCache is None:
+                    self.tmpFiles.append(outputFile)
+
+                try:
+                    size = self.resizeBuffered(size,
+                                               os.path.getsize(outputFile))
+                except OSError:
+                    pass
+
+                copiedFile = outputFile
+                destination = destination[:-len(extension)] + '.mp3'
+
+        copyQueue.put((source, copiedFile, destination, size, plannedWrite))
+
+    def makeRoom(self, size, pending, copyQueue):
+        """Wait until a file fits in the reorder buffer, and add it.
+
+        Files waiting on conversions are handed over, oldest first,
+        until the file fits, since the copier can't free up any room
+        until they're queued; after that, this waits on the copier. A
+        file bigger than the whole buffer is let in once the buffer is
+        empty.
+
+        Args:
+            size: An integer containing the bytes the file takes up.
+            pending: The deque of files waiting to be queued; see
+                produce.
+            copyQueue: A 'queue.Queue' to put files to copy into.
+        """
+        def fits():
+            """Return whether the file fits in the buffer."""
+            return (self.bufferedBytes == 0
+                    or self.bufferedBytes + size <= self.reorderBufferSize)
+
+        while pending and not fits():
+            self.handOver(pending.popleft(), copyQueue)
+
+        with self._bufferCondition:
+            self._bufferCondition.wait_for(fits)
+            self.bufferedBytes += size
+
+        return
+
+    def resizeBuffered(self, oldSize, newSize):
+        """Change the bytes a file takes up in the reorder buffer.
+
+        Returns the new size, for convenience. A new size of 0 takes the
+        file out of the buffer.
+        """
+        with self._bufferCondition:
+            self.bufferedBytes += newSize - oldSize
+            self._bufferCondition.notify_all()
+
+        return newSize
+
+
+def getReorderBufferSize(configsettings):
+    """Return the size of a pipeline's reorder buffer in bytes."""
+    bufferSize = configsettings.getint('ReorderBufferSize',
+                                       fallback=REORDER_BUFFER_SIZE)
+
+    return bufferSize * 1024**2
@@ -0,0 +1,141 @@
+"""Contains the plan of what a transfer will do with each path.
+
+A transfer plan holds one record per source directory and file, in the
+order the sources were walked. Each stage of a transfer (see transfer)
+looks at the records it cares about and updates them in place, rather
+than removing paths from the middle of lists, so every update is
+constant time no matter how large the library is.
+"""
+
+# Kinds of item
+DIRECTORY = 'directory'
+FILE = 'file'
+
+# Actions to take on a file
+COPY = 'copy'
+CONVERT = 'convert'
+
+# Statuses of an item. Pending items still have work to do; the others
+# are finished with, one way or another.
+PENDING = 'pending'
+REMOVED = 'removed'
+SKIPPED = 'skipped'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class TransferItem:
+    """A source directory or file and what to do with it.
+
+    Attributes:
+        source: A string containing the absolute path of the source.
+        destination: A string containing the absolute path to write the
+            source to. Changed to the path of the mp3 once a file has
+            been converted.
+        kind: DIRECTORY or FILE.
+        action: COPY or CONVERT.
+        status: PENDING, REMOVED, SKIPPED, DONE, or FAILED.
+        extension: A string containing the extension being converted
+            from, for files being converted; otherwise None.
+        output: A string containing the path of the converted file, for
+            files being converted; otherwise None.
+        target: A string containing the absolute path of the file that
+            will end up on the device, or None if it hasn't been worked
+            out yet (see transfer.getPlannedWrites).
+        signature: A string containing the source file's signature (see
+            manifest.sourceSignature), or None.
+        encoder: A string containing the encoder settings if the file
+            may be transcoded, or None.
+    """
+
+    __slots__ = ('source', 'destination', 'kind', 'action', 'status',
+                 'extension', 'output', 'target', 'signature', 'encoder')
+
+    def __init__(self, source, destination, kind):
+        """Make a pending record for a source and its destination."""
+        self.source = source
+        self.destination = destination
+        self.kind = kind
+        self.action = COPY
+        self.status = PENDING
+        self.extension = None
+        self.output = None
+        self.target = None
+        self.signature = None
+        self.encoder = None
+
+    @property
+    def plannedWrite(self):
+        """A 3-tuple as returned by transfer.getPlannedWrite."""
+        return (self.target, self.signature, self.encoder)
+
+
+class TransferPlan:
+    """The records of every source directory and file in a transfer.
+
+    Attributes:
+        items: A list of 'TransferItem' objects in the order the sources
+            were walked, so each directory comes before the files inside
+            of it.
+    """
+
+    def __init__(self, paths=()):
+        """Make a plan with a pending item for each path.
+
+        Args:
+            paths: An optional iterable of 3-tuples of ("source",
+                "destination", isDirectory), as generated by
+                transfer.iterCorrespondingPaths.
+        """
+        self.items = [TransferItem(source, destination,
+                                   DIRECTORY if isDirectory else FILE)
+                      for source, destination, isDirectory in paths]
+
+    def __len__(self):
+        """Return the number of items in the plan."""
+        return len(self.items)
+
+    def directories(self, status=PENDING):
+        """Return a list of the directory items with a given status.
+
+        If status is None, every directory item is returned.
+        """
+        return [item for item in self.items
+                if item.kind == DIRECTORY
+                and (status is None or item.status == status)]
+
+    def files(self, status=PENDING):
+        """Return a list of the file items with a given status.
+
+        If status is None, every file item is returned.
+        """
+        return [item for item in self.items
+                if item.kind == FILE
+                and (status is None or item.status == status)]
+
+    def paths(self):
+        """Generate the pending items' paths, directories first.
+
+        Yields 3-tuples of ("source", "destination", isDirectory) like
+        transfer.iterCorrespondingPaths.
+        """
+        for item in self.items:
+            if item.status == PENDING:
+                yield (item.source, item.destination, item.kind == DIRECTORY)
+
+        return
+
+    def plannedWrites(self):
+        """Return the planned writes of files that may have been written.
+
+        Files which failed, or were never finished, are left out, so that
+        a partial copy is never recorded as up to date.
+
+        Returns:
+            A list of 3-tuples as returned by transfer.getPlannedWrite,
+            for files which are done and whose planned writes have been
+            worked out.
+        """
+        return [item.plannedWrite for item in self.items
+                if item.kind == FILE and item.target is not None
+                and item.status == DONE]
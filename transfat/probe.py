@@ -0,0 +1,209 @@
+"""Contains a persistent cache of what's inside audio files.
+
+A file's extension doesn't say what it holds: an .m4a file can be ALAC
+or AAC, and an .mp4 file can hold mp3 audio the stereo plays fine.
+ffprobe, which comes with FFmpeg, reports the codec, bitrate, sample
+rate, and duration of a file's audio. Running it takes a moment per
+file, so results are kept along with the file's size and modification
+time, and are only worked out again if either changes.
+"""
+
+import concurrent.futures
+import json
+import os
+import subprocess
+import threading
+from . import cache
+
+# Version of the probe cache file format
+PROBE_VERSION = 1
+
+# Audio codecs the stereo can play, as ffprobe names them
+PLAYABLE_CODECS = ('mp3',)
+
+# Highest sample rate in Hz an mp3 stream can have
+PLAYABLE_SAMPLE_RATE = 48000
+
+
+def getProbeCachePath():
+    """Return a string containing the path of the probe cache file."""
+    return cache.getCacheDirectoryPath() + "/probes.json"
+
+
+def probeFile(path):
+    """Ask ffprobe what's in an audio file.
+
+    Returns:
+        A dictionary containing the container's 'format' name, the
+        'codec' name of the first audio stream, its 'bitRate' in bit/s
+        and 'sampleRate' in Hz, and the file's 'duration' in seconds.
+        Values ffprobe doesn't report are None. If ffprobe isn't
+        installed, can't read the file, or finds no audio in it, None
+        is returned instead.
+    """
+    try:
+        probe = subprocess.run(['ffprobe', '-v', 'error',
+                                '-show_entries',
+                                'format=format_name,duration,bit_rate:'
+                                'stream=codec_type,codec_name,bit_rate,'
+                                'sample_rate',
+                                '-of', 'json', path],
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+        contents = json.loads(probe.stdout)
+    except (OSError, ValueError):
+        return None
+
+    if probe.returncode or not isinstance(contents, dict):
+        return None
+
+    streams = [stream for stream in contents.get('streams', [])
+               if stream.get('codec_type') == 'audio']
+
+    if not streams:
+        return None
+
+    stream = streams[0]
+    container = contents.get('format', {})
+
+    def number(value, type_=int):
+        """Convert one of ffprobe's values, or return None."""
+        try:
+            return type_(value)
+        except (TypeError, ValueError):
+            return None
+
+    return {'format': container.get('format_name'),
+            'codec': stream.get('codec_name'),
+            'bitRate': number(stream.get('bit_rate')
+                              or container.get('bit_rate')),
+            'sampleRate': number(stream.get('sample_rate')),
+            'duration': number(container.get('duration'), float)}
+
+
+def isPlayable(info):
+    """Return whether the stereo can play the audio described by info.
+
+    Args:
+        info: A dictionary as returned by probeFile, or None, in which
+            case the file is taken not to be playable.
+    """
+    if info is None or info['codec'] not in PLAYABLE_CODECS:
+        return False
+
+    return (info['sampleRate'] is None
+            or info['sampleRate'] <= PLAYABLE_SAMPLE_RATE)
+
+
+class ProbeCache:
+    """Results of probing files, keyed by path, size, and mtime.
+
+    Attributes:
+        path: A string containing the path of the cache file, or None
+            if the cache is only kept in memory.
+        files: A dictionary mapping absolute file paths to lists of
+            [size, mtime, info], where info is as returned by probeFile.
+        probed: An integer counting files ffprobe was run on.
+        reused: An integer counting files taken from the cache file.
+    """
+
+    def __init__(self, path=None):
+        """Load a cache file, starting afresh if it can't be read."""
+        self.path = path
+        self.files = {}
+        self.probed = 0
+        self.reused = 0
+        self._changed = False
+        self._lock = threading.Lock()
+
+        # Paths already looked up, so they're only counted once
+        self._seen = set()
+
+        if path is None:
+            return
+
+        try:
+            with open(path, 'r') as cacheFile:
+                contents = json.load(cacheFile)
+        except (OSError, ValueError):
+            return
+
+        if (isinstance(contents, dict)
+                and contents.get('version') == PROBE_VERSION):
+            self.files = contents['files']
+
+    def save(self):
+        """Write the cache if it's changed; return whether that worked."""
+        if self.path is None or not self._changed:
+            return True
+
+        temporaryPath = self.path + '.part'
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            with self._lock, open(temporaryPath, 'w') as cacheFile:
+                json.dump({'version': PROBE_VERSION, 'files': self.files},
+                          cacheFile, separators=(',', ':'))
+
+            os.replace(temporaryPath, self.path)
+        except OSError:
+            return False
+
+        self._changed = False
+
+        return True
+
+    def probe(self, path):
+        """Return what's in a file, reusing a stored result.
+
+        The stored result is only used if the file's size and
+        modification time still match; otherwise ffprobe is run (see
+        probeFile). Safe to call from several threads at once.
+        """
+        path = os.path.abspath(path)
+
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+
+        state = [info.st_size, info.st_mtime_ns]
+        entry = self.files.get(path)
+
+        if entry is not None and entry[:2] == state:
+            with self._lock:
+                if path not in self._seen:
+                    self._seen.add(path)
+                    self.reused += 1
+
+            return entry[2]
+
+        result = probeFile(path)
+
+        with self._lock:
+            self.files[path] = state + [result]
+            self._seen.add(path)
+            self.probed += 1
+            self._changed = True
+
+        return result
+
+
+def probeFiles(paths, probeCache, jobs=1):
+    """Probe a list of files, running ffprobe on several at once.
+
+    Args:
+        paths: A list of strings containing the paths of the files.
+        probeCache: A 'ProbeCache' object to take results from and store
+            them in.
+        jobs: An optional integer specifying how many ffprobe processes
+            to run at the same time.
+
+    Returns:
+        A dictionary mapping the paths to what's in them, as returned
+        by probeFile.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as executor:
+        return dict(zip(paths, executor.map(probeCache.probe, paths)))
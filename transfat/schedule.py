@@ -0,0 +1,163 @@
+"""Contains functions for ordering conversions so they finish soonest.
+
+Conversions run on several FFmpeg processes at once. If they're started
+in the order files are found, a long DJ set that happens to come last
+is left encoding on its own long after everything else has finished.
+Starting the longest conversions first, and filling in around them with
+shorter ones, finishes close to the soonest the work could possibly be
+done in.
+
+How long a conversion takes is estimated from how long the audio is,
+going by what ffprobe found (see probe.py), or, for files that haven't
+been probed, by their size and extension.
+"""
+
+import heapq
+import os
+import time
+from . import probe
+
+# Seconds it takes to start an FFmpeg process and its encoder
+PROCESS_TIME = 0.05
+
+# Seconds it takes to encode a second of audio with LAME, roughly
+ENCODE_TIME = 1 / 40
+
+# Seconds it takes to remux a second of audio
+REMUX_TIME = 1 / 2000
+
+# How much longer decoding makes a conversion take, by codec. Codecs
+# not listed here are taken to be as quick to decode as FLAC.
+DECODE_FACTORS = {'alac': 1.1, 'aac': 1.2, 'vorbis': 1.2, 'opus': 1.3}
+
+# Typical bytes per second of audio, by extension, for guessing the
+# duration of files that haven't been probed
+BYTE_RATES = {'.flac': 110000, '.alac': 110000, '.m4a': 32000,
+              '.mp4': 32000, '.aac': 32000, '.ogg': 24000}
+
+# Bytes per second of audio taken for any other extension
+DEFAULT_BYTE_RATE = 110000
+
+
+def estimateDuration(path, info=None):
+    """Return roughly how many seconds of audio a file holds.
+
+    Args:
+        path: A string containing the path of the file.
+        info: An optional dictionary as returned by probe.probeFile. If
+            it has the file's duration, that's used; otherwise the
+            duration is guessed from the file's size (see BYTE_RATES).
+    """
+    if info and info['duration'] is not None:
+        return info['duration']
+
+    extension = os.path.splitext(path)[1].lower()
+
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+
+    return size / BYTE_RATES.get(extension, DEFAULT_BYTE_RATE)
+
+
+def estimateTime(path, info=None):
+    """Return roughly how many seconds converting a file takes.
+
+    Doesn't include starting FFmpeg; see estimateBatchTime.
+
+    Args:
+        path: A string containing the path of the file.
+        info: An optional dictionary as returned by probe.probeFile.
+    """
+    duration = estimateDuration(path, info)
+
+    if probe.isPlayable(info):
+        return duration * REMUX_TIME
+
+    codec = info['codec'] if info else None
+
+    return duration * ENCODE_TIME * DECODE_FACTORS.get(codec, 1)
+
+
+def estimateBatchTime(paths, probes):
+    """Return roughly how many seconds an FFmpeg process will take.
+
+    Args:
+        paths: A list of strings containing the paths of the files the
+            process converts.
+        probes: A dictionary mapping paths to what's in them, as
+            returned by probe.probeFiles. Files missing from it are
+            taken not to have been probed.
+    """
+    return PROCESS_TIME + sum(estimateTime(path, probes.get(path))
+                              for path in paths)
+
+
+def longestFirst(jobs, times):
+    """Sort jobs from longest to shortest.
+
+    Args:
+        jobs: A list of jobs.
+        times: A list of how many seconds each job is expected to take,
+            in the same order as jobs.
+
+    Returns:
+        A list of 2-tuples of (job, time), longest first. Jobs expected
+        to take as long as each other stay in the order they came in.
+    """
+    return sorted(zip(jobs, times), key=lambda pair: pair[1], reverse=True)
+
+
+def predictTotalTime(times, workers=1):
+    """Return how long running jobs in order on several workers takes.
+
+    Each job goes to whichever worker frees up first, as it would on a
+    'concurrent.futures.ThreadPoolExecutor'.
+
+    Args:
+        times: A list of how many seconds each job takes, in the order
+            they're started.
+        workers: An optional integer specifying how many jobs run at
+            the same time.
+
+    Returns:
+        A float containing the seconds until the last job finishes.
+    """
+    finishTimes = [0.0] * max(workers, 1)
+
+    for jobTime in times:
+        heapq.heapreplace(finishTimes, finishTimes[0] + jobTime)
+
+    return max(finishTimes)
+
+
+def getShortestTotalTime(times, workers=1):
+    """Return a lower bound on how long running jobs can take.
+
+    No order of the jobs can finish sooner than this: the work can't
+    be spread more evenly than across every worker, and can't be done
+    before the longest job is.
+
+    Args:
+        times: A list of how many seconds each job takes.
+        workers: An optional integer specifying how many jobs run at
+            the same time.
+    """
+    if not times:
+        return 0.0
+
+    return max(sum(times) / max(workers, 1), max(times))
+
+
+def timed(function, *args):
+    """Call a function and return its result and how long it took.
+
+    Returns:
+        A 2-tuple containing whatever the function returns and a float
+        containing the seconds it took.
+    """
+    start = time.monotonic()
+    result = function(*args)
+
+    return (result, time.monotonic() - start)
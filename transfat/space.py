@@ -0,0 +1,259 @@
+"""Contains functions for working out how much space a transfer needs.
+
+A file takes up its size rounded up to a whole number of clusters on a
+FAT device, plus the directory entries holding its name, which can grow
+the directory it's in by a cluster. Copied files' sizes are known
+exactly. Converted files' sizes are estimated from their duration and
+the average bitrate LAME encodes at for the quality they're converted
+at, except for files which are only remuxed, which stay about the same
+size.
+"""
+
+import os
+from . import fat
+from . import fatsort
+from . import plan
+from . import probe
+from . import talk
+from .config.constants import NO
+
+# Average bitrates in kbit/s of LAME's VBR qualities. See:
+# https://trac.ffmpeg.org/wiki/Encode/MP3
+VBR_BITRATES = {'0': 245, '1': 225, '2': 190, '3': 175, '4': 165,
+                '5': 130, '6': 115, '7': 100, '8': 85, '9': 65}
+
+# Bytes allowed for the tags and header of a converted file
+TAG_SIZE = 64 * 1024
+
+# Characters of a long file name held in each directory entry
+LONG_NAME_CHARACTERS = 13
+
+
+def estimateConvertedSize(source, duration, quality):
+    """Return roughly how big a file will be once converted to mp3.
+
+    Args:
+        source: A string containing the path of the file.
+        duration: The file's duration in seconds, or None if it isn't
+            known, in which case the source file's size is used. Lossy
+            files may shrink less than that, but won't grow much.
+        quality: A string containing the LAME VBR quality the file is
+            converted at (see transfer.QUALITY).
+
+    Returns:
+        An integer containing the estimated size in bytes.
+    """
+    if duration is None:
+        try:
+            return os.path.getsize(source)
+        except OSError:
+            return 0
+
+    return int(duration * VBR_BITRATES[quality] * 1000 / 8) + TAG_SIZE
+
+
+def getEntriesSize(name):
+    """Return the bytes of directory entries needed to hold a name.
+
+    Assumes the name needs a long name, which most do.
+    """
+    longEntries = -(-len(name) // LONG_NAME_CHARACTERS)
+    return (1 + longEntries) * fat.ENTRY_SIZE
+
+
+def getDirectorySize(directory):
+    """Return the bytes of directory entries a directory is using.
+
+    Returns 0 if the directory doesn't exist.
+    """
+    try:
+        with os.scandir(directory) as iterator:
+            names = [entry.name for entry in iterator]
+    except OSError:
+        return 0
+
+    # Count the . and .. entries too
+    return (2 * fat.ENTRY_SIZE
+            + sum(getEntriesSize(name) for name in names))
+
+
+def estimateUsage(transferPlan, mountLocation, quality,
+                  overwriteSetting=NO, jobs=1, probeCache=None):
+    """Estimate how much of a device a transfer will use up.
+
+    Args:
+        transferPlan: A 'plan.TransferPlan' object whose planned writes
+            have been worked out (see transfer.getPlannedWrites).
+        mountLocation: A string containing the device's mount location.
+        quality: A string containing the LAME VBR quality files are
+            converted at.
+        overwriteSetting: An optional integer containing the
+            OverwriteDestinationFiles setting. Files already on the
+            device are taken to be overwritten unless it's NO.
+        jobs: An optional integer specifying how many files to find the
+            duration of at once.
+        probeCache: An optional 'probe.ProbeCache' object to take
+            durations from. If given, files whose audio is already mp3
+            are taken to be remuxed, as transfer.transcodeFile does.
+
+    Returns:
+        A 2-tuple of (albums, directories), where albums is a
+        dictionary mapping source directories to the bytes their
+        pending files will use up, and directories is the bytes that
+        directories will grow by. Files being overwritten by smaller
+        ones count negatively.
+    """
+    clusterSize = os.statvfs(mountLocation).f_frsize
+
+    def onDisk(size):
+        """Round a size up to a whole number of clusters."""
+        return -(-size // clusterSize) * clusterSize
+
+    files = transferPlan.files()
+    conversions = [item.source for item in files
+                   if item.target != item.destination]
+
+    if probeCache is None:
+        # Only the durations are needed, so nothing is remuxed
+        probes = probe.probeFiles(conversions, probe.ProbeCache(), jobs)
+        remuxed = set()
+    else:
+        probes = probe.probeFiles(conversions, probeCache, jobs)
+        remuxed = {source for source, info in probes.items()
+                   if probe.isPlayable(info)}
+
+    # Bytes of new directory entries going into each directory
+    newEntries = {}
+
+    for item in transferPlan.directories():
+        if not os.path.isdir(item.destination):
+            directory = item.destination
+            parent, name = os.path.split(directory)
+
+            # A new directory holds . and .. entries, and takes up an
+            # entry in its parent
+            newEntries[directory] = (newEntries.get(directory, 0)
+                                     + 2 * fat.ENTRY_SIZE)
+            newEntries[parent] = (newEntries.get(parent, 0)
+                                  + getEntriesSize(name))
+
+    albums = {}
+
+    for item in files:
+        if item.source in probes and item.source not in remuxed:
+            info = probes[item.source]
+            size = estimateConvertedSize(item.source,
+                                         info and info['duration'], quality)
+        else:
+            try:
+                size = os.path.getsize(item.source)
+            except OSError:
+                size = 0
+
+        try:
+            existingSize = os.stat(item.target).st_size
+        except OSError:
+            existingSize = None
+
+        if existingSize is None:
+            usage = onDisk(size)
+
+            parent, name = os.path.split(item.target)
+            newEntries[parent] = (newEntries.get(parent, 0)
+                                  + getEntriesSize(name))
+        elif overwriteSetting == NO:
+            # Left alone
+            usage = 0
+        else:
+            usage = onDisk(size) - onDisk(existingSize)
+
+        album = os.path.dirname(item.source)
+        albums[album] = albums.get(album, 0) + usage
+
+    directories = 0
+
+    for directory, entriesSize in newEntries.items():
+        currentSize = getDirectorySize(directory)
+        directories += onDisk(currentSize + entriesSize) - onDisk(currentSize)
+
+    return (albums, directories)
+
+
+def dropAlbum(transferPlan, album):
+    """Leave a source directory's pending files out of a transfer.
+
+    The files are marked as removed, and so is the directory if nothing
+    else is going into it.
+    """
+    for item in transferPlan.files():
+        if os.path.dirname(item.source) == album:
+            item.status = plan.REMOVED
+
+    for item in transferPlan.directories():
+        if item.source == album:
+            prefix = os.path.join(item.destination, '')
+
+            if not any(other.destination.startswith(prefix)
+                       for other in transferPlan.files()):
+                item.status = plan.REMOVED
+
+    return
+
+
+def preflight(transferPlan, mountLocation, quality, overwriteSetting=NO,
+              jobs=1, noninteractive=False, quiet=False, probeCache=None):
+    """Check a transfer will fit on a device before starting it.
+
+    Prints the space free on the device and roughly how much will be
+    free after the transfer. If the transfer won't fit, offers to leave
+    out source directories, biggest first, until it does.
+
+    Args:
+        transferPlan: A 'plan.TransferPlan' object whose planned writes
+            have been worked out. Files left out are marked as removed.
+        mountLocation: A string containing the device's mount location.
+        quality: A string containing the LAME VBR quality files are
+            converted at.
+        overwriteSetting: An optional integer containing the
+            OverwriteDestinationFiles setting.
+        jobs: An optional integer specifying how many files to find the
+            duration of at once.
+        noninteractive: An optional boolean signalling not to offer to
+            leave anything out.
+        quiet: An optional boolean toggling whether to omit output.
+        probeCache: An optional 'probe.ProbeCache' object; see
+            estimateUsage.
+
+    Returns:
+        A boolean signaling whether the transfer will fit.
+    """
+    free = fatsort.getSpace(mountLocation)[1]
+    albums, needed = estimateUsage(transferPlan, mountLocation, quality,
+                                   overwriteSetting, jobs, probeCache)
+    needed += sum(albums.values())
+
+    if needed > free:
+        talk.error("About %.1f MiB needed on %s, but only %.1f MiB is free!"
+                   % (needed / 1024**2, mountLocation, free / 1024**2),
+                   quiet)
+
+        if noninteractive:
+            return False
+
+        for album, usage in sorted(albums.items(), key=lambda pair: pair[1],
+                                   reverse=True):
+            if needed <= free or usage <= 0:
+                break
+
+            if talk.prompt("Leave out %s (%.1f MiB)?"
+                           % (album, usage / 1024**2)):
+                dropAlbum(transferPlan, album)
+                needed -= usage
+
+        if needed > free:
+            return False
+
+    talk.status("About %.1f MiB will be free on %s after transferring"
+                % ((free - needed) / 1024**2, mountLocation), not quiet)
+
+    return True
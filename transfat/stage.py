@@ -0,0 +1,238 @@
+"""Contains functions for staging a transfer in a local image file.
+
+Cheap USB sticks are very slow at the small, scattered writes that
+creating files, updating directories, and sorting make. Staging builds
+the finished, sorted filesystem in an image file on a local disk
+instead, then writes the image to the device in one sequential pass.
+The image is sparse, so only the parts of it which were written to take
+up space or get written to the device. Set TMPDIR to put the image on a
+tmpfs.
+"""
+
+import os
+import subprocess
+import tempfile
+from . import fat
+from . import fatsort
+
+# Number of bytes to read or write at a time
+BLOCK_SIZE = 8 * 1024**2
+
+
+def createImage(deviceLocation, refresh=False):
+    """Create an image file to stage a transfer to a device in.
+
+    Args:
+        deviceLocation: A string containing the device location.
+        refresh: An optional boolean toggling whether to start with a
+            copy of what's on the device. Otherwise the image gets a
+            new, empty filesystem like the device's (see
+            makeFilesystem).
+
+    Returns:
+        A string containing the path of the image file; or, if it
+        couldn't be created, an empty string.
+    """
+    try:
+        size = fatsort.getDeviceSize(deviceLocation)
+        fd, imagePath = tempfile.mkstemp(prefix='transfat-', suffix='.img')
+    except OSError:
+        return ''
+
+    os.close(fd)
+
+    try:
+        if refresh:
+            success = readDevice(deviceLocation, imagePath) == size
+        else:
+            success = makeFilesystem(deviceLocation, imagePath, size)
+    except OSError:
+        success = False
+
+    if not success:
+        removeImage(imagePath)
+        return ''
+
+    return imagePath
+
+
+def readDevice(deviceLocation, imagePath):
+    """Copy a device into an image file and return the bytes copied.
+
+    The device is read from start to end. Blocks which are all zeros
+    aren't written to the image, which leaves holes in their place.
+    """
+    # Make sure everything written to the mounted device is on it
+    os.sync()
+
+    zeros = bytes(BLOCK_SIZE)
+    offset = 0
+
+    with open(deviceLocation, 'rb', buffering=0) as device, \
+            open(imagePath, 'r+b', buffering=0) as image:
+        while True:
+            block = device.read(BLOCK_SIZE)
+
+            if not block:
+                break
+
+            if block != zeros[:len(block)]:
+                image.seek(offset)
+                image.write(block)
+
+            offset += len(block)
+
+        image.truncate(offset)
+
+    return offset
+
+
+def makeFilesystem(deviceLocation, imagePath, size):
+    """Make an empty FAT filesystem in an image file.
+
+    The filesystem has the same size as the device, and if the device
+    already has a FAT filesystem, the same FAT type, sector size,
+    cluster size, label, and volume ID.
+
+    Returns:
+        A boolean signaling whether the filesystem was made. mkfs.vfat
+        needs to be installed. exFAT devices can't be staged, since
+        mkfs.vfat can't make exFAT filesystems.
+    """
+    if fat.isExfat(deviceLocation):
+        return False
+
+    os.truncate(imagePath, size)
+
+    options = []
+
+    try:
+        with fat.FatVolume(deviceLocation) as volume:
+            options += ['-F', str(volume.fatType),
+                        '-S', str(volume.bytesPerSector),
+                        '-s', str(volume.sectorsPerCluster)]
+
+            if volume.volumeId is not None:
+                options += ['-i', '%08X' % volume.volumeId]
+
+            if volume.volumeLabel and volume.volumeLabel != 'NO NAME':
+                options += ['-n', volume.volumeLabel]
+    except (OSError, ValueError):
+        # Not FAT yet, so let mkfs.vfat choose
+        pass
+
+    try:
+        exitCode = subprocess.Popen(['mkfs.vfat'] + options + [imagePath],
+                                    stdout=subprocess.DEVNULL).wait()
+    except FileNotFoundError:
+        return False
+
+    return bool(not exitCode)
+
+
+def mountImage(imagePath):
+    """Mount an image file and return where; or an empty string."""
+    try:
+        mountLocation = tempfile.mkdtemp(prefix='transfat-')
+    except OSError:
+        return ''
+
+    exitCode = subprocess.Popen(['sudo', 'mount', '-o', 'loop', imagePath,
+                                 mountLocation]).wait()
+    if exitCode:
+        os.rmdir(mountLocation)
+        return ''
+
+    return mountLocation
+
+
+def iterWrittenExtents(fd, size, start=0):
+    """Generate the parts of a file which aren't holes.
+
+    Yields 2-tuples of (offset, length) in ascending order, starting at
+    a given offset. If the system can't find holes, the whole file is
+    taken to be written.
+    """
+    offset = start
+
+    while offset < size:
+        try:
+            offset = os.lseek(fd, offset, os.SEEK_DATA)
+            end = os.lseek(fd, offset, os.SEEK_HOLE)
+        except AttributeError:
+            # No SEEK_DATA on this platform
+            end = size
+        except OSError:
+            # No more data past offset
+            return
+
+        yield (offset, min(end, size) - offset)
+        offset = end
+
+    return
+
+
+def writeImage(imagePath, deviceLocation):
+    """Write a staged image to a device and return the bytes written.
+
+    Everything up to the start of the data region is written, since the
+    device's old file allocation tables and root directory need
+    replacing even where the image's are zeros; after that, only the
+    parts of the image which were written to are. Those are free
+    clusters on the image, so whatever the device has there doesn't
+    matter. Everything is written in ascending order and flushed to the
+    device before returning. The device must be unmounted.
+
+    Raises an OSError if the image can't be read or the device can't be
+    written to.
+    """
+    with fat.FatVolume(imagePath) as volume:
+        dataOffset = volume.dataOffset
+
+    imageFd = os.open(imagePath, os.O_RDONLY)
+
+    try:
+        deviceFd = os.open(deviceLocation, os.O_WRONLY)
+    except OSError:
+        os.close(imageFd)
+        raise
+
+    written = 0
+
+    try:
+        size = os.fstat(imageFd).st_size
+        extents = [(0, min(dataOffset, size))]
+        extents += iterWrittenExtents(imageFd, size, dataOffset)
+
+        for offset, length in extents:
+            end = offset + length
+
+            while offset < end:
+                block = os.pread(imageFd, min(BLOCK_SIZE, end - offset),
+                                 offset)
+                if not block:
+                    break
+
+                count = os.pwrite(deviceFd, block, offset)
+                offset += count
+                written += count
+
+        os.fsync(deviceFd)
+    finally:
+        os.close(deviceFd)
+        os.close(imageFd)
+
+    return written
+
+
+def removeImage(imagePath, mountLocation=''):
+    """Remove an image file and the directory it was mounted on."""
+    try:
+        os.remove(imagePath)
+
+        if mountLocation:
+            os.rmdir(mountLocation)
+    except OSError:
+        pass
+
+    return
@@ -49,19 +49,58 @@ def getRuntimeArguments():
             "--default",
             help="use default settings from config file",
             action="store_true")
+    parser.add_argument(
+            "-j", "--jobs",
+            help="number of audio conversions to run at once"
+                 " (default: number of CPU cores)",
+            type=positiveInteger,
+            default=os.cpu_count() or 1)
     parser.add_argument(
             "--no-sort",
             help="do not unmount and fatsort",
             action="store_true")
+    parser.add_argument(
+            "--pipeline",
+            help="copy files while other files are still converting",
+            action="store_true")
     parser.add_argument(
             "--print-config",
             nargs=0,
             help='print example transfatrc and exit',
             action=ConfigPrintAction)
+    parser.add_argument(
+            "--rebuild-manifest",
+            help="rebuild the device manifest from a scan of the device",
+            action="store_true")
+    parser.add_argument(
+            "--refresh",
+            help="like --stage, but start with a copy of what's already"
+                 " on the device",
+            action="store_true")
     parser.add_argument(
             "--rename",
             help="rename name-pattern matched directories",
             action="store_true")
+    parser.add_argument(
+            "--sort-all",
+            help="sort every directory on the device, not just the ones"
+                 " transferred to",
+            action="store_true")
+    parser.add_argument(
+            "--stage",
+            help="build a new filesystem for the device in a local image"
+                 " and write it to the device in one pass, replacing"
+                 " everything on the device",
+            action="store_true")
+    parser.add_argument(
+            "-u", "--update",
+            help="only transfer files which are new or have changed",
+            action="store_true")
+    parser.add_argument(
+            "--verify",
+            help="checksum files as they're copied, then read them back"
+                 " from the device and copy any that don't match again",
+            action="store_true")
     parser.add_argument(
             "--version",
             action='version',
@@ -85,6 +124,24 @@ def getRuntimeArguments():
     return arguments
 
 
+def positiveInteger(string):
+    """Return an integer parsed from a string if it's positive.
+
+    Used as an argparse type; raises an 'argparse.ArgumentTypeError' if
+    the string isn't a positive integer.
+    """
+    try:
+        value = int(string)
+    except ValueError:
+        value = 0
+
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+                "'%s' is not a positive integer" % string)
+
+    return value
+
+
 def getConfigurationFilePath():
     """Return a string containing the path of the configuration file.
 
@@ -2,8 +2,13 @@
 
 import distutils.util
 import sys
+import threading
 from .version import NAME
 
+# Held while prompting, so prompts from different threads don't get
+# mixed up with each other
+promptLock = threading.RLock()
+
 
 def prompt(query):
     """Prompt a yes/no question and get an answer.
@@ -12,20 +17,24 @@ def prompt(query):
     Credit goes to Matt Stevenson. See:
     http://mattoc.com/python-yes-no-prompt-cli.html
 
+    Safe to call from several threads at once; only one question is
+    asked at a time.
+
     Args:
         query: A string containing a question.
 
     Returns:
         A boolean corresponding to the answer to the question asked.
     """
-    sys.stdout.write("%s [y/n]: " % query)
-    val = input().lower()
-    try:
-        result = distutils.util.strtobool(val)
-    except ValueError:
-        # Result no good! Ask again.
-        sys.stdout.write("Please answer with y/n\n")
-        return prompt(query)
+    with promptLock:
+        sys.stdout.write("%s [y/n]: " % query)
+        val = input().lower()
+        try:
+            result = distutils.util.strtobool(val)
+        except ValueError:
+            # Result no good! Ask again.
+            sys.stdout.write("Please answer with y/n\n")
+            return prompt(query)
     return result
 
 
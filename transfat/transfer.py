@@ -1,14 +1,56 @@
 """Contains functions used to copy and process (mostly audio) files."""
 
+import concurrent.futures
+import ctypes
+import errno
+import functools
 import os
 import shutil
 import subprocess
+import time
+from . import cache
+from . import fat
+from . import journal
+from . import manifest
+from . import plan
+from . import probe
+from . import schedule
 from . import talk
 from .config.constants import NO, YES, PROMPT
 
+# Quality setting for conversions. See:
+# https://trac.ffmpeg.org/wiki/Encode/MP3
+QUALITY = '0'
+
+# FFmpeg options to put audio the stereo can already play into an mp3
+# file as it is, without encoding it again
+REMUX_OPTIONS = ['-codec:a', 'copy']
+
+# Tracks at most this many seconds long are converted in batches, if
+# batching is turned on
+SHORT_TRACK_DURATION = 240
+
+# Most files converted by a single FFmpeg process when batching
+BATCH_SIZE = 16
+
+# Extensions of audio files, which are never filtered out
+AUDIO_EXTENSIONS = ('.flac', '.alac', '.aac', '.m4a', '.mp4', '.ogg', '.mp3')
+
+# Default buffer size in MiB for copying files in-process
+COPY_BUFFER_SIZE = 8
+
+# Errors which mean the kernel can't copy between two particular files
+# in a particular way, but might be able to in another
+FALLBACK_ERRNOS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                   errno.EBADF)
+
+# fallocate mode which reserves space for a file without changing its
+# size, which is the only mode Linux's FAT driver supports
+FALLOC_FL_KEEP_SIZE = 1
+
 
 def getCorrespondingPathsLists(sourcePaths, destinationPath, verbose=False,
-                               quiet=False):
+                               quiet=False, walk=os.walk):
     """Return lists of corresponding source and destination paths.
 
     Generate corresponding lists of paths for source and destination
@@ -25,6 +67,9 @@ def getCorrespondingPathsLists(sourcePaths, destinationPath, verbose=False,
             output.
         quiet: An optional boolean toggling whether to omit error
             output.
+        walk: An optional function to walk source directories with,
+            which must behave like os.walk; for instance
+            'library.LibraryIndex.walk'.
 
     Returns:
         A 4-tuple containing (sourceDirs, sourceFiles, destinationDirs,
@@ -43,16 +88,64 @@ def getCorrespondingPathsLists(sourcePaths, destinationPath, verbose=False,
         correspond to each other, and, similarly, where the indices of
         sourceFiles and destinationFiles correspond to each other.
     """
-    # Make sure source and destination paths are absolute paths
-    sourcePaths_ = [os.path.abspath(source) for source in sourcePaths]
-    destinationPath_ = os.path.abspath(destinationPath)
-
     # Generate lists of source and destination paths
     sourceDirs = []
     sourceFiles = []
     destinationDirs = []
     destinationFiles = []
 
+    for source, destination, isDirectory in iterCorrespondingPaths(
+                                                sourcePaths, destinationPath,
+                                                verbose, quiet, walk):
+        if isDirectory:
+            sourceDirs.append(source)
+            destinationDirs.append(destination)
+        else:
+            sourceFiles.append(source)
+            destinationFiles.append(destination)
+
+    return (sourceDirs, sourceFiles, destinationDirs, destinationFiles)
+
+
+def iterCorrespondingPaths(sourcePaths, destinationPath, verbose=False,
+                           quiet=False, walk=os.walk, ordered=False):
+    """Generate corresponding source and destination paths.
+
+    Like getCorrespondingPathsLists, but yields paths as the sources are
+    walked instead of building lists of them, so whatever consumes the
+    paths can get started as soon as the first directory has been read.
+    Each directory is yielded before the files inside of it.
+
+    Ordered paths come in the order a sorted FAT directory stores them
+    (see fat.sortKey): each directory's subdirectories are yielded
+    before the files next to them, and both are in natural order. So
+    creating destinations in the order they're yielded leaves their
+    directories sorted, except where converting a file changes where
+    its name sorts.
+
+    Args:
+        sourcePaths: A list of strings containing source paths, which
+            can be files or directories.
+        destinationPath: A string containing a destination path for
+            where the source files/directories should be transfered to.
+        verbose: An optional boolean toggling whether to give extra
+            output.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+        walk: An optional function to walk source directories with,
+            which must behave like os.walk.
+        ordered: An optional boolean toggling whether to yield paths in
+            sorted order, as described above.
+
+    Yields:
+        3-tuples of ("source", "destination", isDirectory) containing
+        the absolute paths of a source and its destination and a
+        boolean signalling whether they're directories.
+    """
+    # Make sure source and destination paths are absolute paths
+    sourcePaths_ = [os.path.abspath(source) for source in sourcePaths]
+    destinationPath_ = os.path.abspath(destinationPath)
+
     # Go through each source
     for source in sourcePaths_:
         # Get the parent directory of the source so we can generate the
@@ -62,45 +155,52 @@ def getCorrespondingPathsLists(sourcePaths, destinationPath, verbose=False,
 
         # Determine whether the source is a file or directory
         if os.path.isfile(source):
-            # The source is a file, so add it to the file lists
-            sourceFiles += [source]
-            destinationFiles += [destinationPath_ + source[parentlen:]]
+            # The source is a file
+            yield (source, destinationPath_ + source[parentlen:], False)
         elif os.path.isdir(source):
-            # The source is a directory, so add itself and everything
-            # inside of it to the appropriate lists
-            for root, _, files in os.walk(source):
-                sourceDirs += [root]
-                sourceFiles += [root + '/' + file for file in files]
-                destinationDirs += [destinationPath_ + root[parentlen:]]
-                destinationFiles += [destinationPath_
-                                     + root[parentlen:]
-                                     + '/'
-                                     + file
-                                     for file in files]
+            # The source is a directory, so yield itself and everything
+            # inside of it
+            for root, dirs, files in walk(source):
+                destinationRoot = destinationPath_ + root[parentlen:]
+
+                if not ordered:
+                    yield (root, destinationRoot, True)
+                else:
+                    # Walk subdirectories in order, and yield them now
+                    # rather than when they're walked
+                    dirs[:] = sorted(dirs, key=fat.sortKey)
+                    files = sorted(files, key=fat.sortKey)
+
+                    if root == source:
+                        yield (root, destinationRoot, True)
+
+                    for dir_ in dirs:
+                        if not os.path.islink(root + '/' + dir_):
+                            yield (root + '/' + dir_,
+                                   destinationRoot + '/' + dir_,
+                                   True)
+
+                for file_ in files:
+                    yield (root + '/' + file_,
+                           destinationRoot + '/' + file_,
+                           False)
         else:
             # The source is neither a file nor directory. Give a
             # warning.
             talk.error("'%s' does not exist!" % source, quiet)
             talk.status("Proceeding anyway", verbose)
 
-    return (sourceDirs, sourceFiles, destinationDirs, destinationFiles)
-
+    return
 
-def filterOutExtensions(sourceFiles, destinationFiles, configsettings,
-                        noninteractive=False):
-    """Remove indices corresponding to unwanted files from lists.
 
-    Filter out files of unwanted extensions from the list of source
-    files and destination files.
+def filterOutExtensions(transferPlan, configsettings, noninteractive=False):
+    """Mark unwanted files in a transfer plan as removed.
 
-    [*] The indices of the source file list and destination file list
-    inputs must correspond to each other.
+    Filter out files of unwanted extensions from the pending files of a
+    transfer plan.
 
     Args:
-        sourceFiles: A list of strings of absolute paths to source
-            files. See [*] above.
-        destinationFiles: A list of strings of absolute paths to
-            destination files. See [*] above.
+        transferPlan: A 'plan.TransferPlan' object.
         configsettings: A dictionary-like 'configparser.SectionProxy'
             object containing configuration settings from config.ini.
         noninteractive: An optional boolean toggling whether to suppress
@@ -108,7 +208,54 @@ def filterOutExtensions(sourceFiles, destinationFiles, configsettings,
             configuration file config.ini.
 
     Returns:
-        Nothing. The work performed on the file lists is done in place.
+        Nothing. The work performed on the plan is done in place.
+    """
+    removalOptions = getRemovalOptions(configsettings)
+
+    for item in transferPlan.files():
+        if not isWantedFile(item.destination, removalOptions, noninteractive):
+            item.status = plan.REMOVED
+
+    return
+
+
+def iterWantedPaths(paths, configsettings, noninteractive=False):
+    """Filter unwanted files out of a stream of paths.
+
+    The streaming counterpart of filterOutExtensions.
+
+    Args:
+        paths: An iterable of 3-tuples as generated by
+            iterCorrespondingPaths.
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean toggling whether to suppress
+            prompts to remove files.
+
+    Yields:
+        The directories and wanted files from paths.
+    """
+    removalOptions = getRemovalOptions(configsettings)
+
+    for source, destination, isDirectory in paths:
+        if isDirectory or isWantedFile(destination, removalOptions,
+                                       noninteractive):
+            yield (source, destination, isDirectory)
+
+    return
+
+
+def getRemovalOptions(configsettings):
+    """Return which file extensions to remove, for isWantedFile.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+
+    Returns:
+        A 2-tuple containing a list of two-item lists of [extensions,
+        removeOption], where extensions is a tuple of extensions, and
+        the remove option for files of any other non-audio type.
     """
     # Load settings from config file
     imageOption = configsettings.getint('RemoveImages')
@@ -118,7 +265,6 @@ def filterOutExtensions(sourceFiles, destinationFiles, configsettings,
     otherOption = configsettings.getint('RemoveOtherFiletypes')
 
     # Tuples of file extension types we care about
-    audioExt = ('.flac', '.alac', '.aac', '.m4a', '.mp4', '.ogg', '.mp3')
     imageExt = ('.jpg', '.jpeg', '.bmp', '.png', '.gif')
     logExt = ('.log',)
     cueExt = ('.cue',)
@@ -130,59 +276,188 @@ def filterOutExtensions(sourceFiles, destinationFiles, configsettings,
                      [cueExt, cueOption],
                      [m3uExt, m3uOption]]
 
-    # Gather all of the non-audio file extensions into one tuple
-    nonAudioExt = ()
-    for ext in extensionList:
-        nonAudioExt += ext[0]
+    return (extensionList, otherOption)
 
-    # Initialize a list of indices corresponding to files to remove
-    indexList = []
 
-    # Find which files have extensions that we don't want and mark their
-    # indices
-    for file_ in destinationFiles:
-        if file_.lower().endswith(audioExt):
-            # This is an audio file; keep this file for sure
-            pass
-        elif file_.lower().endswith(nonAudioExt):
-            # This matches one of the non-audio extensions. Find which
-            # extension it is and remove the file from the file list as
-            # instructed to by the config settings.
-            for ext, removeOption in extensionList:
-                if file_.lower().endswith(ext):
-                    # Extension matched! Remove the file according to
-                    # the config settings, prompting if necessary.
-
-                    if ((removeOption == PROMPT
-                        and (noninteractive
-                             or talk.prompt("Move '%s'?" % file_)))
-                            or removeOption == NO):
-                        # Keep the file in the file list
-                        break
-                    else:
-                        # Add index to list of indices to remove
-                        indexList += [destinationFiles.index(file_)]
-        else:
-            # This is some other kind of file. Remove the file according
-            # to the config settings, prompting if necessary.
-            if ((otherOption == PROMPT
+def isWantedFile(file_, removalOptions, noninteractive=False):
+    """Return whether a file should be kept, prompting if necessary.
+
+    Args:
+        file_: A string containing the path of the file.
+        removalOptions: A 2-tuple as returned by getRemovalOptions.
+        noninteractive: An optional boolean toggling whether to suppress
+            prompts to remove files that may have been requested in the
+            configuration file config.ini; such files are kept.
+    """
+    removeOption = getRemoveOption(file_, removalOptions)
+
+    return bool((removeOption == PROMPT
                  and (noninteractive or talk.prompt("Move '%s'?" % file_)))
-                    or otherOption == NO):
-                # Keep the file in the file list
-                pass
-            else:
-                # Add index to list of indices to remove
-                indexList += [destinationFiles.index(file_)]
+                or removeOption == NO)
+
+
+def getRemoveOption(file_, removalOptions):
+    """Return the config setting for whether to remove a file.
+
+    Args:
+        file_: A string containing the path of the file.
+        removalOptions: A 2-tuple as returned by getRemovalOptions.
+
+    Returns:
+        NO, YES, or PROMPT. Audio files are never removed.
+    """
+    extensionList, otherOption = removalOptions
 
-    # Remove files we don't want from the file lists, going through the
-    # indices in reverse order
-    for index in indexList[::-1]:
-        sourceFiles.pop(index)
-        destinationFiles.pop(index)
+    if file_.lower().endswith(AUDIO_EXTENSIONS):
+        # This is an audio file; keep this file for sure
+        return NO
+
+    for ext, removeOption in extensionList:
+        if file_.lower().endswith(ext):
+            # Extension matched! Remove the file according to the
+            # config settings, prompting if necessary.
+            return removeOption
+
+    # This is some other kind of file
+    return otherOption
+
+
+def getPlannedWrites(transferPlan, configsettings, encoderSettings,
+                     noninteractive=False):
+    """Work out what each pending file will be written to the device as.
+
+    Args:
+        transferPlan: A 'plan.TransferPlan' object.
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        encoderSettings: A string as returned by
+            manifest.getEncoderSettings.
+        noninteractive: An optional boolean signalling that extensions
+            which would be prompted for won't be converted.
+
+    Returns:
+        Nothing. Sets the target, signature, and encoder of each pending
+        file in the plan, so that its plannedWrite attribute is the
+        3-tuple returned by getPlannedWrite.
+    """
+    convertExtensions = tuple(extension for extension, _
+                              in getConversionExtensions(configsettings,
+                                                         noninteractive))
+
+    for item in transferPlan.files():
+        item.target, item.signature, item.encoder = getPlannedWrite(
+                                                        item.source,
+                                                        item.destination,
+                                                        convertExtensions,
+                                                        encoderSettings)
+
+    return
+
+
+def getPlannedWrite(source, destination, convertExtensions, encoderSettings):
+    """Return what a source file will be written to the device as.
+
+    Args:
+        source: A string containing the absolute path of a source file.
+        destination: A string containing the absolute path of the
+            corresponding destination file.
+        convertExtensions: A tuple of the extensions which will be
+            converted, as given by getConversionExtensions.
+        encoderSettings: A string as returned by
+            manifest.getEncoderSettings.
+
+    Returns:
+        A 3-tuple of ("destination", "source", "encoder"), where
+        destination is the absolute path of the file that will end up on
+        the device, source is the source file's signature (see
+        manifest.sourceSignature) or None if the source can't be read,
+        and encoder is the encoder settings if the file may be
+        transcoded and None otherwise.
+    """
+    extension = os.path.splitext(source)[1].lower()
+
+    try:
+        signature = manifest.sourceSignature(source)
+    except OSError:
+        signature = None
+
+    if extension in convertExtensions:
+        return (destination[:-len(extension)] + '.mp3', signature,
+                encoderSettings)
+
+    return (destination, signature, None)
+
+
+def filterUnchangedFiles(transferPlan, deviceManifest, mountLocation,
+                         verbose=False):
+    """Mark files which are already up to date on the device as skipped.
+
+    The device manifest is taken as the truth about what's on the
+    device, so nothing on the device is looked at; it should have been
+    rebuilt from a scan of the device first if it can't be trusted.
+
+    A file that will be copied as is is up to date if its manifest entry
+    has the same size and is no older than the source file. A file that
+    will be transcoded is up to date if its manifest entry says it was
+    transcoded from the current version of the source file with the
+    current encoder settings.
+
+    Args:
+        transferPlan: A 'plan.TransferPlan' object whose planned writes
+            have been worked out by getPlannedWrites.
+        deviceManifest: A dictionary of entries as returned by
+            manifest.loadManifest.
+        mountLocation: A string containing the mount location of the
+            destination device.
+        verbose: An optional boolean toggling whether to give extra
+            output.
+
+    Returns:
+        Nothing. The work performed on the plan is done in place.
+    """
+    for item in transferPlan.files():
+        if isUpToDate(item.plannedWrite, deviceManifest, mountLocation,
+                      verbose):
+            item.status = plan.SKIPPED
 
     return
 
 
+def isUpToDate(plannedWrite, deviceManifest, mountLocation, verbose=False):
+    """Return whether a planned write is already on the device.
+
+    See filterUnchangedFiles for what counts as up to date.
+
+    Args:
+        plannedWrite: A 3-tuple as returned by getPlannedWrite.
+        deviceManifest: A dictionary of entries as returned by
+            manifest.loadManifest.
+        mountLocation: A string containing the mount location of the
+            destination device.
+        verbose: An optional boolean toggling whether to say so if the
+            file is up to date.
+    """
+    destination, signature, encoder = plannedWrite
+    entry = deviceManifest.get(os.path.relpath(destination, mountLocation))
+
+    if signature is None or entry is None:
+        # Either the source can't be read, in which case we'll let the
+        # later stages deal with it, or it isn't on the device
+        return False
+    elif encoder is not None:
+        upToDate = entry[2:] == (signature, encoder)
+    else:
+        # FAT stores modification times to within two seconds
+        sourceSize, sourceMtime = signature.split(':')
+        upToDate = (entry[0] == int(sourceSize)
+                    and entry[1] >= int(sourceMtime) / 1e9 - 2)
+
+    if upToDate:
+        talk.status("%s is up to date" % destination, verbose)
+
+    return upToDate
+
+
 def createDirectories(directoriesList, noninteractive=False, verbose=False,
                       quiet=False):
     """Create directories specified by a list.
@@ -199,6 +474,10 @@ def createDirectories(directoriesList, noninteractive=False, verbose=False,
             output.
         quiet: An optional boolean toggling whether to omit error
             output.
+
+    Returns:
+        A list of strings containing the absolute paths of the
+        directories which were created.
     """
     # Determine whether to prompt to overwrite files
     if noninteractive:
@@ -206,6 +485,9 @@ def createDirectories(directoriesList, noninteractive=False, verbose=False,
     else:
         doprompt = True
 
+    # List of directories created
+    createdDirs = []
+
     # Create each directory
     for targetDir in directoriesList:
         try:
@@ -235,25 +517,30 @@ def createDirectories(directoriesList, noninteractive=False, verbose=False,
             # Create directory
             talk.status("Creating %s" % targetDir, verbose)
             os.makedirs(targetDir)
+
+            createdDirs += [targetDir]
         except OSError:
             talk.error("Failed to create %s!" % targetDir, quiet)
 
-    return
+    return createdDirs
 
 
-def convertAudioFiles(sourceFiles, destinationFiles, configsettings,
-                      noninteractive=False, verbose=False, quiet=False):
+def convertAudioFiles(transferPlan, configsettings, noninteractive=False,
+                      verbose=False, quiet=False, jobs=1, transcodeCache=None,
+                      toDestination=False, transferJournal=None,
+                      answers=None, probeCache=None):
     """Convert non-mp3 audio files to mp3.
 
-    Uses FFmpeg to convert audio files with non-mp3 extensions (as
-    specified in the config settings) to mp3s. Returns a list of paths
-    to the mp3 files created, and updates the source and destination
-    file lists in place, replacing the original files with the newly
-    converted files.
+    Uses FFmpeg to convert the pending audio files of a transfer plan
+    with non-mp3 extensions (as specified in the config settings) to
+    mp3s. Returns a list of paths to the mp3 files created, and updates
+    the plan in place so that the converted files are copied instead of
+    the original files.
 
-    The input arguments for the source and destination files are
-    expected to be in terms of absolute paths; [*] furthermore, their
-    indices are expected to correspond to each other.
+    The conversions expected to take longest are started first (see
+    schedule.py), so that the processes all finish at about the same
+    time. How long the conversions took is reported along with how
+    long they were expected to take.
 
     If the user has an old version of FFmpeg, it's quite possible that
     metadata will fail to transfer to the converted file. On later
@@ -261,10 +548,7 @@ def convertAudioFiles(sourceFiles, destinationFiles, configsettings,
     here.
 
     Args:
-        sourceFiles: A list of strings of absolute paths to source
-            files. See [*] above.
-        destinationFiles: A list of strings of absolute paths to
-            destination files. See [*] above.
+        transferPlan: A 'plan.TransferPlan' object.
         configsettings: A dictionary-like 'configparser.SectionProxy'
             object containing configuration settings from config.ini.
         noninteractive: An optional boolean signalling to never ask to
@@ -275,17 +559,256 @@ def convertAudioFiles(sourceFiles, destinationFiles, configsettings,
         quiet: An optional boolean toggling whether to omit both error
             output and output to signal that the non-interactive flag
             has prevented a conversion from taking place.
+        jobs: An optional integer specifying how many FFmpeg processes
+            to run at the same time.
+        transcodeCache: An optional 'cache.TranscodeCache' object to
+            take converted files from and store them in. Files served
+            from the cache aren't included in the list returned.
+        toDestination: An optional boolean toggling whether to have
+            FFmpeg write straight to the destination files instead of
+            next to the source files. Files converted this way are
+            marked as done, since there's nothing left to copy, and
+            aren't included in the list returned. The destination
+            directories must already exist. Ignored when using a
+            transcode cache.
+        transferJournal: An optional 'journal.Journal' object to record
+            conversions in. Temporary files converted by the transfer
+            it's resuming are used rather than converting again.
+        answers: An optional dictionary of answers to conversion
+            prompts; see ConversionPlanner.
+        probeCache: An optional 'probe.ProbeCache' object. If given,
+            files whose audio is already mp3 are remuxed rather than
+            encoded again; see transcodeFile. Also used to find how
+            long tracks are, for batching short ones (see getBatches)
+            and for starting long ones first.
 
     Returns:
         A list of strings containing the absolute paths of the files
-        created by conversion. Also modifies the source and destination
-        file lists in place such that the original files are replaced by
-        the newly converted files.
+        created by conversion. Also modifies the plan in place: files
+        which failed to convert are left to be copied as they are.
     """
-    # Quality setting for conversions. See:
-    # https://trac.ffmpeg.org/wiki/Encode/MP3
-    QUALITY = '0'
+    # Only write straight to the destination if we aren't going
+    # through the cache
+    toDestination = toDestination and transcodeCache is None
+
+    # Work out which files to convert
+    conversions = planConversions(transferPlan, configsettings,
+                                  noninteractive, toDestination, answers)
+
+    # Return an empty list if we don't need to convert anything
+    if not conversions:
+        return []
+
+    inputOptions, encoderOptions = getFFmpegOptions(jobs, verbose, quiet)
+
+    batching = configsettings.getint('BatchShortTracks', fallback=NO)
+
+    # Find out how long the tracks are. Without a probe cache, this is
+    # only worth running ffprobe for if we're batching; otherwise how
+    # long they are is guessed from their size.
+    if probeCache is not None or batching:
+        probes = probe.probeFiles([item.source for item in conversions],
+                                  probeCache or probe.ProbeCache(), jobs)
+    else:
+        probes = {}
 
+    # Convert short tracks several to an FFmpeg process if we're asked
+    # to
+    if batching:
+        batches = getBatches(conversions, probes, jobs)
+    else:
+        batches = [[item] for item in conversions]
+
+    # Start the longest conversions first
+    batchTimes = [schedule.estimateBatchTime([item.source for item in batch],
+                                             probes)
+                  for batch in batches]
+    schedulePlan = schedule.longestFirst(batches, batchTimes)
+    predictedTime = schedule.predictTotalTime(
+                                [batchTime for _, batchTime in schedulePlan],
+                                jobs)
+
+    talk.status("Conversions expected to take %.1f seconds" % predictedTime,
+                verbose)
+
+    # Run the conversions, keeping up to the requested number of FFmpeg
+    # processes going at once. The futures dictionary maps to lists of
+    # items of the conversions list.
+    results = {}
+
+    # Seconds each FFmpeg process took
+    processTimes = []
+
+    startTime = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+
+        for batch, _ in schedulePlan:
+            # Items of the batch which still need converting
+            items = []
+
+            for item in batch:
+                if (transferJournal
+                        and transferJournal.convertedFile(item.source,
+                                                          item.output)):
+                    talk.status("Already converted %s" % item.source,
+                                verbose)
+
+                    results[item] = (0, item.output)
+                    continue
+
+                talk.status("Converting %s" % item.source, verbose)
+
+                if transferJournal:
+                    recordConversion(transferJournal, item.source,
+                                     item.output, transcodeCache,
+                                     toDestination)
+
+                items += [item]
+
+            if items:
+                future = executor.submit(schedule.timed, transcodeBatch,
+                                         [item.source for item in items],
+                                         [item.output for item in items],
+                                         inputOptions, encoderOptions,
+                                         transcodeCache, toDestination,
+                                         probeCache)
+                futures[future] = items
+
+        # Collect exit codes as the processes finish
+        for future in concurrent.futures.as_completed(futures):
+            batchResults, processTime = future.result()
+            processTimes += [processTime]
+
+            for item, result in zip(futures[future], batchResults):
+                results[item] = result
+
+                if transferJournal and not result[0]:
+                    transferJournal.record(journal.CONVERTED, item.source)
+
+                    if toDestination:
+                        transferJournal.verify(item.source, item.output,
+                                               item.output)
+
+    talk.status("Conversions took %.1f seconds, expected %.1f; the soonest"
+                " they could have finished in was %.1f"
+                % (time.monotonic() - startTime, predictedTime,
+                   schedule.getShortestTotalTime(processTimes, jobs)),
+                not quiet)
+
+    # List of files converted
+    convertedFiles = []
+
+    # Update the plan in its original order
+    for item in conversions:
+        exitCode, outputFile = results[item]
+
+        if exitCode:
+            # Failed to convert, so copy the original file instead
+            talk.error("Failed to convert %s" % item.source, quiet)
+
+            item.action = plan.COPY
+            item.output = None
+        elif toDestination:
+            # Success, and the file is already where it needs to be
+            item.status = plan.DONE
+        else:
+            # Success. Add to list of converted files, unless the file
+            # lives in the cache, which looks after its own files
+            if transcodeCache is None:
+                convertedFiles += [outputFile]
+
+            # Copy the converted file to a destination with the new
+            # extension
+            item.output = outputFile
+            item.destination = (item.destination[:-len(item.extension)]
+                                + '.mp3')
+
+    return convertedFiles
+
+
+def getBatches(conversions, probes, jobs=1):
+    """Group conversions into batches to give to FFmpeg processes.
+
+    Short tracks (see SHORT_TRACK_DURATION) are grouped in the order
+    they come in, into batches of at most BATCH_SIZE, but small enough
+    that every job gets some. Every other track, including ones whose
+    duration can't be found, gets a batch of its own.
+
+    Args:
+        conversions: A list of 'plan.TransferItem' objects to convert.
+        probes: A dictionary mapping the items' sources to what's in
+            them, as returned by probe.probeFiles.
+        jobs: An optional integer specifying how many FFmpeg processes
+            will run at the same time.
+
+    Returns:
+        A list of lists of 'plan.TransferItem' objects.
+    """
+    shortTracks = []
+    batches = []
+
+    for item in conversions:
+        info = probes[item.source]
+
+        if (info and info['duration'] is not None
+                and info['duration'] <= SHORT_TRACK_DURATION):
+            shortTracks += [item]
+        else:
+            batches += [[item]]
+
+    batchSize = max(1, min(BATCH_SIZE, -(-len(shortTracks) // jobs)))
+
+    batches += [shortTracks[start:start + batchSize]
+                for start in range(0, len(shortTracks), batchSize)]
+
+    return batches
+
+
+def recordConversion(transferJournal, source, output, transcodeCache=None,
+                     toDestination=False):
+    """Record a conversion as planned in a journal.
+
+    Args:
+        transferJournal: A 'journal.Journal' object.
+        source: A string containing the path of the file to convert.
+        output: A string containing the path to convert to, which is
+            ignored when using a transcode cache.
+        transcodeCache: An optional 'cache.TranscodeCache' object the
+            conversion goes through. It looks after its own files.
+        toDestination: An optional boolean signalling that the
+            conversion writes straight to the destination.
+    """
+    if transcodeCache is not None:
+        transferJournal.record(journal.PLANNED, source)
+    elif toDestination:
+        transferJournal.record(journal.PLANNED, source, output=output,
+                               partial=getPartialPath(output))
+    elif os.path.lexists(output):
+        # FFmpeg won't overwrite a file that's already there, so it
+        # isn't this transfer's to clean up
+        transferJournal.record(journal.PLANNED, source)
+    else:
+        transferJournal.record(journal.PLANNED, source, output=output,
+                               partial=output, temporary=True)
+
+    return
+
+
+def getConversionExtensions(configsettings, noninteractive=False):
+    """Return which extensions to convert and whether to prompt for them.
+
+    Args:
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to leave out
+            extensions that would need prompting for.
+
+    Returns:
+        A list of two-item lists of ["extension", promptOption], where
+        the extension is lower case and includes the leading period.
+    """
     # Load extensions to convert from config file
     flacConvert = configsettings.getint('ConvertFLACtoMP3')
     alacConvert = configsettings.getint('ConvertALACtoMP3')
@@ -312,20 +835,198 @@ def convertAudioFiles(sourceFiles, destinationFiles, configsettings,
     if oggConvert:
         extensionList += [['.ogg', oggConvert - 1]]
 
-    # Make sure we don't prompt if we're in non-interactive mode
+    # Make sure we don't prompt if we're in non-interactive mode, by not
+    # converting extensions we'd prompt for
     if noninteractive:
-        for pair in extensionList:
-            if pair[1] == PROMPT:
-                # Don't convert this extension
-                pairIndex = extensionList.index(pair)
-                extensionList.pop(pairIndex)
+        extensionList = [pair for pair in extensionList if not pair[1]]
+
+    return extensionList
 
-    # Return an empty list if we don't need to convert anything
-    if not extensionList:
-        return []
 
-    # We need to look for files to convert. Determine how noisy FFmpeg
-    # should be.
+def planConversions(transferPlan, configsettings, noninteractive=False,
+                    toDestination=False, answers=None):
+    """Work out which audio files to convert to mp3.
+
+    Decides which pending files of a transfer plan need converting
+    according to the config settings, prompting as necessary. Nothing is
+    converted here.
+
+    Args:
+        transferPlan: A 'plan.TransferPlan' object.
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to never ask to
+            convert files that it would otherwise prompt for, and
+            furthermore, to not do such conversions.
+        toDestination: An optional boolean toggling whether conversions
+            should write straight to the destination files.
+        answers: An optional dictionary of answers to conversion
+            prompts; see ConversionPlanner.
+
+    Returns:
+        A list of the 'plan.TransferItem' objects to convert, in plan
+        order. Their action is set to convert, and their extension and
+        output are set to the extension being converted from and the
+        path to convert to. Files which don't need to be converted or
+        copied because they already exist at the destination are marked
+        as done.
+    """
+    planner = ConversionPlanner(configsettings, noninteractive, toDestination,
+                                answers)
+
+    # Items to convert
+    conversions = []
+
+    # Work out which files to convert before starting any FFmpeg
+    # processes, so that all of the prompting is done up front
+    for item in transferPlan.files():
+        conversion, finished = planner.plan(item.source, item.destination)
+
+        if conversion:
+            item.action = plan.CONVERT
+            item.extension, item.output = conversion
+            conversions += [item]
+        if finished:
+            item.status = plan.DONE
+
+    return conversions
+
+
+class ConversionPlanner:
+    """Decides which audio files to convert to mp3, one at a time.
+
+    Holds on to the answers given to prompts, so that the user isn't
+    asked more than once about the same extension in the same directory.
+    See planConversions.
+    """
+
+    def __init__(self, configsettings, noninteractive=False,
+                 toDestination=False, answers=None):
+        """Load conversion settings from config settings.
+
+        Args:
+            configsettings: A dictionary-like 'configparser.SectionProxy'
+                object containing configuration settings from
+                config.ini.
+            noninteractive: An optional boolean signalling to never ask
+                to convert files that it would otherwise prompt for,
+                and furthermore, to not do such conversions.
+            toDestination: An optional boolean toggling whether
+                conversions should write straight to the destination
+                files.
+            answers: An optional dictionary mapping 2-tuples of
+                ("dirpath", "extension") to whether to convert files of
+                that extension in that directory, so as not to prompt
+                for them (see decisions.askConversions).
+        """
+        self.extensionList = getConversionExtensions(configsettings,
+                                                     noninteractive)
+        self.noninteractive = noninteractive
+        self.toDestination = toDestination
+
+        # Don't prompt more than once to convert the same file
+        # extension in the same directory. Initialize a whitelist and
+        # blacklist for this, [**] which will contain sets of two-tuples
+        # of ("dirpath", "extension")
+        self.whitelist = set()
+        self.blacklist = set()
+
+        for key, convert in (answers or {}).items():
+            if convert:
+                self.whitelist.add(key)
+            else:
+                self.blacklist.add(key)
+
+        # If we're writing straight to the destination we need to know
+        # whether to overwrite existing destination files ourselves,
+        # since cp won't be doing it for us
+        self.overwritesetting = configsettings.getint(
+                                                'OverwriteDestinationFiles')
+
+    def plan(self, oldFile, destination):
+        """Decide whether to convert a file, prompting as necessary.
+
+        Args:
+            oldFile: A string containing the absolute path of a source
+                file.
+            destination: A string containing the absolute path of the
+                corresponding destination file.
+
+        Returns:
+            A 2-tuple containing (conversion, finished), where
+            conversion is None if the file shouldn't be converted and
+            otherwise a 2-tuple of ("extension", "newFile"), and
+            finished is a boolean signalling that the file needs neither
+            converting nor copying since it already exists at the
+            destination.
+        """
+        for extension, prompt in self.extensionList:
+            # Find if the extensions match
+            if not oldFile.lower().endswith(extension):
+                continue
+
+            # An extension matched!
+            if prompt:
+                # Work out whether we're on the whitelist, blacklist, or
+                # whether we should prompt for this file. See [**] above
+                # for more details.
+                container = os.path.dirname(oldFile)
+
+                if (container, extension) in self.whitelist:
+                    # Convert the file
+                    pass
+                elif (container, extension) in self.blacklist:
+                    # Don't convert the file
+                    return (None, False)
+                elif talk.prompt(
+                        "Convert %s and other %s's in the same directory?"
+                        % (oldFile, extension)):
+                    # Add to whitelist and convert
+                    self.whitelist.add((container, extension))
+                else:
+                    # Add to blacklist and don't convert
+                    self.blacklist.add((container, extension))
+                    return (None, False)
+
+            if not self.toDestination:
+                return ((extension, oldFile[:-len(extension)] + '.mp3'),
+                        False)
+
+            newFile = destination[:-len(extension)] + '.mp3'
+
+            # Leave existing destination files alone unless we're told
+            # to overwrite them
+            if (os.path.exists(newFile)
+                    and not (self.overwritesetting == YES
+                             or (self.overwritesetting == PROMPT
+                                 and not self.noninteractive
+                                 and talk.prompt("Overwrite %s?"
+                                                 % newFile)))):
+                return (None, True)
+
+            return ((extension, newFile), False)
+
+        # No extensions matched
+        return (None, False)
+
+
+def getFFmpegOptions(jobs=1, verbose=False, quiet=False):
+    """Return options to give FFmpeg when converting audio files.
+
+    Args:
+        jobs: An optional integer specifying how many FFmpeg processes
+            will run at the same time.
+        verbose: An optional boolean toggling whether FFmpeg should give
+            extra output.
+        quiet: An optional boolean toggling whether FFmpeg should omit
+            everything but fatal errors.
+
+    Returns:
+        A 2-tuple containing two lists of strings: the options to give
+        before the input file, and the options specifying how to encode
+        the output file.
+    """
+    # Determine how noisy FFmpeg should be
     if quiet:
         logsetting = 'fatal'
     elif verbose:
@@ -333,111 +1034,366 @@ def convertAudioFiles(sourceFiles, destinationFiles, configsettings,
     else:
         logsetting = 'warning'
 
-    # List of files converted
-    convertedFiles = []
+    # Only give stdin to FFmpeg if there's a single process that could
+    # be reading it
+    if jobs > 1:
+        stdinOption = ['-nostdin']
+    else:
+        stdinOption = []
 
-    # Don't prompt more than once to convert the same file extension in
-    # the same directory.  Initialize a whitelist and blacklist for
-    # this, [**] which will contain lists of two-tuples of ("dirpath",
-    # "extension")
-    whitelist = []
-    blacklist = []
+    inputOptions = ['-hide_banner'] + stdinOption + ['-loglevel', logsetting]
+    encoderOptions = ['-codec:a', 'libmp3lame', '-qscale:a', QUALITY]
 
-    # Convert each file as necessary
-    for oldFile in sourceFiles:
-        for extension, prompt in extensionList:
-            # Find if the extensions match
-            extensionMatch = oldFile.lower().endswith(extension)
-
-            if extensionMatch:
-                # An extension matched!
-                if prompt:
-                    # Work out whether we're on the whitelist,
-                    # blacklist, or whether we should prompt for this
-                    # file. See [**] above for more details.
-                    container = os.path.dirname(oldFile)
-
-                    if (container, extension) in whitelist:
-                        # Convert the file
-                        pass
-                    elif (container, extension) in blacklist:
-                        # Move on to next file
-                        break
-                    else:
-                        # Prompt and modify white/black-lists
-                        # accordingly
-                        if talk.prompt(
-                           "Convert %s and other %s's in the same directory?"
-                           % (oldFile, extension)):
-                            # Add to whitelist and convert
-                            whitelist += [(container, extension)]
-                        else:
-                            # Add to blacklist and move on to next file
-                            blacklist += [(container, extension)]
-                            break
-
-                # Convert the file!
-                talk.status("Converting %s" % oldFile, verbose)
-
-                newFile = oldFile[:-len(extension)] + '.mp3'
-                command = (['ffmpeg']
-                           + ['-n']
-                           + ['-hide_banner']
-                           + ['-loglevel', logsetting]
-                           + ['-i', oldFile]
-                           + ['-codec:a', 'libmp3lame']
-                           + ['-qscale:a', QUALITY]
-                           + [newFile])
-
-                # Give stdin and stdout to user and wait for completion
-                convertProcess = subprocess.Popen(command)
-                exitCode = convertProcess.wait()
-
-                if exitCode:
-                    # Failed to convert
-                    talk.error("Failed to convert %s" % oldFile, quiet)
-                else:
-                    # Success. Add to list of converted files
-                    convertedFiles += [newFile]
+    return (inputOptions, encoderOptions)
 
-                    # Swap the source and destination files with the new
-                    # converted file-name.
-                    oldFileIndex = sourceFiles.index(oldFile)
-                    oldDestination = destinationFiles[oldFileIndex]
-                    newDestination = oldDestination[:-len(extension)] + '.mp3'
 
-                    sourceFiles[oldFileIndex] = newFile
-                    destinationFiles[oldFileIndex] = newDestination
+def transcodeFile(oldFile, newFile, inputOptions, encoderOptions,
+                  transcodeCache=None, atomic=False, probeCache=None):
+    """Transcode a file with FFmpeg, going through a cache if given.
 
-                # Move on to next file
-                break
+    Without a cache, the file is transcoded into newFile. With a cache,
+    an existing entry for the file and encoder options is used if there
+    is one; otherwise the file is transcoded into a new cache entry.
+
+    Atomic transcodes write to a temporary file next to newFile, which
+    replaces newFile only once FFmpeg succeeds, so a failed transcode
+    never leaves a partial file behind. Otherwise an existing newFile
+    is left alone and the transcode fails.
+
+    With a probe cache, the file is probed first, and if the stereo can
+    already play its audio (see probe.isPlayable), the audio is remuxed
+    into an mp3 file as it is instead of being encoded again, which is
+    both much faster and lossless.
+
+    Args:
+        oldFile: A string containing the path of the file to transcode.
+        newFile: A string containing the path to transcode to when not
+            using a cache.
+        inputOptions: A list of strings containing FFmpeg options to
+            give before the input file.
+        encoderOptions: A list of strings containing FFmpeg options
+            specifying how to encode the output file.
+        transcodeCache: An optional 'cache.TranscodeCache' object.
+        atomic: An optional boolean toggling whether to transcode into
+            newFile atomically. Only used without a cache.
+        probeCache: An optional 'probe.ProbeCache' object.
+
+    Returns:
+        A 2-tuple containing the exit code of the transcode and the path
+        of the transcoded file.
+    """
+    encoderOptions = getEncoderOptions(oldFile, encoderOptions, probeCache)
+
+    # Only the audio can be remuxed into an mp3; leave out anything else
+    if encoderOptions is REMUX_OPTIONS:
+        mapOptions = ['-map', '0:a:0']
+    else:
+        mapOptions = []
+
+    if transcodeCache is None and atomic:
+        temporaryPath = getPartialPath(newFile)
+        command = (['ffmpeg', '-y']
+                   + inputOptions
+                   + ['-i', oldFile]
+                   + mapOptions
+                   + encoderOptions
+                   + ['-f', 'mp3', temporaryPath])
+        exitCode = runProcess(command)
+
+        try:
+            if exitCode:
+                os.remove(temporaryPath)
+            else:
+                os.replace(temporaryPath, newFile)
+        except OSError:
+            exitCode = exitCode or 1
+
+        return (exitCode, newFile)
+    elif transcodeCache is None:
+        command = (['ffmpeg', '-n']
+                   + inputOptions
+                   + ['-i', oldFile]
+                   + mapOptions
+                   + encoderOptions
+                   + [newFile])
+
+        return (runProcess(command), newFile)
+
+    try:
+        key = transcodeCache.key(oldFile, *encoderOptions,
+                                 cache.ffmpegVersion())
+    except OSError:
+        # Couldn't read the source file
+        return (1, None)
+
+    entryPath = transcodeCache.lookup(key)
+
+    if entryPath:
+        # Cache hit; no need to run FFmpeg
+        return (0, entryPath)
+
+    # Cache miss. Transcode into a temporary file and move it into the
+    # cache once it's finished.
+    temporaryPath = transcodeCache.temporaryPath(key)
+    command = (['ffmpeg', '-y']
+               + inputOptions
+               + ['-i', oldFile]
+               + mapOptions
+               + encoderOptions
+               + ['-f', 'mp3', temporaryPath])
+    exitCode = runProcess(command)
+
+    if exitCode:
+        try:
+            os.remove(temporaryPath)
+        except OSError:
+            pass
+
+        return (exitCode, None)
+
+    return (0, transcodeCache.store(key, temporaryPath))
+
+
+def transcodeBatch(oldFiles, newFiles, inputOptions, encoderOptions,
+                   transcodeCache=None, atomic=False, probeCache=None):
+    """Transcode several files with a single FFmpeg process.
+
+    Starting FFmpeg and its encoder takes a while, which adds up over
+    hundreds of short tracks. Each file is transcoded as transcodeFile
+    would, except that the files which need transcoding are given to
+    one FFmpeg process as separate inputs, each mapped to its own
+    output. FFmpeg gives up on all of them if any one fails, so if it
+    does, the files are transcoded again one at a time, which fails
+    only the bad ones. Cover art isn't carried over by batched
+    transcodes.
+
+    Args:
+        oldFiles: A list of strings containing the paths of the files
+            to transcode.
+        newFiles: A list of strings containing the paths to transcode
+            them to when not using a cache.
+        inputOptions: A list of strings containing FFmpeg options to
+            give before the input files.
+        encoderOptions: A list of strings containing FFmpeg options
+            specifying how to encode the output files.
+        transcodeCache: An optional 'cache.TranscodeCache' object.
+        atomic: An optional boolean toggling whether to transcode into
+            the new files atomically. Only used without a cache.
+        probeCache: An optional 'probe.ProbeCache' object.
+
+    Returns:
+        A list of 2-tuples as returned by transcodeFile, one for each
+        file, in order.
+    """
+    if len(oldFiles) == 1:
+        return [transcodeFile(oldFiles[0], newFiles[0], inputOptions,
+                              encoderOptions, transcodeCache, atomic,
+                              probeCache)]
+
+    results = [None] * len(oldFiles)
+
+    # Files to give FFmpeg, as 4-tuples of (index, options, "output",
+    # key), where key is the file's cache key when using a cache
+    batch = []
+
+    for index, oldFile in enumerate(oldFiles):
+        options = getEncoderOptions(oldFile, encoderOptions, probeCache)
+        key = None
+
+        if transcodeCache is not None:
+            try:
+                key = transcodeCache.key(oldFile, *options,
+                                         cache.ffmpegVersion())
+            except OSError:
+                # Couldn't read the source file
+                results[index] = (1, None)
+                continue
+
+            entryPath = transcodeCache.lookup(key)
+
+            if entryPath:
+                # Cache hit; no need to run FFmpeg
+                results[index] = (0, entryPath)
+                continue
+
+            output = transcodeCache.temporaryPath(key)
+        elif atomic:
+            output = getPartialPath(newFiles[index])
+        elif os.path.lexists(newFiles[index]):
+            # Left alone, as for transcodeFile
+            results[index] = (1, newFiles[index])
+            continue
+        else:
+            output = newFiles[index]
+
+        batch += [(index, options, output, key)]
+
+    if not batch:
+        return results
+
+    def getCommand(entries):
+        """Return an FFmpeg command transcoding entries of the batch."""
+        command = ['ffmpeg', '-y'] + inputOptions
+
+        for index, _, _, _ in entries:
+            command += ['-i', oldFiles[index]]
+
+        for number, (_, options, output, _) in enumerate(entries):
+            command += (['-map', '%d:a:0' % number,
+                         '-map_metadata', str(number)]
+                        + options
+                        + ['-f', 'mp3', output])
+
+        return command
+
+    exitCodes = [runProcess(getCommand(batch))] * len(batch)
+
+    if exitCodes[0] and len(batch) > 1:
+        # Find out which files are bad
+        exitCodes = [runProcess(getCommand([entry])) for entry in batch]
+
+    for (index, _, output, key), exitCode in zip(batch, exitCodes):
+        if exitCode:
+            try:
+                os.remove(output)
+            except OSError:
+                pass
+
+            if transcodeCache is None:
+                results[index] = (exitCode, newFiles[index])
+            else:
+                results[index] = (exitCode, None)
+        elif transcodeCache is not None:
+            results[index] = (0, transcodeCache.store(key, output))
+        elif atomic:
+            try:
+                os.replace(output, newFiles[index])
+                results[index] = (0, newFiles[index])
+            except OSError:
+                results[index] = (1, newFiles[index])
+        else:
+            results[index] = (0, output)
+
+    return results
 
-    return convertedFiles
 
+def getEncoderOptions(oldFile, encoderOptions, probeCache=None):
+    """Return the FFmpeg options to transcode a file with.
+
+    These are the given encoder options, unless a probe cache is given
+    and the stereo can already play the file's audio (see
+    probe.isPlayable), in which case they're REMUX_OPTIONS.
+    """
+    if probeCache is not None and probe.isPlayable(probeCache.probe(oldFile)):
+        return REMUX_OPTIONS
+
+    return encoderOptions
+
+
+def getPartialPath(newFile):
+    """Return where an atomic transcode into a file writes to first."""
+    head, tail = os.path.split(newFile)
+    return "%s/.%s.%d.part" % (head, tail, os.getpid())
+
+
+def runProcess(command):
+    """Run a command and return its exit code.
+
+    Failing to start the command at all (for instance if the program
+    isn't installed) is reported as a non-zero exit code rather than
+    raised.
+    """
+    try:
+        return subprocess.Popen(command).wait()
+    except OSError:
+        return 127
+
+
+def copyFiles(transferPlan, configsettings, noninteractive=False,
+              verbose=False, quiet=False, transferJournal=None,
+              parallelWriter=None, checksums=None):
+    """Copy the pending files of a transfer plan to their destinations.
+
+    Copy each source file (or the file it was converted to) into its
+    destination file, with options specified in config settings. Files
+    are copied in-process unless the config settings ask for cp to be
+    used.
+
+    Args:
+        transferPlan: A 'plan.TransferPlan' object.
+        configsettings: A dictionary-like 'configparser.SectionProxy'
+            object containing configuration settings from config.ini.
+        noninteractive: An optional boolean signalling to never prompt
+            to overwrite destination files.
+        verbose: An optional boolean toggling whether to print each file
+            copied.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+        transferJournal: An optional 'journal.Journal' object to record
+            copies in.
+        parallelWriter: An optional 'writes.ParallelWriter' object to
+            copy the files with, several at once. It's finished with
+            once the files are copied.
+        checksums: An optional 'verify.Checksums' object to record the
+            checksum of each file in as it's copied in-process.
+
+    Returns:
+        Nothing. Each file copied is marked as done, or failed if it
+        couldn't be copied.
+    """
+    cpOptions = getCopyOptions(configsettings, noninteractive, verbose)
+    bufferSize = getCopyBufferSize(configsettings)
+    preallocateFiles = getPreallocateFiles(configsettings)
+
+    def finishCopy(item, copiedFile, success):
+        """Mark a file as copied or failed."""
+        if success:
+            item.status = plan.DONE
+
+            if transferJournal:
+                transferJournal.verify(item.source, copiedFile,
+                                       item.destination)
+        else:
+            item.status = plan.FAILED
+
+        return
+
+    # Copy the files to the destination directory
+    for item in transferPlan.files():
+        copiedFile = item.output or item.source
+
+        if transferJournal:
+            transferJournal.planCopy(item.source, copiedFile,
+                                     item.destination)
+
+        if parallelWriter:
+            parallelWriter.copy(copiedFile, item.destination,
+                                functools.partial(finishCopy, item,
+                                                  copiedFile))
+        else:
+            finishCopy(item, copiedFile,
+                       copyFile(copiedFile, item.destination, cpOptions,
+                                quiet, bufferSize, preallocateFiles,
+                                checksums))
+
+    if parallelWriter:
+        parallelWriter.finish()
+
+    return
 
-def copyFiles(sourceFiles, destinationFiles, configsettings,
-              noninteractive=False, verbose=False, quiet=False):
-    """Copy files from a source to a destination.
 
-    Use cp with options specified in config settings to copy each source
-    file into a destination file.
+def getCopyOptions(configsettings, noninteractive=False, verbose=False):
+    """Return a list of options to run cp with.
 
-    [*] The indices of the source file list and destination file list
-    inputs must correspond to each other.
+    The in-process copy engine understands the same options.
 
     Args:
-        sourceFiles: A list of strings of absolute paths to source
-            files. See [*] above.
-        destinationFiles: A list of strings of absolute paths to
-            destination files. See [*] above.
         configsettings: A dictionary-like 'configparser.SectionProxy'
             object containing configuration settings from config.ini.
         noninteractive: An optional boolean signalling to never run cp
             with its interactive flag.
         verbose: An optional boolean toggling whether to run cp with its
             verbose flag.
-        quiet: An optional boolean toggling whether to omit error
-            output.
     """
     # Initialize list of options to run cp with
     cpOptions = []
@@ -460,19 +1416,254 @@ def copyFiles(sourceFiles, destinationFiles, configsettings,
     if verbose:
         cpOptions += ['-v']
 
-    # Copy the files to the destination directory
-    for source, destination in zip(sourceFiles, destinationFiles):
+    return cpOptions
+
+
+def getCopyBufferSize(configsettings):
+    """Return the copy buffer size in bytes, or 0 to copy with cp."""
+    bufferSize = configsettings.getint('NativeCopyBufferSize',
+                                       fallback=COPY_BUFFER_SIZE)
+
+    return bufferSize * 1024**2
+
+
+def copyFile(source, destination, cpOptions, quiet=False, bufferSize=0,
+             preallocateFiles=False, checksums=None):
+    """Copy a file and return whether it was successful.
+
+    Args:
+        source: A string containing the path of the file to copy.
+        destination: A string containing the path to copy to.
+        cpOptions: A list of strings containing options as returned by
+            getCopyOptions.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+        bufferSize: An optional integer containing the number of bytes
+            to copy at a time in-process. If zero, run cp instead.
+        preallocateFiles: An optional boolean toggling whether to
+            reserve space for the file before copying it in-process
+            (see preallocate).
+        checksums: An optional 'verify.Checksums' object to record the
+            checksum of the file in as it's copied in-process.
+    """
+    if bufferSize:
+        success = nativeCopyFile(source, destination, cpOptions, bufferSize,
+                                 preallocateFiles, checksums)
+    elif '-i' in cpOptions:
+        # cp asks about overwriting on the terminal itself, so don't let
+        # anything else ask a question at the same time
+        with talk.promptLock:
+            copyProcess = subprocess.Popen(["cp", source, destination]
+                                           + cpOptions)
+            success = not copyProcess.wait()
+    else:
         # Give stdin and stdout to user and wait for completion
-        copyProcess = subprocess.Popen(["cp", source, destination] + cpOptions)
-        exitCode = copyProcess.wait()
+        copyProcess = subprocess.Popen(["cp", source, destination]
+                                       + cpOptions)
+        success = not copyProcess.wait()
 
-        if exitCode:
-            # Failed to copy
-            talk.error("Failed to copy %s" % source, quiet)
+    if not success:
+        # Failed to copy
+        talk.error("Failed to copy %s" % source, quiet)
+
+    return success
+
+
+def nativeCopyFile(source, destination, cpOptions, bufferSize,
+                   preallocateFiles=False, checksums=None):
+    """Copy a file in-process and return whether it was successful.
+
+    Behaves like running cp with the given options: -f overwrites,
+    -i prompts to overwrite, -n leaves existing files alone, and -v
+    prints each file copied. The file's contents are copied by the
+    kernel where possible.
+
+    Args:
+        source: A string containing the path of the file to copy.
+        destination: A string containing the path to copy to.
+        cpOptions: A list of strings containing options as returned by
+            getCopyOptions.
+        bufferSize: An integer containing the number of bytes to copy at
+            a time.
+        preallocateFiles: An optional boolean toggling whether to
+            reserve space for the file before copying it (see
+            preallocate).
+        checksums: An optional 'verify.Checksums' object to record the
+            checksum of the file in as it's copied.
+    """
+    if os.path.lexists(destination):
+        if '-n' in cpOptions:
+            # cp --no-clobber skips existing files without complaint
+            return True
+        elif '-i' in cpOptions and not talk.prompt("Overwrite %s?"
+                                                   % destination):
+            return True
+
+    digest = checksums.newDigest() if checksums else None
+
+    # Whether the destination has been truncated, so that a failed copy
+    # would leave part of a file behind
+    opened = False
+
+    try:
+        with open(source, 'rb') as sourceFile:
+            with open(destination, 'wb') as destinationFile:
+                opened = True
+
+                if preallocateFiles:
+                    preallocate(destinationFile.fileno(),
+                                os.fstat(sourceFile.fileno()).st_size)
+
+                copied = copyFileContents(sourceFile.fileno(),
+                                          destinationFile.fileno(),
+                                          bufferSize, digest)
+
+        # cp keeps the permission bits, for what they're worth on FAT
+        try:
+            shutil.copymode(source, destination)
+        except OSError:
+            pass
+    except OSError:
+        # Don't leave a partial copy behind to be taken for a whole one
+        if opened:
+            removePartialCopy(destination)
+
+        return False
+
+    if checksums:
+        checksums.record(source, destination, digest, copied)
+
+    if '-v' in cpOptions:
+        print("'%s' -> '%s'" % (source, destination))
+
+    return True
+
+
+def removePartialCopy(destination):
+    """Remove a file a copy failed partway through writing, if possible."""
+    try:
+        os.remove(destination)
+    except OSError:
+        pass
 
     return
 
 
+def getPreallocateFiles(configsettings):
+    """Return whether to reserve space for files before copying them."""
+    return bool(configsettings.getint('PreallocateFiles', fallback=NO))
+
+
+@functools.lru_cache(maxsize=None)
+def getFallocate():
+    """Return the C library's fallocate function, or None.
+
+    Python only has posix_fallocate, which on filesystems like FAT that
+    can't reserve space the way it asks for writes zeros instead,
+    doubling the writes to the device.
+    """
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (OSError, AttributeError):
+        return None
+
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                          ctypes.c_int64)
+    fallocate.restype = ctypes.c_int
+
+    return fallocate
+
+
+def preallocate(fd, size):
+    """Reserve space for a file's contents before they're written.
+
+    On FAT, a file written bit by bit gets whichever clusters are free
+    as it grows, and files written at the same time end up interleaved.
+    Reserving the whole file first gives it a contiguous run of
+    clusters where there's one to be had, which is quicker to read back
+    and to write. The file's size is left alone, and space reserved but
+    never written is freed once the file is closed.
+
+    Args:
+        fd: An integer file descriptor of the file, open for writing.
+        size: An integer containing how many bytes the file will hold.
+
+    Returns:
+        A boolean signalling whether the space was reserved. Nothing
+        else happens if it couldn't be, for instance because the
+        filesystem doesn't support it.
+    """
+    fallocate = getFallocate()
+
+    if fallocate is None or size <= 0:
+        return False
+
+    return not fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size)
+
+
+def copyFileContents(sourceFd, destinationFd, bufferSize, digest=None):
+    """Copy everything from one file descriptor to another.
+
+    Uses copy_file_range, then sendfile, then plain reads and writes,
+    falling back to the next method whenever the kernel refuses to do
+    a copy one way before any data has been copied. Only plain reads
+    and writes are used if the contents are being checksummed, since
+    they're the only way the contents pass through here.
+
+    Args:
+        sourceFd: An integer file descriptor to read from.
+        destinationFd: An integer file descriptor to write to.
+        bufferSize: An integer containing the number of bytes to copy at
+            a time.
+        digest: An optional hash object (see hashlib) to give everything
+            copied to.
+
+    Returns:
+        An integer containing the number of bytes copied.
+    """
+    copied = 0
+
+    if hasattr(os, 'copy_file_range') and digest is None:
+        try:
+            while True:
+                count = os.copy_file_range(sourceFd, destinationFd,
+                                           bufferSize)
+                if not count:
+                    return copied
+
+                copied += count
+        except OSError as err:
+            if copied or err.errno not in FALLBACK_ERRNOS:
+                raise
+
+    if digest is None:
+        try:
+            while True:
+                count = os.sendfile(destinationFd, sourceFd, None,
+                                    bufferSize)
+                if not count:
+                    return copied
+
+                copied += count
+        except OSError as err:
+            if copied or err.errno not in FALLBACK_ERRNOS:
+                raise
+
+    while True:
+        data = os.read(sourceFd, bufferSize)
+        if not data:
+            return copied
+
+        if digest is not None:
+            digest.update(data)
+
+        view = memoryview(data)
+        while view:
+            view = view[os.write(destinationFd, view):]
+
+        copied += len(data)
+
+
 def deletePaths(paths, doprompt=True, verbose=False, quiet=False):
     """Delete a list of files and directories possibly containing files.
 
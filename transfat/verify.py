@@ -0,0 +1,261 @@
+"""Contains functions for checking that copies reached the device intact.
+
+Cheap USB sticks and SD cards can silently corrupt what's written to
+them, and a copy which reports success says nothing about what the
+device will read back. When verifying, each file is checksummed as it's
+copied, from the same bytes that are written, so the source isn't read
+a second time. Once everything is copied, each copy is flushed and
+dropped from the page cache, so that reading it back goes to the device
+rather than to memory, and read back and checksummed, several files at
+once. Files whose checksums don't match are copied again, and checked
+again, a few times before giving up on them.
+
+What didn't match is written to a report file of JSON, so it can be
+looked at by other programs.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+from . import cache
+from . import talk
+from . import transfer
+
+# Version of the verification report format
+REPORT_VERSION = 1
+
+# Number of times to copy a file again if its copy doesn't match
+RETRIES = 2
+
+# Bytes to read at a time when reading copies back
+READ_BLOCK_SIZE = 1024**2
+
+
+def getReportPath():
+    """Return a string containing the path of the verification report."""
+    return cache.getCacheDirectoryPath() + "/verify.json"
+
+
+class Checksums:
+    """Checksums of files taken as they were copied.
+
+    Attributes:
+        files: A dictionary mapping the paths files were copied to to
+            3-tuples of ("copied file", "checksum", size), where the
+            copied file is the file the copy was made from, which is
+            the converted file for converted files, and the checksum is
+            a hex string.
+    """
+
+    def __init__(self):
+        """Start without any checksums."""
+        self.files = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def newDigest():
+        """Return a hash object to checksum a file with as it's copied."""
+        return hashlib.blake2b(digest_size=20)
+
+    def record(self, copiedFile, destination, digest, size):
+        """Record a copy's checksum.
+
+        Safe to call from several threads at once.
+
+        Args:
+            copiedFile: A string containing the path of the file copied.
+            destination: A string containing the path it was copied to.
+            digest: A hash object as returned by newDigest which has
+                been given everything that was written.
+            size: An integer containing the number of bytes written.
+        """
+        with self._lock:
+            self.files[destination] = (copiedFile, digest.hexdigest(), size)
+
+        return
+
+
+def checkCopy(destination, checksum, size):
+    """Read a copy back from the device and compare it with its checksum.
+
+    The copy is flushed to the device and dropped from the page cache
+    first, so what's read is what the device holds.
+
+    Args:
+        destination: A string containing the path of the copy.
+        checksum: A hex string containing the checksum it should have.
+        size: An integer containing the size it should have.
+
+    Returns:
+        A 2-tuple containing None if the copy matches, and otherwise a
+        dictionary of its 'destination', the 'expected' and 'actual'
+        checksums, the expected 'size' and the 'actualSize' read, and
+        the 'error' reading it if there was one; and an integer
+        containing the number of bytes read.
+    """
+    digest = Checksums.newDigest()
+    read = 0
+
+    try:
+        fd = os.open(destination, os.O_RDONLY)
+    except OSError as err:
+        return ({'destination': destination, 'expected': checksum,
+                 'actual': None, 'size': size, 'actualSize': None,
+                 'error': err.strerror}, 0)
+
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+        for block in iter(lambda: os.read(fd, READ_BLOCK_SIZE), b''):
+            digest.update(block)
+            read += len(block)
+    except OSError as err:
+        return ({'destination': destination, 'expected': checksum,
+                 'actual': None, 'size': size, 'actualSize': read,
+                 'error': err.strerror}, read)
+    finally:
+        os.close(fd)
+
+    if digest.hexdigest() == checksum and read == size:
+        return (None, read)
+
+    return ({'destination': destination, 'expected': checksum,
+             'actual': digest.hexdigest(), 'size': size, 'actualSize': read,
+             'error': None}, read)
+
+
+def checkCopies(checksums, destinations, jobs=1):
+    """Read copies back from the device, several at once.
+
+    Args:
+        checksums: A 'Checksums' object with the copies' checksums.
+        destinations: A list of strings containing the paths of the
+            copies to check.
+        jobs: An optional integer specifying how many files to read at
+            the same time.
+
+    Returns:
+        A 2-tuple containing a list of dictionaries describing the
+        copies which don't match, as returned by checkCopy along with
+        the 'copiedFile' each was copied from, and an integer containing
+        the number of bytes read.
+    """
+    def check(destination):
+        _, checksum, size = checksums.files[destination]
+        return checkCopy(destination, checksum, size)
+
+    mismatches = []
+    read = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as executor:
+        for mismatch, count in executor.map(check, destinations):
+            read += count
+
+            if mismatch:
+                mismatch['copiedFile'] = checksums.files[
+                                            mismatch['destination']][0]
+                mismatches += [mismatch]
+
+    return (mismatches, read)
+
+
+def verifyCopies(checksums, bufferSize, preallocateFiles=False, jobs=1,
+                 verbose=False, quiet=False):
+    """Check every copy checksummed, copying bad ones again.
+
+    Copies which still don't match after RETRIES more tries are removed
+    from the device, so they aren't taken for good copies later.
+
+    Args:
+        checksums: A 'Checksums' object with the copies' checksums.
+        bufferSize: An integer containing the number of bytes to copy at
+            a time when copying files again.
+        preallocateFiles: An optional boolean toggling whether to
+            reserve space for files copied again (see
+            transfer.preallocate).
+        jobs: An optional integer specifying how many files to read at
+            the same time.
+        verbose: An optional boolean toggling whether to print each file
+            copied again.
+        quiet: An optional boolean toggling whether to omit error
+            output.
+
+    Returns:
+        A 4-tuple containing a list of dictionaries describing the
+        copies which never matched (see checkCopy), each with the number
+        of 'attempts' made at copying it; the number of files checked;
+        the number of bytes read back; and the seconds spent reading.
+    """
+    cpOptions = ['-f', '-v'] if verbose else ['-f']
+    destinations = sorted(checksums.files)
+    attempts = dict.fromkeys(destinations, 1)
+    checked = len(destinations)
+    failed = []
+    totalRead = 0
+    readTime = 0.0
+
+    while destinations:
+        start = time.monotonic()
+        mismatches, read = checkCopies(checksums, destinations, jobs)
+        readTime += time.monotonic() - start
+        totalRead += read
+
+        destinations = []
+
+        for mismatch in mismatches:
+            destination = mismatch['destination']
+
+            if attempts[destination] <= RETRIES:
+                talk.error("%s doesn't match what was copied; copying it"
+                           " again" % destination, quiet)
+
+                attempts[destination] += 1
+
+                if transfer.copyFile(mismatch['copiedFile'], destination,
+                                     cpOptions, quiet, bufferSize,
+                                     preallocateFiles, checksums):
+                    destinations += [destination]
+                    continue
+
+            mismatch['attempts'] = attempts[destination]
+            failed += [mismatch]
+
+    for mismatch in failed:
+        talk.error("%s failed verification; removing it"
+                   % mismatch['destination'], quiet)
+
+    transfer.deleteFiles([mismatch['destination'] for mismatch in failed],
+                         quiet)
+
+    return (failed, checked, totalRead, readTime)
+
+
+def writeReport(path, mismatches, checked):
+    """Write a report of the copies which failed verification.
+
+    The report is a JSON object containing the report 'version', the
+    'time' it was written, the number of files 'checked', and the list
+    of 'mismatches' as returned by verifyCopies.
+
+    Returns:
+        A boolean signalling whether the report was written.
+    """
+    temporaryPath = path + '.part'
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(temporaryPath, 'w') as reportFile:
+            json.dump({'version': REPORT_VERSION, 'time': time.time(),
+                       'checked': checked, 'mismatches': mismatches},
+                      reportFile, indent=2)
+
+        os.replace(temporaryPath, path)
+    except OSError:
+        return False
+
+    return True
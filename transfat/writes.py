@@ -0,0 +1,406 @@
+"""Contains an adaptive way of writing files to a device.
+
+USB sticks and SD cards differ a lot in how well they take writes to
+several files at once: some get faster with two to four going, others
+slow to a crawl. Rather than guess, files are written by a number of
+writers with a buffer size which are both adjusted as the copy goes
+on, AIMD-style. While throughput holds up, the two settings take turns
+being raised by a step; when throughput drops, whichever was raised
+last is halved. The settings which gave the best throughput are
+remembered for each filesystem UUID, and the next copy to the device
+starts from them.
+
+Throughput is only measured honestly if the data reaches the device,
+so each file is flushed to the device once it's written, and only time
+spent with something being written counts, so that waiting on
+conversions doesn't look like a slow device. Files are
+still created one at a time in the order they're given, so ordered
+writes stay in order; only their contents are written in parallel.
+"""
+
+import concurrent.futures
+import json
+import os
+import shutil
+import threading
+import time
+from . import cache
+from . import talk
+from . import transfer
+
+# Version of the device settings file format
+DEVICES_VERSION = 1
+
+# Most files written at once
+MAX_WRITERS = 4
+
+# Smallest and largest buffer sizes in bytes, and how much the buffer
+# size is raised by at a time
+MIN_BUFFER_SIZE = 1024**2
+MAX_BUFFER_SIZE = 32 * 1024**2
+BUFFER_STEP = 4 * 1024**2
+
+# Throughput is measured over windows of at least this many bytes and
+# seconds
+WINDOW_BYTES = 64 * 1024**2
+WINDOW_TIME = 1.0
+
+# Fraction throughput has to drop by to count as a drop, so that noise
+# doesn't halve anything
+TOLERANCE = 0.1
+
+
+def getDevicesPath():
+    """Return a string containing the path of the device settings file."""
+    return cache.getCacheDirectoryPath() + "/devices.json"
+
+
+class WriteController:
+    """Tunes how many files to write at once and with what buffer size.
+
+    Attributes:
+        path: A string containing the path of the device settings file.
+        uuid: A string containing the UUID of the filesystem being
+            written to, or None if it isn't known, in which case nothing
+            is remembered.
+        writers: An integer containing how many files to write at once.
+        bufferSize: An integer containing how many bytes to copy at a
+            time.
+        best: A 3-tuple of (writers, bufferSize, throughput) for the
+            settings which gave the best throughput, in bytes per
+            second, or None if nothing has been measured.
+    """
+
+    def __init__(self, path, uuid, bufferSize):
+        """Start from the settings remembered for a filesystem, if any.
+
+        Args:
+            path: A string containing the path of the device settings
+                file.
+            uuid: A string containing the UUID of the filesystem being
+                written to, or None.
+            bufferSize: An integer containing the buffer size in bytes
+                to start with if nothing is remembered.
+        """
+        self.path = path
+        self.uuid = uuid
+        self.writers = 1
+        self.bufferSize = min(max(bufferSize, MIN_BUFFER_SIZE),
+                              MAX_BUFFER_SIZE)
+        self.best = None
+
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._windowBytes = 0
+        self._windowTime = 0.0
+        self._busySince = None
+        self._previousThroughput = None
+        self._lastRaised = None
+        self._nextRaised = 'writers'
+
+        try:
+            with open(path, 'r') as devicesFile:
+                contents = json.load(devicesFile)
+        except (OSError, ValueError):
+            return
+
+        if (isinstance(contents, dict)
+                and contents.get('version') == DEVICES_VERSION
+                and isinstance(contents.get('devices'), dict)):
+            self._devices = contents['devices']
+
+        settings = self._devices.get(uuid)
+
+        # Ignore settings which have been mangled
+        try:
+            writers = int(settings['writers'])
+            bufferSize = int(settings['bufferSize'])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        self.writers = min(max(writers, 1), MAX_WRITERS)
+        self.bufferSize = min(max(bufferSize, MIN_BUFFER_SIZE),
+                              MAX_BUFFER_SIZE)
+
+    def save(self):
+        """Remember the best settings found; return whether that worked.
+
+        Nothing is written if the filesystem's UUID isn't known, nothing
+        was measured, or the settings already remembered gave better
+        throughput, since a short copy can't be measured as well as a
+        long one.
+        """
+        if self.uuid is None or self.best is None:
+            return True
+
+        writers, bufferSize, throughput = self.best
+        settings = self._devices.get(self.uuid)
+
+        try:
+            if throughput <= float(settings['throughput']):
+                return True
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        self._devices[self.uuid] = {'writers': writers,
+                                    'bufferSize': bufferSize,
+                                    'throughput': throughput}
+
+        temporaryPath = self.path + '.part'
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            with open(temporaryPath, 'w') as devicesFile:
+                json.dump({'version': DEVICES_VERSION,
+                           'devices': self._devices},
+                          devicesFile, separators=(',', ':'))
+
+            os.replace(temporaryPath, self.path)
+        except OSError:
+            return False
+
+        return True
+
+    def setBusy(self, busy):
+        """Start or stop the clock throughput is measured with.
+
+        Call with True when something starts being written and nothing
+        was, and with False when nothing is being written any more.
+        """
+        with self._lock:
+            now = time.monotonic()
+
+            if busy:
+                self._busySince = now
+            elif self._busySince is not None:
+                self._windowTime += now - self._busySince
+                self._busySince = None
+
+        return
+
+    def record(self, count):
+        """Count bytes written to the device, adjusting once per window.
+
+        Safe to call from several threads at once.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._windowBytes += count
+            elapsed = self._windowTime
+
+            if self._busySince is not None:
+                elapsed += now - self._busySince
+
+            if self._windowBytes >= WINDOW_BYTES and elapsed >= WINDOW_TIME:
+                self.adjust(self._windowBytes / elapsed)
+                self._windowBytes = 0
+                self._windowTime = 0.0
+
+                if self._busySince is not None:
+                    self._busySince = now
+
+        return
+
+    def adjust(self, throughput):
+        """Adjust the settings after a window of writes.
+
+        Args:
+            throughput: A float containing the bytes per second written
+                over the window, with the current settings.
+        """
+        if self.best is None or throughput > self.best[2]:
+            self.best = (self.writers, self.bufferSize, throughput)
+
+        if (self._previousThroughput is not None
+                and throughput < self._previousThroughput * (1 - TOLERANCE)):
+            # Multiplicative decrease of whatever was raised last
+            if self._lastRaised == 'writers':
+                self.writers = max(1, self.writers // 2)
+            elif self._lastRaised == 'bufferSize':
+                self.bufferSize = max(MIN_BUFFER_SIZE, self.bufferSize // 2)
+
+            self._lastRaised = None
+        else:
+            # Additive increase, taking turns between the settings
+            for _ in range(2):
+                setting = self._nextRaised
+                self._nextRaised = ('bufferSize' if setting == 'writers'
+                                    else 'writers')
+
+                if setting == 'writers' and self.writers < MAX_WRITERS:
+                    self.writers += 1
+                elif (setting == 'bufferSize'
+                      and self.bufferSize < MAX_BUFFER_SIZE):
+                    self.bufferSize = min(self.bufferSize + BUFFER_STEP,
+                                          MAX_BUFFER_SIZE)
+                else:
+                    # Already as high as it goes
+                    continue
+
+                self._lastRaised = setting
+                break
+            else:
+                self._lastRaised = None
+
+        self._previousThroughput = throughput
+
+        return
+
+
+class ParallelWriter:
+    """Copies files to a device with several writers at once.
+
+    Files are created in the calling thread, in the order they're given,
+    and prompted about there if need be. Their contents are written by
+    a pool of threads, as many at a time as a 'WriteController' says,
+    and flushed to the device.
+    """
+
+    def __init__(self, controller, cpOptions, quiet=False,
+                 preallocateFiles=False, checksums=None):
+        """Set up a writer.
+
+        Args:
+            controller: A 'WriteController' object.
+            cpOptions: A list of strings containing options as returned
+                by transfer.getCopyOptions, which are understood as by
+                transfer.nativeCopyFile.
+            quiet: An optional boolean toggling whether to omit error
+                output.
+            preallocateFiles: An optional boolean toggling whether to
+                reserve space for each file when it's created (see
+                transfer.preallocate). With several files written at
+                once, this is what keeps them from being interleaved.
+            checksums: An optional 'verify.Checksums' object to record
+                the checksum of each file in as it's written.
+        """
+        self.controller = controller
+        self.cpOptions = cpOptions
+        self.quiet = quiet
+        self.preallocateFiles = preallocateFiles
+        self.checksums = checksums
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                                                    max_workers=MAX_WRITERS)
+        self._writing = 0
+        self._condition = threading.Condition()
+
+    def copy(self, source, destination, callback):
+        """Start copying a file.
+
+        The destination file exists once this returns, but its contents
+        may not be written yet. Waits for a writer to be free first.
+
+        Args:
+            source: A string containing the path of the file to copy.
+            destination: A string containing the path to copy to.
+            callback: A function to call with a boolean signalling
+                whether the copy was successful once it's done. It may
+                be called from another thread.
+        """
+        if os.path.lexists(destination):
+            if '-n' in self.cpOptions:
+                # cp --no-clobber skips existing files without complaint
+                callback(True)
+                return
+            elif '-i' in self.cpOptions and not talk.prompt(
+                                        "Overwrite %s?" % destination):
+                callback(True)
+                return
+
+        try:
+            sourceFd = os.open(source, os.O_RDONLY)
+        except OSError:
+            self.fail(source, callback)
+            return
+
+        try:
+            destinationFd = os.open(destination,
+                                    os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                    0o666)
+        except OSError:
+            os.close(sourceFd)
+            self.fail(source, callback)
+            return
+
+        if self.preallocateFiles:
+            transfer.preallocate(destinationFd, os.fstat(sourceFd).st_size)
+
+        with self._condition:
+            self._condition.wait_for(
+                        lambda: self._writing < self.controller.writers)
+            self._writing += 1
+
+            if self._writing == 1:
+                self.controller.setBusy(True)
+
+        self._executor.submit(self.write, source, destination, sourceFd,
+                              destinationFd, callback)
+
+        return
+
+    def write(self, source, destination, sourceFd, destinationFd, callback):
+        """Write a file's contents and flush them to the device.
+
+        Meant to run on the pool; see copy. Closes both file
+        descriptors.
+        """
+        digest = self.checksums.newDigest() if self.checksums else None
+
+        try:
+            size = transfer.copyFileContents(sourceFd, destinationFd,
+                                             self.controller.bufferSize,
+                                             digest)
+            os.fsync(destinationFd)
+            success = True
+        except OSError:
+            success = False
+        finally:
+            os.close(sourceFd)
+            os.close(destinationFd)
+
+        with self._condition:
+            self._writing -= 1
+            self._condition.notify_all()
+
+            if not self._writing:
+                self.controller.setBusy(False)
+
+        if not success:
+            # Don't leave a partial copy behind to be taken for a whole
+            # one
+            transfer.removePartialCopy(destination)
+            self.fail(source, callback)
+            return
+
+        self.controller.record(size)
+
+        if self.checksums:
+            self.checksums.record(source, destination, digest, size)
+
+        # cp keeps the permission bits, for what they're worth on FAT
+        try:
+            shutil.copymode(source, destination)
+        except OSError:
+            pass
+
+        if '-v' in self.cpOptions:
+            print("'%s' -> '%s'" % (source, destination))
+
+        callback(True)
+
+        return
+
+    def fail(self, source, callback):
+        """Report a failed copy."""
+        talk.error("Failed to copy %s" % source, self.quiet)
+        callback(False)
+
+        return
+
+    def finish(self):
+        """Wait for every copy started to finish."""
+        self._executor.shutdown(wait=True)
+
+        return